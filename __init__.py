@@ -12,10 +12,19 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import bpy
+import time
+import traceback
 from pathlib import Path
+from typing import Iterator
 
-from .vmt import VMT
+from .vmt import VMT, Progress
 from . import vtf
+from . import deferred
+from . import instrument
+from . import vpk
+from .cache import TextureCache, get_cache, session_cache
+from .content import get_index
+from .diskcache import get_pixel_cache
 from .crafty import CraftyMtl
 from .models import ModelsMtl
 
@@ -36,7 +45,53 @@ def menu_func_import(self, context):
     self.layout.operator(VtfImporter.bl_idname, text="Source Engine Image (.vtf)")
 
 
-class VmtImporter(bpy.types.Operator):
+class ImportOptions:
+    """Properties of all operators, inherited by them like the ones of bpy_extras' ImportHelper"""
+
+    backend: bpy.props.EnumProperty(items=[
+        ("vtflib", "VTFLib (default)", "Decode with the included VTFLib"),
+        ("numpy", "NumPy", "Decode with NumPy, can decode several textures at once in threads. Falls back to VTFLib for uncommon formats")
+    ], name="VTF decoder", default="vtflib")
+
+    log_level: bpy.props.EnumProperty(items=[
+        ("ERRORS", "Errors", "Only log failures"),
+        ("SUMMARY", "Summary (default)", "Log failures and a summary of the timings at the end"),
+        ("STEPS", "Every step", "Log every step of the import, slows down large imports")
+    ], name="Console log", default="SUMMARY")
+    timing_file: bpy.props.StringProperty(name="Timing file", subtype='FILE_PATH', default="", description="Save the timings of the import as JSON to this file, leave empty to disable")
+
+
+class ParallelDecoding(ImportOptions):
+    """Properties of the operators decoding many textures at once"""
+
+    workers: bpy.props.IntProperty(name="Decoding processes", default=0, min=0, description="Number of processes (or threads with the NumPy decoder) used to decode textures in parallel, 0 uses all CPU cores")
+
+
+class DecodeOptions(ImportOptions):
+    """Properties of the operators importing textures"""
+
+    cache_directory: bpy.props.StringProperty(name="Persistent cache directory", subtype='DIR_PATH', default="", description="Stores decoded textures for faster imports in later sessions, leave empty to disable")
+    cache_size: bpy.props.IntProperty(name="Persistent cache size (MB)", default=4096, min=1, description="Least recently used textures are removed from the persistent cache when it grows larger than this")
+    low_memory: bpy.props.BoolProperty(name="Limit memory usage", description="Free temporary buffers after every texture and limit the number of decoded textures waiting to be imported", default=False)
+    max_size: bpy.props.IntProperty(name="Max texture size", default=0, min=0, description="Import a smaller mipmap stored in the VTF file if the texture is larger than this, 0 imports the full size")
+
+
+class MaterialOptions(DecodeOptions):
+    """Properties of the operators importing materials"""
+
+    share_textures: bpy.props.BoolProperty(name="Reuse imported textures", description="Reuse textures imported earlier in this session or found in the .blend file", default=True)
+    deferred: bpy.props.EnumProperty(items=[
+        ("NONE", "Immediately (default)", "Load textures before the materials are created"),
+        ("BACKGROUND", "In the background", "Create the materials with placeholder textures and load the textures in the background"),
+        ("MANUAL", "On demand", "Create the materials with placeholder textures, load them later with Load deferred Source textures")
+    ], name="Load textures", default="NONE")
+    node_groups: bpy.props.BoolProperty(name="Use shared node groups", description="Build the shader from node groups shared between materials, faster to create and compile", default=False)
+    bake_channels: bpy.props.BoolProperty(name="Bake derived textures", description="Extract single channels and convert phong exponents to roughness at import, so the shaders don't need separate and math nodes. Not available when loading textures later", default=False)
+    merge_identical: bpy.props.BoolProperty(name="Merge identical textures", description="Import texture files with identical contents only once, even if their paths differ. The files are hashed before decoding", default=False)
+    memory_budget: bpy.props.IntProperty(name="Memory budget (MB)", default=0, min=0, description="Decode no more textures than fit in this much memory and free the pixels of imported textures when over it, 0 is unlimited. The peak usage is logged in the summary")
+
+
+class VmtImporter(bpy.types.Operator, MaterialOptions):
     """Import Source Engine VMT file as a material"""
     bl_idname = "import_scene.vmt"
     bl_label = "Import VMT"
@@ -56,10 +111,22 @@ class VmtImporter(bpy.types.Operator):
     override: bpy.props.BoolProperty(default=False, name='Override existing material')
 
     def execute(self, context):
-        vmt = VMT(Path(self.filepath), self.textext, Path(self.texturepath) if self.texturepath else None)
-        if not vmt.make_material(self.materialname, self.override):
+        deferred.begin(instrument.LEVELS[self.log_level])
+        cache = get_cache(self.share_textures, get_pixel_cache(self.cache_directory, self.cache_size), self.low_memory, self.backend, self.max_size, self.deferred != 'NONE', self.bake_channels, self.merge_identical, self.memory_budget)
+        index = None
+        if self.texturepath:
+            # Also finds the textures in the VPK archives of the game directory
+            index = get_index(Path(self.texturepath), Path(self.cache_directory) if self.cache_directory else None)
+        vmt = VMT(Path(self.filepath), self.textext, Path(self.texturepath) if self.texturepath else None, cache, index)
+        if not vmt.make_material(self.materialname, self.override, self.node_groups):
             self.report({'INFO'}, 'Material already exists')
+            instrument.end(self.timing_file)
             return {'CANCELLED'}
+        if self.deferred == 'BACKGROUND':
+            # Ends the session once the textures are loaded
+            deferred.BackgroundLoader(deferred.get_pending_images(), 0, cache.pixel_cache, self.low_memory, self.backend, self.timing_file).start()
+        else:
+            instrument.end(self.timing_file)
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -67,7 +134,7 @@ class VmtImporter(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
 
-class VtfImporter(bpy.types.Operator):
+class VtfImporter(bpy.types.Operator, DecodeOptions):
     """Import Source Engine VTF file as a image"""
     bl_idname = "import_scene.vtf"
     bl_label = "Import VTF"
@@ -77,7 +144,9 @@ class VtfImporter(bpy.types.Operator):
     filter_glob: bpy.props.StringProperty(default="*.vtf", options={'HIDDEN'})
 
     def execute(self, context):
-        vtf.import_image(Path(self.filepath))
+        deferred.begin(instrument.LEVELS[self.log_level])
+        vtf.import_image(Path(self.filepath), get_pixel_cache(self.cache_directory, self.cache_size), self.low_memory, self.backend, self.max_size)
+        instrument.end(self.timing_file)
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -85,7 +154,103 @@ class VtfImporter(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
 
-class SourceModelsMtlImporter(bpy.types.Operator):
+# Seconds spent importing per timer event in batch imports, keeps the UI responsive
+BATCH_STEP_TIME = 0.1
+BATCH_TIMER_INTERVAL = 0.01
+
+
+class BatchImport(MaterialOptions, ParallelDecoding):
+    """Runs a batch import started from the UI in time slices from a timer, showing the progress in the status bar.
+    Esc cancels the import, keeping the materials imported so far. Imports executed from scripts run in one go."""
+
+    deduplicate: bpy.props.BoolProperty(name="Merge duplicate materials", description="Build equivalent materials (same textures and parameters) only once and use that material for all of them", default=False)
+    skip_unchanged: bpy.props.BoolProperty(name="Skip unchanged materials", description="Don't build materials again that were imported before from the same unchanged VMT and texture files with the same options", default=True)
+    show_progress: bpy.props.BoolProperty(name="Show progress", description="Import in small steps, showing the progress in the status bar and allowing to cancel with Esc. Imports from scripts always run in one go", default=True)
+
+    _interactive = False
+
+    def invoke(self, context, event):
+        self._interactive = True
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def run_batch(self, context, steps: Iterator[Progress], cache: TextureCache):
+        self._steps = steps
+        self._cache = cache
+        if not (self._interactive and self.show_progress) or bpy.app.background:
+            try:
+                for _ in steps:
+                    pass
+            finally:
+                result = self._finish_batch()
+            return result
+        self._progress = None
+        self._started = time.perf_counter()
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(BATCH_TIMER_INTERVAL, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, 100)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._steps.close()
+            self._end_modal(context)
+            done = self._progress.materials_done if self._progress else 0
+            self.report({'WARNING'}, "Import cancelled, kept {} imported materials".format(done))
+            return self._finish_batch()
+        if event.type != 'TIMER':
+            # Blocks undo, opening files and the like while the import is changing the data
+            return {'RUNNING_MODAL'}
+        deadline = time.perf_counter() + BATCH_STEP_TIME
+        try:
+            # At least one step per event, even if a step takes longer than the time slice
+            while True:
+                self._progress = next(self._steps)
+                if time.perf_counter() >= deadline:
+                    break
+        except StopIteration:
+            self._end_modal(context)
+            return self._finish_batch()
+        except Exception as e:
+            traceback.print_exc()
+            self._end_modal(context)
+            self.report({'ERROR'}, "Import failed: {}".format(e))
+            instrument.end(self.timing_file)
+            return {'CANCELLED'}
+        self._update_status(context)
+        return {'RUNNING_MODAL'}
+
+    def _update_status(self, context):
+        progress = self._progress
+        if progress is None:
+            return
+        elapsed = max(time.perf_counter() - self._started, 1e-6)
+        # Textures and materials are imported interleaved, the bar shows both together
+        done = progress.textures_done + progress.materials_done
+        total = progress.textures_total + progress.materials_total
+        context.window_manager.progress_update(int(100 * done / max(total, 1)))
+        decoded = instrument.recorder.counters["decoded bytes"] / (1024 * 1024)
+        context.workspace.status_text_set("Importing textures {}/{}, materials {}/{}, {:.1f} MB/s, {:.1f} materials/s, Esc to cancel".format(
+            progress.textures_done, progress.textures_total, progress.materials_done, progress.materials_total,
+            decoded / elapsed, progress.materials_done / elapsed))
+
+    def _end_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+    def _finish_batch(self):
+        if self.deferred == 'BACKGROUND':
+            # Ends the session once the textures are loaded
+            deferred.BackgroundLoader(deferred.get_pending_images(), self.workers, self._cache.pixel_cache, self.low_memory, self.backend, self.timing_file).start()
+        else:
+            instrument.end(self.timing_file)
+        return {'FINISHED'}
+
+
+class SourceModelsMtlImporter(bpy.types.Operator, BatchImport):
     """Import materials for Source Engine models imported in the scene"""
     bl_idname = "import_scene.sourcemodelsmtl"
     bl_label = "Import materials for Source Models"
@@ -106,16 +271,13 @@ class SourceModelsMtlImporter(bpy.types.Operator):
     prefer_v: bpy.props.BoolProperty(name="Prefer higher quality weapons", description="Prefer higher quality materials in v_models folder over materials in w_models folder (CSGO)", default=True)
 
     def execute(self, context):
-        models = ModelsMtl(Path(self.directory), self.textext, Path(self.texturepath) if self.texturepath else None)
-        models.replace_materials(self.only_empty, self.skip_crafty, self.prefer_v)
-        return {'FINISHED'}
-
-    def invoke(self, context, event):
-        context.window_manager.fileselect_add(self)
-        return {'RUNNING_MODAL'}
+        deferred.begin(instrument.LEVELS[self.log_level])
+        cache = get_cache(self.share_textures, get_pixel_cache(self.cache_directory, self.cache_size), self.low_memory, self.backend, self.max_size, self.deferred != 'NONE', self.bake_channels, self.merge_identical, self.memory_budget)
+        models = ModelsMtl(Path(self.directory), self.textext, Path(self.texturepath) if self.texturepath else None, self.workers, cache, Path(self.cache_directory) if self.cache_directory else None)
+        return self.run_batch(context, models.iter_replace_materials(self.only_empty, self.skip_crafty, self.prefer_v, self.node_groups, self.deduplicate, self.skip_unchanged), cache)
 
 
-class CraftyMtlImporter(bpy.types.Operator):
+class CraftyMtlImporter(bpy.types.Operator, BatchImport):
     """Import Crafty-exported MTL to replace the materials with properly imported ones"""
     bl_idname = "import_scene.craftymtl"
     bl_label = "Replace imported Crafty materials"
@@ -139,13 +301,36 @@ class CraftyMtlImporter(bpy.types.Operator):
         if not self.texturepath:
             self.report({'INFO'}, 'Texture path was not specified')
             return {'CANCELLED'}
+        deferred.begin(instrument.LEVELS[self.log_level])
         crafty = CraftyMtl(Path(self.filepath))
-        crafty.replace_materials(Path(self.texturepath), self.textext, self.materialsuffix, self.rename)
+        cache = get_cache(self.share_textures, get_pixel_cache(self.cache_directory, self.cache_size), self.low_memory, self.backend, self.max_size, self.deferred != 'NONE', self.bake_channels, self.merge_identical, self.memory_budget)
+        return self.run_batch(context, crafty.iter_replace_materials(Path(self.texturepath), self.textext, self.materialsuffix, self.rename, self.workers, cache, Path(self.cache_directory) if self.cache_directory else None, self.node_groups, self.deduplicate, self.skip_unchanged), cache)
+
+
+class DeferredTexturesLoader(bpy.types.Operator, ParallelDecoding):
+    """Load the textures of materials imported with deferred texture loading"""
+    bl_idname = "import_scene.deferredvtf"
+    bl_label = "Load deferred Source textures"
+    bl_options = {'UNDO'}
+
+    only_visible: bpy.props.BoolProperty(name="Only visible objects", description="Only load textures used by materials of visible objects", default=True)
+
+    def execute(self, context):
+        images = deferred.get_pending_images(context.visible_objects if self.only_visible else None)
+        if not images:
+            self.report({'INFO'}, 'No textures to load')
+            return {'CANCELLED'}
+        deferred.begin(instrument.LEVELS[self.log_level])
+        deferred.load_images(images, self.workers, backend=self.backend)
+        instrument.end(self.timing_file)
         return {'FINISHED'}
 
-    def invoke(self, context, event):
-        context.window_manager.fileselect_add(self)
-        return {'RUNNING_MODAL'}
+
+@bpy.app.handlers.persistent
+def load_pre(*args):
+    """Forget the state of the file that was open when another one is loaded"""
+    deferred.cancel_loaders()
+    session_cache.clear()
 
 
 def register():
@@ -153,7 +338,9 @@ def register():
     bpy.utils.register_class(VtfImporter)
     bpy.utils.register_class(SourceModelsMtlImporter)
     bpy.utils.register_class(CraftyMtlImporter)
+    bpy.utils.register_class(DeferredTexturesLoader)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.app.handlers.load_pre.append(load_pre)
 
 
 def unregister():
@@ -161,7 +348,11 @@ def unregister():
     bpy.utils.unregister_class(VtfImporter)
     bpy.utils.unregister_class(SourceModelsMtlImporter)
     bpy.utils.unregister_class(CraftyMtlImporter)
+    bpy.utils.unregister_class(DeferredTexturesLoader)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    bpy.app.handlers.load_pre.remove(load_pre)
+    deferred.cancel_loaders()
+    vpk.unmount_all()
 
 if __name__ == "__main__":
     register()
@@ -0,0 +1,67 @@
+# Derived single channel textures computed once at import, instead of separating channels and doing math in the shader
+
+import bpy
+from typing import Optional
+
+import numpy as np
+from . import instrument
+from . import vtf
+
+# Source phong exponent to Blender roughness, (1 - x) * 0.5, see VMT.make_material
+TRANSFORM_ROUGHNESS = "roughness"
+
+_CHANNELS = {"r": 0, "g": 1, "b": 2}
+
+
+def get_transform(name: str) -> Optional[str]:
+    return TRANSFORM_ROUGHNESS if name == "roughness" else None
+
+
+def get_texture_name(texture: str, channel: str, transform: Optional[str]) -> str:
+    # Identifies the derived texture within a material
+    if transform:
+        return "{}_{}_{}".format(texture, channel, transform)
+    return "{}_{}".format(texture, channel)
+
+
+def get_key(key: str, channel: str, transform: Optional[str]) -> str:
+    return "{}|{}|{}".format(key, channel, transform or "")
+
+
+def compute(pixels: np.ndarray, channel: str, transform: Optional[str]=None) -> np.ndarray:
+    """Extract a channel of flat RGBA pixels, 8 bit or float, to flat grayscale RGBA floats"""
+    values = pixels.reshape(-1, 4)[:, _CHANNELS[channel]]
+    if values.dtype == np.uint8:
+        values = values * np.float32(1 / 255)
+    else:
+        values = values.astype(np.float32)
+    if transform == TRANSFORM_ROUGHNESS:
+        np.subtract(1, values, out=values)
+        values *= np.float32(0.5)
+    out = np.empty((values.shape[0], 4), np.float32)
+    out[:, :3] = values[:, None]
+    out[:, 3] = 1
+    return out.reshape(-1)
+
+
+def bake_image(name: str, width: int, height: int, pixels: np.ndarray, channel: str, transform: Optional[str]=None) -> bpy.types.Image:
+    with instrument.span("bake", name):
+        values = compute(pixels, channel, transform)
+    image = bpy.data.images.new(name, width=width, height=height, alpha=False)
+    with instrument.span("upload"):
+        vtf.set_pixels(image, values)
+    image.colorspace_settings.name = "Non-Color"
+    image.file_format = "PNG"
+    with instrument.span("pack"):
+        image.pack()
+    return image
+
+
+def read_pixels(image: bpy.types.Image) -> np.ndarray:
+    # Pixels of an image loaded by Blender, for baking from converted textures
+    pixels = np.empty(image.size[0] * image.size[1] * 4, np.float32)
+    if hasattr(image.pixels, "foreach_get"):
+        image.pixels.foreach_get(pixels)
+    else:
+        pixels[:] = image.pixels[:]
+    return pixels
@@ -0,0 +1,105 @@
+# Synthetic game directory for the benchmarks: VMT files with varied parameters sharing VTF textures
+
+import random
+import struct
+from pathlib import Path
+from typing import List, NamedTuple
+
+import numpy as np
+
+from vtfnumpy import FLAG_EIGHTBITALPHA, FORMAT_BGR888, FORMAT_BGRA8888, FORMAT_DXT1, FORMAT_DXT5, get_image_size
+
+_HEADER = struct.Struct("<4s2IIHHIHH4x3f4xfiBiBB")
+HEADER_SIZE = 80
+
+# Formats and sizes of the generated textures, cycled through
+TEXTURE_KINDS = [
+    (FORMAT_DXT1, 1024, False),
+    (FORMAT_DXT5, 1024, True),
+    (FORMAT_DXT1, 512, False),
+    (FORMAT_DXT5, 512, True),
+    (FORMAT_BGRA8888, 256, True),
+    (FORMAT_BGR888, 256, False),
+]
+
+
+class Corpus(NamedTuple):
+    root: Path
+    vmts: List[Path]
+    vtfs: List[Path]
+    mtl: Path
+    material_names: List[str]
+
+
+def write_vtf(path: Path, image_format: int, size: int, alpha: bool, rng: np.random.Generator):
+    # Version 7.2 with a full mipmap chain and no low resolution image
+    mipmap_count = size.bit_length()
+    flags = FLAG_EIGHTBITALPHA if alpha else 0
+    header = _HEADER.pack(b"VTF\0", 7, 2, HEADER_SIZE, size, size, flags, 1, 0,
+                          0.5, 0.5, 0.5, 1.0, image_format, mipmap_count, -1, 0, 0)
+    header += struct.pack("<H", 1)
+    header = header.ljust(HEADER_SIZE, b"\0")
+    data_size = sum(get_image_size(image_format, max(1, size >> level), max(1, size >> level)) for level in range(mipmap_count))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), "wb") as f:
+        f.write(header)
+        f.write(rng.integers(0, 256, data_size, np.uint8).tobytes())
+
+
+def _write_vmt(path: Path, shader: str, parameters: dict):
+    lines = ['"{}"'.format(shader), "{"]
+    lines.extend('\t"{}" "{}"'.format(key, value) for key, value in parameters.items())
+    lines.append("}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n".join(lines) + "\n")
+
+
+def _material_parameters(i: int, textures: List[str], rnd: random.Random) -> dict:
+    parameters = {"$basetexture": rnd.choice(textures)}
+    if i % 3 == 0:
+        parameters["$bumpmap"] = rnd.choice(textures)
+    if i % 4 == 0:
+        parameters["$phong"] = "1"
+        parameters["$phongexponent"] = str(rnd.randrange(1, 255))
+    if i % 5 == 0:
+        parameters["$phongexponenttexture"] = rnd.choice(textures)
+        parameters["$phongalbedotint"] = "1"
+    if i % 6 == 0:
+        parameters["$translucent"] = "1"
+    elif i % 7 == 0:
+        parameters["$alphatest"] = "1"
+    if i % 8 == 0:
+        parameters["$envmap"] = "env_cubemap"
+        parameters["$envmapmask"] = rnd.choice(textures)
+    if i % 9 == 0:
+        parameters["$selfillum"] = "1"
+    return parameters
+
+
+def generate(root: Path, materials: int=200, textures: int=60, seed: int=0) -> Corpus:
+    root = Path(root)
+    rnd = random.Random(seed)
+    rng = np.random.default_rng(seed)
+    vtfs = []
+    texture_names = []
+    for i in range(textures):
+        image_format, size, alpha = TEXTURE_KINDS[i % len(TEXTURE_KINDS)]
+        name = "models/bench/textures/tex{:03}".format(i)
+        path = root / "materials" / (name + ".vtf")
+        write_vtf(path, image_format, size, alpha, rng)
+        vtfs.append(path)
+        texture_names.append(name)
+    vmts = []
+    material_names = []
+    mtl = []
+    for i in range(materials):
+        name = "mat{:04}".format(i)
+        relpath = "models/bench/{}/{}".format("v_models" if i % 2 else "w_models", name)
+        path = root / "materials" / (relpath + ".vmt")
+        _write_vmt(path, "VertexLitGeneric", _material_parameters(i, texture_names, rnd))
+        vmts.append(path)
+        material_names.append(name)
+        mtl.append("# {}\nnewmtl material_{}".format(relpath, i))
+    mtl_path = root / "bench.mtl"
+    mtl_path.write_text("\n\n".join(mtl) + "\n")
+    return Corpus(root, vmts, vtfs, mtl_path, material_names)
@@ -0,0 +1,342 @@
+# Minimal in-process stand-in for bpy, enough to run the import pipeline outside Blender.
+# It records what gets created instead of doing anything with it.
+
+import sys
+import types
+from collections import Counter
+
+
+# Number of created nodes, links, images etc.
+stats = Counter()
+
+
+class IDProperties:
+    def __init__(self):
+        self._properties = dict()
+
+    def __getitem__(self, key):
+        return self._properties[key]
+
+    def __setitem__(self, key, value):
+        self._properties[key] = value
+
+    def __delitem__(self, key):
+        del self._properties[key]
+
+    def __contains__(self, key):
+        return key in self._properties
+
+    def get(self, key, default=None):
+        return self._properties.get(key, default)
+
+
+class ID(IDProperties):
+    def __init__(self, collection, name):
+        super().__init__()
+        self._collection = collection
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._collection._rename(self, value)
+
+    def user_remap(self, new_id):
+        stats["user_remap"] += 1
+
+
+class IDCollection:
+    def __init__(self, factory):
+        self._factory = factory
+        self._items = dict()
+
+    def _unique_name(self, name):
+        if name not in self._items:
+            return name
+        i = 1
+        while "{}.{:03}".format(name, i) in self._items:
+            i += 1
+        return "{}.{:03}".format(name, i)
+
+    def _rename(self, item, name):
+        del self._items[item._name]
+        item._name = self._unique_name(name)
+        self._items[item._name] = item
+
+    def new(self, name, *args, **kwargs):
+        item = self._factory(self, self._unique_name(name), *args, **kwargs)
+        self._items[item.name] = item
+        stats[type(item).__name__ + " created"] += 1
+        return item
+
+    def remove(self, item):
+        del self._items[item.name]
+
+    def get(self, name, default=None):
+        return self._items.get(name, default)
+
+    def __getitem__(self, name):
+        return self._items[name]
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __iter__(self):
+        return iter(list(self._items.values()))
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+
+
+class Pixels:
+    def __init__(self, image):
+        self._image = image
+
+    def __len__(self):
+        return self._image.size[0] * self._image.size[1] * 4
+
+    def foreach_set(self, values):
+        if len(values) != len(self):
+            raise ValueError("Pixel count mismatch")
+        stats["pixel bytes uploaded"] += len(values) * 4
+
+
+class ColorspaceSettings:
+    name = "sRGB"
+
+
+class Image(ID):
+    def __init__(self, collection, name, width=1, height=1, alpha=False, filepath=""):
+        super().__init__(collection, name)
+        self.size = [width, height]
+        self.alpha = alpha
+        self.filepath = filepath
+        self.file_format = "PNG"
+        self.alpha_mode = "STRAIGHT"
+        self.colorspace_settings = ColorspaceSettings()
+        self.packed = False
+
+    @property
+    def pixels(self):
+        return Pixels(self)
+
+    @pixels.setter
+    def pixels(self, values):
+        Pixels(self).foreach_set(values)
+
+    def scale(self, width, height):
+        self.size = [width, height]
+
+    def pack(self):
+        self.packed = True
+        stats["images packed"] += 1
+
+    @property
+    def packed_file(self):
+        return self if self.packed else None
+
+    def buffers_free(self):
+        stats["image buffers freed"] += 1
+
+    def update(self):
+        pass
+
+
+class ImageCollection(IDCollection):
+    def __init__(self):
+        super().__init__(Image)
+
+    def new(self, name, width, height, alpha=False, **kwargs):
+        return super().new(name, width, height, alpha)
+
+    def load(self, filepath, check_existing=False):
+        if check_existing:
+            for image in self:
+                if image.filepath == filepath:
+                    return image
+        name = filepath.replace("\\", "/").rsplit("/", 1)[-1]
+        return super().new(name, 1, 1, False, filepath)
+
+
+class Socket:
+    def __init__(self, node, name):
+        self.node = node
+        self.name = name
+        self.default_value = 0.0
+        self.is_linked = False
+
+
+class Sockets:
+    # Sockets are created when first accessed, any name is valid
+    def __init__(self, node):
+        self._node = node
+        self._sockets = dict()
+
+    def __getitem__(self, key):
+        if key not in self._sockets:
+            self._sockets[key] = Socket(self._node, key)
+        return self._sockets[key]
+
+    def __contains__(self, key):
+        return key in self._sockets
+
+    def new(self, socket_type, name):
+        return self[name]
+
+
+class Node:
+    _types = {
+        'ShaderNodeTexImage': 'TEX_IMAGE',
+        'ShaderNodeBsdfPrincipled': 'BSDF_PRINCIPLED',
+        'ShaderNodeOutputMaterial': 'OUTPUT_MATERIAL',
+        'ShaderNodeGroup': 'GROUP',
+    }
+
+    def __init__(self, bl_idname, name):
+        self.bl_idname = bl_idname
+        self.type = self._types.get(bl_idname, bl_idname)
+        self.name = name
+        self.location = (0, 0)
+        self.inputs = Sockets(self)
+        self.outputs = Sockets(self)
+        self.image = None
+        self.node_tree = None
+        self.operation = None
+
+
+class Nodes:
+    _default_names = {
+        'ShaderNodeBsdfPrincipled': 'Principled BSDF',
+        'ShaderNodeOutputMaterial': 'Material Output',
+    }
+
+    def __init__(self):
+        self._nodes = []
+
+    def new(self, bl_idname):
+        node = Node(bl_idname, self._default_names.get(bl_idname, bl_idname))
+        self._nodes.append(node)
+        stats["nodes created"] += 1
+        return node
+
+    def get(self, name, default=None):
+        for node in self._nodes:
+            if node.name == name:
+                return node
+        return default
+
+    def remove(self, node):
+        self._nodes.remove(node)
+
+    def clear(self):
+        self._nodes.clear()
+
+    def __iter__(self):
+        return iter(list(self._nodes))
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class Links:
+    def new(self, output, input):
+        input.is_linked = True
+        stats["links created"] += 1
+
+
+class NodeTree(ID):
+    def __init__(self, collection, name, tree_type='ShaderNodeTree'):
+        super().__init__(collection, name)
+        self.nodes = Nodes()
+        self.links = Links()
+        self.inputs = Sockets(self)
+        self.outputs = Sockets(self)
+
+
+class Material(ID):
+    def __init__(self, collection, name):
+        super().__init__(collection, name)
+        self._use_nodes = False
+        self.node_tree = None
+        self.blend_method = "OPAQUE"
+        self.shadow_method = "OPAQUE"
+
+    @property
+    def use_nodes(self):
+        return self._use_nodes
+
+    @use_nodes.setter
+    def use_nodes(self, value):
+        if value and self.node_tree is None:
+            # Blender creates these for new node materials
+            self.node_tree = NodeTree(None, self.name)
+            self.node_tree.nodes.new('ShaderNodeOutputMaterial')
+            self.node_tree.nodes.new('ShaderNodeBsdfPrincipled')
+        self._use_nodes = value
+
+
+class Data:
+    def __init__(self):
+        self.images = ImageCollection()
+        self.materials = IDCollection(Material)
+        self.node_groups = IDCollection(NodeTree)
+        self.objects = IDCollection(ID)
+
+
+class Timers:
+    # Functions are only recorded, never called. Blender compares them by identity.
+    def __init__(self):
+        self._functions = []
+
+    def register(self, function, first_interval=0):
+        self._functions.append(function)
+        stats["timers registered"] += 1
+
+    def is_registered(self, function):
+        return any(f is function for f in self._functions)
+
+    def unregister(self, function):
+        if not self.is_registered(function):
+            raise ValueError("Timer not registered")
+        self._functions = [f for f in self._functions if f is not function]
+
+
+class Operator:
+    def report(self, type, message):
+        print(message)
+
+
+def _property(*args, **kwargs):
+    return None
+
+
+def install() -> types.ModuleType:
+    """Put the stand-in into sys.modules as bpy, with empty data"""
+    bpy = types.ModuleType("bpy")
+    bpy.data = Data()
+    bpy.app = types.SimpleNamespace(timers=Timers(), handlers=types.SimpleNamespace(load_pre=[], persistent=lambda function: function))
+    bpy.props = types.SimpleNamespace(**{name: _property for name in (
+        "StringProperty", "BoolProperty", "IntProperty", "FloatProperty", "EnumProperty")})
+    bpy.types = types.SimpleNamespace(
+        Operator=Operator, Image=Image, Material=Material, Object=ID, ShaderNodeTree=NodeTree,
+        TOPBAR_MT_file_import=types.SimpleNamespace(append=_property, remove=_property))
+    bpy.utils = types.SimpleNamespace(register_class=_property, unregister_class=_property)
+    sys.modules["bpy"] = bpy
+    stats.clear()
+    return bpy
+
+
+def reset():
+    """Remove all data created so far"""
+    bpy = sys.modules["bpy"]
+    bpy.data.images.clear()
+    bpy.data.materials.clear()
+    bpy.data.node_groups.clear()
+    bpy.app.timers = Timers()
+    stats.clear()
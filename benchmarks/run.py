@@ -0,0 +1,178 @@
+# Headless benchmarks of the import pipeline, using a bpy stand-in and a synthetic game directory
+# Usage: python benchmarks/run.py [--materials N] [--textures N] [--repeat N] [--json FILE]
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(1, str(ROOT))
+
+import fakebpy
+import corpus
+
+PACKAGE = "blender_vmt"
+
+
+def load_addon():
+    """Import the addon as a package with the bpy stand-in in place"""
+    fakebpy.install()
+    spec = importlib.util.spec_from_file_location(PACKAGE, str(ROOT / "__init__.py"), submodule_search_locations=[str(ROOT)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Benchmarks:
+    def __init__(self, data: corpus.Corpus, repeat: int, workers: int):
+        self.data = data
+        self.repeat = repeat
+        self.workers = workers
+        self.results = []
+        self.addon = sys.modules[PACKAGE]
+
+    def measure(self, name: str, items: int, function, setup=None):
+        instrument = self.addon.instrument
+        times = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            fakebpy.reset()
+            instrument.begin(instrument.LEVEL_ERRORS)
+            # The pipeline logs every step, which would drown the report
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                function()
+                times.append(time.perf_counter() - start)
+        result = {
+            "name": name,
+            "items": items,
+            "best": min(times),
+            "median": statistics.median(times),
+            "created": dict(fakebpy.stats),
+            # Of the last run
+            "stages": instrument.recorder.to_dict()["stages"],
+        }
+        self.results.append(result)
+        print("{:<40} {:>9.3f} s {:>9.3f} s {:>10.1f}/s  {}".format(
+            name, result["best"], result["median"], items / result["best"] if result["best"] else 0,
+            ", ".join("{} {}".format(value, key) for key, value in sorted(result["created"].items()))))
+
+    def parsing(self):
+        keyvalues = self.addon.keyvalues
+        paths = self.data.vmts
+        self.measure("parse vmt, serial", len(paths), lambda: keyvalues.parse_files(paths, 1), keyvalues._parsed.clear)
+        self.measure("parse vmt, threads", len(paths), lambda: keyvalues.parse_files(paths, self.workers), keyvalues._parsed.clear)
+        self.measure("parse vmt, cached", len(paths), lambda: keyvalues.parse_files(paths, 1))
+
+    def _decode(self, backend: str, workers: int, max_size: int=0):
+        for path, result in self.addon.decode.decode_vtfs(self.data.vtfs, workers, 0, backend, max_size):
+            if isinstance(result, Exception):
+                raise result
+
+    def decoding(self):
+        decode = self.addon.decode
+        count = len(self.data.vtfs)
+        self.measure("decode vtf, numpy serial", count, lambda: self._decode(decode.BACKEND_NUMPY, 1))
+        self.measure("decode vtf, numpy threads", count, lambda: self._decode(decode.BACKEND_NUMPY, self.workers))
+        self.measure("decode vtf, numpy max size 256", count, lambda: self._decode(decode.BACKEND_NUMPY, self.workers, 256))
+        if decode.VTFLib is not None:
+            self.measure("decode vtf, vtflib serial", count, lambda: self._decode(decode.BACKEND_VTFLIB, 1))
+            self.measure("decode vtf, vtflib processes", count, lambda: self._decode(decode.BACKEND_VTFLIB, self.workers))
+        else:
+            print("VTFLib is not available, skipping its benchmarks")
+
+    def upload(self):
+        decode = self.addon.decode
+        vtf = self.addon.vtf
+        decoded = [decode.decode_vtf(path, decode.BACKEND_NUMPY) for path in self.data.vtfs]
+        pixels = sum(image.width * image.height for image in decoded)
+
+        def upload(low_memory):
+            for i, image in enumerate(decoded):
+                vtf.load_image("upload{}".format(i), image, low_memory)
+
+        self.measure("upload pixels (Mpx)", pixels // 1000000, lambda: upload(False))
+        self.measure("upload pixels, low memory (Mpx)", pixels // 1000000, lambda: upload(True))
+
+    def _make_materials(self, node_groups: bool):
+        addon = self.addon
+        # Placeholders keep texture decoding out of the measurement
+        cache = addon.cache.get_cache(False, deferred=True)
+        index = addon.content.get_index(self.data.root)
+        for path in self.data.vmts:
+            addon.vmt.VMT(path, ".vtf", self.data.root, cache, index).make_material(path.stem, True, node_groups)
+
+    def node_graphs(self):
+        count = len(self.data.vmts)
+        self.measure("build materials", count, lambda: self._make_materials(False))
+        self.measure("build materials, node groups", count, lambda: self._make_materials(True))
+
+    def _add_empty_materials(self):
+        for name in self.data.material_names:
+            sys.modules["bpy"].data.materials.new(name)
+
+    def _models(self, backend: str, node_groups: bool=False, deduplicate: bool=False, bake: bool=False):
+        addon = self.addon
+        self._add_empty_materials()
+        cache = addon.cache.get_cache(False, backend=backend, bake=bake)
+        mtl = addon.models.ModelsMtl(self.data.root, ".vtf", workers=self.workers, cache=cache)
+        mtl.replace_materials(node_groups=node_groups, deduplicate=deduplicate)
+
+    def _crafty(self, backend: str):
+        addon = self.addon
+        cache = addon.cache.get_cache(False, backend=backend)
+        addon.crafty.CraftyMtl(self.data.mtl).replace_materials(self.data.root, ".vtf", workers=self.workers, cache=cache)
+
+    def end_to_end(self):
+        numpy = self.addon.decode.BACKEND_NUMPY
+        count = len(self.data.vmts)
+        self.measure("models mtl, numpy", count, lambda: self._models(numpy), self.addon.keyvalues._parsed.clear)
+        self.measure("models mtl, numpy, groups, dedup", count, lambda: self._models(numpy, True, True), self.addon.keyvalues._parsed.clear)
+        self.measure("models mtl, numpy, baked channels", count, lambda: self._models(numpy, bake=True), self.addon.keyvalues._parsed.clear)
+        self.measure("crafty mtl, numpy", count, lambda: self._crafty(numpy), self.addon.keyvalues._parsed.clear)
+
+
+SUITES = ["parsing", "decoding", "upload", "node_graphs", "end_to_end"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VMT import pipeline without Blender")
+    parser.add_argument("--materials", type=int, default=200, help="number of generated VMT files")
+    parser.add_argument("--textures", type=int, default=60, help="number of generated VTF files")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best and median are reported")
+    parser.add_argument("--workers", type=int, default=0, help="worker threads or processes, 0 uses all cores")
+    parser.add_argument("--directory", help="where to generate the files, a temporary directory by default")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("suites", nargs="*", help="benchmarks to run, all by default: {}".format(", ".join(SUITES)))
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error("unknown benchmark {}".format(suite))
+
+    load_addon()
+    with contextlib.ExitStack() as stack:
+        directory = args.directory or stack.enter_context(tempfile.TemporaryDirectory(prefix="vmt-bench-"))
+        print("Generating {} materials and {} textures in {}".format(args.materials, args.textures, directory))
+        data = corpus.generate(Path(directory), args.materials, args.textures)
+        benchmarks = Benchmarks(data, args.repeat, args.workers)
+        print("{:<40} {:>11} {:>11} {:>12}".format("benchmark", "best", "median", "rate"))
+        for suite in args.suites or SUITES:
+            getattr(benchmarks, suite)()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"materials": args.materials, "textures": args.textures, "repeat": args.repeat,
+                       "workers": args.workers, "results": benchmarks.results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
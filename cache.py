@@ -0,0 +1,322 @@
+import bpy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from . import bake
+from . import content
+from . import decode
+from . import vtf
+from . import deferred
+from . import instrument
+from .diskcache import PixelCache
+from .memory import MB, MemoryBudget
+from .decode import BACKEND_VTFLIB
+
+# Custom property storing the cache key on imported images,
+# so they can be found again after undo or reopening the .blend file
+KEY_PROPERTY = "vmt_key"
+
+
+class TextureCache:
+    """Images shared between materials, keyed by the texture path and a version of its contents, see content.get_identity"""
+
+    def __init__(self):
+        self.images = dict()  # key -> image name, ID references don't survive undo
+        self.hits = 0
+        self.misses = 0
+        self._prefetched = set()
+        self.failed = set()  # keys (or paths of missing files) that failed to import, left out of materials
+        self.pixel_cache = None  # optional persistent cache of decoded textures
+        self.low_memory = False
+        self.backend = BACKEND_VTFLIB
+        self.max_size = 0  # 0 imports the full size
+        self.deferred = False  # create placeholders that are filled in later
+        self.bake = False  # bake derived single channel textures instead of computing them in the shader
+        self.merge_identical = False  # key textures by a hash of their contents instead of their path
+        self.budget = MemoryBudget(0)  # decoded textures and image buffers, tracked for the peak usage even without a limit
+
+    def clear(self):
+        # The images and their buffers belong to the .blend file that was open
+        self.images.clear()
+        self._prefetched.clear()
+        self.failed.clear()
+        self.budget = MemoryBudget(0)
+
+    def get_key(self, path: Path) -> Optional[str]:
+        if self.merge_identical:
+            # Identical files with different paths share an image
+            digest = content.get_content_hash(path)
+            key = "blake2b|" + digest if digest is not None else None
+        else:
+            key = content.get_identity(path)
+        if key is None:
+            return None
+        if self.max_size > 0:
+            # Size limited textures are different images
+            key += "|{}".format(self.max_size)
+        return key
+
+    def begin(self):
+        # Index images imported earlier, possibly in another session
+        self.hits = 0
+        self.misses = 0
+        self.failed.clear()
+        for image in bpy.data.images:
+            key = image.get(KEY_PROPERTY)
+            if key:
+                self.images[key] = image.name
+
+    def _get(self, key: str) -> Optional[bpy.types.Image]:
+        name = self.images.get(key)
+        if name is None:
+            return None
+        image = bpy.data.images.get(name)
+        if image is None or image.get(KEY_PROPERTY) != key:
+            # Removed or renamed since
+            del self.images[key]
+            self.budget.remove(key)
+            return None
+        return image
+
+    def add(self, key: Optional[str], image: bpy.types.Image):
+        if key is None:
+            return
+        image[KEY_PROPERTY] = key
+        self.images[key] = image.name
+        if image.packed_file is not None:
+            # The pixels of packed images can be loaded again, so they are freed first when over the memory budget
+            self.budget.add(key, image.size[0] * image.size[1] * 4, partial(vtf.free_buffers, image.name))
+
+    def _miss(self):
+        self.misses += 1
+        instrument.count("texture cache misses")
+
+    def _hit(self, key: str):
+        self.budget.touch(key)
+        if key in self._prefetched:
+            # First use of a texture decoded in advance
+            self._prefetched.discard(key)
+            self._miss()
+        else:
+            self.hits += 1
+            instrument.count("texture cache hits")
+
+    def _fail(self, key: Optional[str], path: Path, error: Exception=None):
+        self.failed.add(key or str(path))
+        if error is not None:
+            instrument.log("VMT: Failed to import texture {}: {}".format(path, error), instrument.LEVEL_ERRORS)
+
+    def _is_failed(self, key: Optional[str], path: Path) -> bool:
+        if (key or str(path)) not in self.failed:
+            return False
+        instrument.log("VMT: Leaving out texture {}, it failed to import".format(path), instrument.LEVEL_ERRORS)
+        return True
+
+    def load(self, path: Path, convert: bool) -> Optional[bpy.types.Image]:
+        """Image of a texture, None if it can't be imported"""
+        key = self.get_key(path)
+        if self._is_failed(key, path):
+            return None
+        image = self._get(key) if key else None
+        if image is not None:
+            if convert and not self.deferred and deferred.is_pending(image):
+                # Placeholder from an earlier deferred import
+                deferred.load_images([image], 1, self.pixel_cache, self.low_memory, self.backend)
+            self._hit(key)
+            return image
+        self._miss()
+        instrument.log("VMT: Loading texture {}".format(path))
+        try:
+            if convert and self.deferred:
+                image = deferred.make_placeholder(path, self.max_size)
+            elif convert:
+                image = vtf.import_image(path, self.pixel_cache, self.low_memory, self.backend, self.max_size)
+            else:
+                image = bpy.data.images.load(str(path), check_existing=True)
+        except Exception as e:
+            # The material is built without it instead of failing the whole import
+            self._fail(key, path, e)
+            return None
+        self.add(key, image)
+        return image
+
+    def _bake(self, path: Path, width: int, height: int, pixels: np.ndarray, channel: str, transform: Optional[str], key: Optional[str]) -> bpy.types.Image:
+        name = "{}_{}".format(path.stem, transform or channel)
+        image = bake.bake_image(name, width, height, pixels, channel, transform)
+        self.add(key, image)
+        return image
+
+    def load_derived(self, path: Path, convert: bool, channel: str, transform: Optional[str]=None) -> Optional[bpy.types.Image]:
+        """Load a single channel of a texture as its own image, optionally transformed. None if it can't be imported."""
+        key = self.get_key(path)
+        key = bake.get_key(key, channel, transform) if key else None
+        if self._is_failed(key, path):
+            return None
+        image = self._get(key) if key else None
+        if image is not None:
+            self._hit(key)
+            return image
+        self._miss()
+        instrument.log("VMT: Baking {} channel of texture {}".format(transform or channel, path))
+        try:
+            if convert:
+                path, decoded = next(vtf.decode_images([path], 1, self.pixel_cache, self.low_memory, self.backend, self.max_size))
+                if isinstance(decoded, Exception):
+                    raise decoded
+                return self._bake(path, decoded.width, decoded.height, decoded.pixels, channel, transform, key)
+            source = bpy.data.images.load(str(path), check_existing=True)
+            return self._bake(path, source.size[0], source.size[1], bake.read_pixels(source), channel, transform, key)
+        except Exception as e:
+            self._fail(key, path, e)
+            return None
+
+    def prefetch(self, paths: Iterable[Path], workers: int=0, derived: Iterable[Tuple[Path, str, Optional[str]]]=()):
+        for _ in self.iter_prefetch(paths, workers, derived):
+            pass
+
+    def iter_prefetch(self, paths: Iterable[Path], workers: int=0, derived: Iterable[Tuple[Path, str, Optional[str]]]=()) -> Iterator[Tuple[int, int]]:
+        """Decode the missing VTF textures in parallel, so later loads only need a lookup.
+        Derived textures are given as (path, channel, transform), each source is decoded once for all of them.
+        Yields the number of imported and missing textures after every texture."""
+        plan = self.plan_prefetch(paths, workers, derived)
+        for done, total, _ in self.iter_run_prefetch(plan, workers):
+            yield done, total
+
+    def plan_prefetch(self, paths: Iterable[Path], workers: int=0, derived: Iterable[Tuple[Path, str, Optional[str]]]=()) -> "PrefetchPlan":
+        """Find the textures that need to be imported, without decoding anything"""
+        paths = set(paths)
+        derived = set(derived)
+        plan = PrefetchPlan()
+        if self.merge_identical:
+            # The keys are content hashes, computed in parallel first
+            content.hash_files(paths | set(item[0] for item in derived), workers)
+        if self.deferred:
+            return plan
+        keys = set()
+        for path in paths:
+            key = self.get_key(path)
+            if key and key in keys:
+                instrument.count("identical textures merged")
+            if key and key not in keys and self._is_missing(key):
+                plan.missing[path] = key
+                keys.add(key)
+        for path, channel, transform in derived:
+            key = self.get_key(path)
+            key = bake.get_key(key, channel, transform) if key else None
+            if key and key not in keys and self._get(key) is None:
+                plan.derived.setdefault(path, []).append((channel, transform, key))
+                keys.add(key)
+        # Only the headers are read, in threads since there can be thousands of them
+        to_import = list(set(plan.missing) | set(plan.derived))
+        with ThreadPoolExecutor(content.IO_THREADS) as pool:
+            for path, file_size, decoded_size in pool.map(self._get_sizes, to_import):
+                plan.file_sizes[path] = file_size
+                plan.decoded_sizes[path] = decoded_size
+        if self.pixel_cache:
+            plan.cached.update(path for path in to_import if self.pixel_cache.contains(path, self.max_size))
+        return plan
+
+    def _is_missing(self, key: str) -> bool:
+        # Placeholders from an earlier deferred import are decoded with the missing textures
+        image = self._get(key)
+        return image is None or deferred.is_pending(image)
+
+    def _get_sizes(self, path: Path) -> Tuple[Path, int, int]:
+        return path, content.get_size(path), decode.get_decoded_size(path, self.max_size)
+
+    def iter_run_prefetch(self, plan: "PrefetchPlan", workers: int=0, read_ahead: int=0) -> Iterator[Tuple[int, int, List[str]]]:
+        """Import the textures of a plan, largest first so the long decodes don't end up last.
+        Files are read ahead in that many I/O threads if given.
+        Yields the number of imported and missing textures and the keys imported after every texture."""
+        total = plan.total
+        if not total:
+            return
+        instrument.log("VMT: Decoding {} textures".format(total))
+        # A source used both directly and for baked channels is decoded once for all of them
+        sources = plan.get_order(set(plan.missing) | set(plan.derived))
+        reader = None
+        if read_ahead > 0:
+            reader = content.ReadAhead([path for path in sources if path not in plan.cached], read_ahead)
+        done = 0
+        try:
+            for path, decoded in vtf.decode_images(sources, workers, self.pixel_cache, self.low_memory, self.backend, self.max_size, self.budget):
+                if reader is not None and path not in plan.cached:
+                    reader.take(path)
+                key = plan.missing.get(path)
+                derived = plan.derived.get(path, [])
+                keys = ([key] if key else []) + [derived_key for _, _, derived_key in derived]
+                if isinstance(decoded, Exception):
+                    instrument.log("VTF: Failed to decode {}: {}".format(path, decoded), instrument.LEVEL_ERRORS)
+                    # Materials are built without them
+                    for failed_key in keys:
+                        self._fail(failed_key, path)
+                else:
+                    if key:
+                        image = self._get(key)
+                        if image is not None:
+                            deferred.fill(image, decoded, self.low_memory, self.budget)
+                        else:
+                            image = vtf.load_image(path.stem, decoded, self.low_memory, self.budget)
+                        self.add(key, image)
+                        self._prefetched.add(key)
+                    for channel, transform, derived_key in derived:
+                        self._bake(path, decoded.width, decoded.height, decoded.pixels, channel, transform, derived_key)
+                        self._prefetched.add(derived_key)
+                del decoded
+                done += 1
+                yield done, total, keys
+        finally:
+            if reader is not None:
+                reader.close()
+
+
+class PrefetchPlan:
+    """Textures a prefetch will import, with their sizes for ordering and reporting"""
+
+    def __init__(self):
+        self.missing = dict()  # type: Dict[Path, str]  # texture -> key
+        self.derived = dict()  # type: Dict[Path, List[Tuple[str, Optional[str], str]]]  # source -> [(channel, transform, key)]
+        self.file_sizes = dict()  # type: Dict[Path, int]
+        self.decoded_sizes = dict()  # type: Dict[Path, int]
+        self.cached = set()  # in the persistent pixel cache, not decoded
+
+    @property
+    def total(self) -> int:
+        # Sources to decode, each once
+        return len(set(self.missing) | set(self.derived))
+
+    @property
+    def keys(self) -> Set[str]:
+        keys = set(self.missing.values())
+        for items in self.derived.values():
+            keys.update(key for _, _, key in items)
+        return keys
+
+    def get_order(self, paths: Iterable[Path]) -> List[Path]:
+        # Largest first, the decoding of the smaller ones then fills the gaps at the end
+        return sorted(paths, key=lambda path: self.decoded_sizes.get(path, 0), reverse=True)
+
+
+# Lives for the whole Blender session
+session_cache = TextureCache()
+
+
+def get_cache(shared: bool, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=BACKEND_VTFLIB, max_size: int=0, deferred: bool=False, bake: bool=False, merge_identical: bool=False, memory_budget: int=0) -> TextureCache:
+    cache = session_cache if shared else TextureCache()
+    cache.pixel_cache = pixel_cache
+    cache.low_memory = low_memory
+    cache.backend = backend
+    cache.max_size = max_size
+    cache.deferred = deferred
+    # Baking needs the pixels, which deferred imports don't have yet
+    cache.bake = bake and not deferred
+    cache.merge_identical = merge_identical
+    cache.budget.begin(memory_budget * MB)  # MB, 0 is unlimited
+    if shared:
+        # Only the shared cache reuses the images of earlier imports, a new one starts empty
+        cache.begin()
+    return cache
@@ -0,0 +1,316 @@
+import os
+import json
+import mmap
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import instrument
+from . import vpk
+
+INDEX_VERSION = 1
+
+# Threads for work that mostly waits for the disk, like reading and hashing files.
+# Defined here since the other modules reading files depend on this one.
+IO_THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def get_index_file(directory: Path, name: str, key: str) -> Path:
+    """File in the cache directory of a saved index, named by the hash of what it indexes"""
+    return directory / "{}-{}.json".format(name, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def load_index(file: Path, version: int) -> Optional[dict]:
+    """Data of a saved index, None if it is missing, unreadable or of another version"""
+    try:
+        with open(str(file), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != version:
+        return None
+    return data
+
+
+def save_index(file: Path, version: int, data: dict):
+    # Written to a temporary file first, so other instances never load half of it
+    temp = file.with_name("{}.{}.tmp".format(file.name, os.getpid()))
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(temp), "w", encoding="utf-8") as f:
+            json.dump(dict(data, version=version), f)
+        os.replace(str(temp), str(file))
+    except OSError as e:
+        instrument.log("Failed to save index {}: {}".format(file, e), instrument.LEVEL_ERRORS)
+
+
+def normalize(relpath: str) -> str:
+    # Source paths are case-insensitive and often use backslashes
+    return relpath.replace("\\", "/").strip("/").lower()
+
+
+class ContentIndex:
+    """Index of the files in a game directory, maps lower-cased relative paths to the real files"""
+
+    def __init__(self, root: Path, subdirs: Tuple[str, ...]=("materials",), cache_directory: Path=None):
+        self.root = Path(root)
+        self.subdirs = subdirs  # only these are indexed
+        self.cache_directory = cache_directory  # for the directories of VPK archives
+        self.dirs = dict()  # real relative dir -> [mtime_ns, file names, subdir names]
+        self.files = dict()  # normalized relative path -> real relative path
+        self.archives = []  # type: List[vpk.VpkArchive]  # in the root, searched after the loose files
+
+    def refresh(self) -> bool:
+        # Only directories whose modification time changed are listed again,
+        # unchanged ones only need a stat
+        dirs = dict()
+        stack = list(self.subdirs) or [""]
+        listed = 0
+        while stack:
+            reldir = stack.pop()
+            path = self.root / reldir if reldir else self.root
+            try:
+                mtime = os.stat(str(path)).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(reldir)
+            if entry is None or entry[0] != mtime:
+                files = []
+                subdirs = []
+                try:
+                    with os.scandir(str(path)) as it:
+                        for item in it:
+                            if item.is_dir():
+                                subdirs.append(item.name)
+                            else:
+                                files.append(item.name)
+                except OSError:
+                    continue
+                entry = [mtime, files, subdirs]
+                listed += 1
+            dirs[reldir] = entry
+            for subdir in entry[2]:
+                stack.append(reldir + "/" + subdir if reldir else subdir)
+        changed = listed > 0 or len(dirs) != len(self.dirs)
+        self.dirs = dirs
+        self.files = dict()
+        for reldir, entry in dirs.items():
+            for name in entry[1]:
+                relpath = reldir + "/" + name if reldir else name
+                self.files.setdefault(relpath.lower(), relpath)
+        instrument.log("ContentIndex: Indexed {} files in {}, listed {} of {} directories".format(len(self.files), self.root, listed, len(dirs)))
+        # Archives removed from the root are closed
+        files = vpk.find_dir_files(self.root)
+        for archive in self.archives:
+            if archive.path not in files:
+                vpk.unmount(archive.path)
+        self.archives = []
+        for file in files:
+            try:
+                self.archives.append(vpk.mount(file, self.subdirs, self.cache_directory))
+            except Exception as e:
+                instrument.log("ContentIndex: Failed to read {}: {}".format(file, e), instrument.LEVEL_ERRORS)
+        return changed
+
+    def find(self, relpath: str) -> Optional[Path]:
+        relpath = normalize(relpath)
+        real = self.files.get(relpath)
+        if real is not None:
+            return self.root / real
+        for archive in self.archives:
+            item = archive.files.get(relpath)
+            if item is not None:
+                return archive.path / item[0]
+        return None
+
+    def iter_files(self, prefix: str="", suffix: str="") -> Iterator[Tuple[str, Path]]:
+        """Iterate over the normalized relative paths and real paths of files under a directory"""
+        prefix = normalize(prefix)
+        if prefix:
+            prefix += "/"
+        suffix = suffix.lower()
+        for relpath, real in self.files.items():
+            if relpath.startswith(prefix) and relpath.endswith(suffix):
+                yield relpath, self.root / real
+        # Loose files override the ones in archives, like in the game
+        found = set()
+        for archive in self.archives:
+            for relpath, real in archive.iter_files():
+                if relpath.startswith(prefix) and relpath.endswith(suffix) and relpath not in self.files and relpath not in found:
+                    found.add(relpath)
+                    yield relpath, archive.path / real
+
+    def _get_file(self, directory: Path) -> Path:
+        return get_index_file(directory, "index", "{}|{}".format(self.root.resolve(), "|".join(self.subdirs)))
+
+    def load(self, directory: Path) -> bool:
+        data = load_index(self._get_file(directory), INDEX_VERSION)
+        if data is None or data.get("subdirs") != list(self.subdirs):
+            return False
+        self.dirs = data["dirs"]
+        return True
+
+    def save(self, directory: Path):
+        save_index(self._get_file(directory), INDEX_VERSION, {"root": str(self.root), "subdirs": list(self.subdirs), "dirs": self.dirs})
+
+
+# Indexes built in this session, refreshed on every use
+_indexes = dict()  # type: Dict[str, ContentIndex]
+
+
+def get_index(root: Path, cache_directory: Path=None) -> ContentIndex:
+    key = str(Path(root).resolve())
+    index = _indexes.get(key)
+    if index is None:
+        index = ContentIndex(root, cache_directory=cache_directory)
+        if cache_directory:
+            index.load(cache_directory)
+        _indexes[key] = index
+    if index.refresh() and cache_directory:
+        index.save(cache_directory)
+    return index
+
+
+# Files are either loose files or files in a VPK archive, whose path is the path of the
+# directory file followed by the path in the archive (<game>/pak01_dir.vpk/materials/...)
+
+def is_archived(path: Path) -> bool:
+    return vpk.find(path) is not None
+
+
+def read_bytes(path: Path, size: int=-1):
+    """Contents of a loose or archived file, only the first size bytes if given"""
+    found = vpk.find(path)
+    if found is not None:
+        archive, entry = found
+        return archive.read(entry, size)
+    with open(str(path), "rb") as f:
+        return f.read(size)
+
+
+def get_identity(path: Path) -> Optional[str]:
+    """Identifies a file and its current contents, None if it doesn't exist"""
+    found = vpk.find(path)
+    if found is not None:
+        archive, entry = found
+        # The archive is only read again when the directory file changes
+        return "{}|{}|{}|{}".format(archive.path.resolve() / path.relative_to(archive.path), entry.size, entry.crc, archive.stat[1])
+    try:
+        path = path.resolve()
+        stat = path.stat()
+    except OSError:
+        return None
+    return "{}|{}|{}".format(path, stat.st_size, stat.st_mtime_ns)
+
+
+# Content hashes of this session, keyed by the identity of the file, so unchanged files are only hashed once
+_hashes = dict()  # type: Dict[str, str]
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_content_hash(path: Path) -> Optional[str]:
+    """Hash of the contents of a file, equal for identical files with different paths. None if it doesn't exist."""
+    identity = get_identity(path)
+    if identity is None:
+        return None
+    digest = _hashes.get(identity)
+    if digest is not None:
+        return digest
+    with instrument.span("hash", str(path)):
+        # blake2b releases the GIL for large buffers, so files can be hashed in threads
+        hasher = hashlib.blake2b(digest_size=16)
+        found = vpk.find(path)
+        if found is not None:
+            hasher.update(found[0].read(found[1]))
+        else:
+            try:
+                with open(str(path), "rb") as f:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                        hasher.update(chunk)
+            except OSError:
+                return None
+        digest = hasher.hexdigest()
+    _hashes[identity] = digest
+    return digest
+
+
+def hash_files(paths: Iterable[Path], workers: int=0):
+    """Hash many files at once in a thread pool, so later get_content_hash calls only need a lookup"""
+    paths = [path for path in paths if get_identity(path) not in _hashes]
+    if len(paths) < 2 or workers == 1:
+        for path in paths:
+            get_content_hash(path)
+        return
+    with ThreadPoolExecutor(workers or IO_THREADS) as pool:
+        for _ in pool.map(get_content_hash, paths):
+            pass
+
+
+def get_size(path: Path) -> int:
+    """Size of a loose or archived file, 0 if it doesn't exist"""
+    found = vpk.find(path)
+    if found is not None:
+        return found[1].size
+    try:
+        return os.stat(str(path)).st_size
+    except OSError:
+        return 0
+
+
+READ_AHEAD_CHUNK_SIZE = 1 << 20
+
+
+def _read_ahead(path: Path):
+    # Only brings the file into the OS cache, so the decoder doesn't wait for the disk
+    with instrument.span("read ahead"):
+        found = vpk.find(path)
+        if found is not None:
+            # Touching a byte of every page maps it in from the archive
+            data = found[0].read(found[1])
+            for offset in range(0, len(data), mmap.PAGESIZE):
+                data[offset]
+            return
+        buffer = bytearray(READ_AHEAD_CHUNK_SIZE)
+        try:
+            with open(str(path), "rb", buffering=0) as f:
+                while f.readinto(buffer):
+                    pass
+        except OSError:
+            pass
+
+
+class ReadAhead:
+    """Reads files in I/O threads in the order they will be used, while the CPU works on the earlier ones.
+    Only a window of files is read ahead of the ones taken, so they are still in the OS cache when needed."""
+
+    def __init__(self, paths: Iterable[Path], workers: int=2, window: int=0):
+        self._pool = ThreadPoolExecutor(workers)
+        self._paths = iter(paths)
+        self._window = window or 2 * workers
+        self._futures = dict()  # path -> future, for the files read ahead and not taken yet
+        self._taken = set()  # taken before they were read ahead
+        self._fill()
+
+    def _fill(self):
+        while len(self._futures) < self._window:
+            path = next(self._paths, None)
+            if path is None:
+                return
+            if path in self._taken:
+                self._taken.discard(path)
+                continue
+            self._futures[path] = self._pool.submit(_read_ahead, path)
+
+    def take(self, path: Path):
+        """Called when the file is used, reads the next one ahead"""
+        if self._futures.pop(path, None) is None:
+            self._taken.add(path)
+        self._fill()
+
+    def close(self):
+        # Files not read yet are skipped, the ones being read are left to finish in the background
+        for future in self._futures.values():
+            future.cancel()
+        self._pool.shutdown(wait=False)
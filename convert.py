@@ -0,0 +1,213 @@
+# Bulk conversion of VTF textures to PNG or TGA files outside Blender,
+# so materials can be imported with a converted texture file format, which only needs bpy.data.images.load
+
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+from . import decode
+from . import instrument
+from . import vpk
+from .content import ContentIndex
+
+FORMAT_PNG = ".png"
+FORMAT_TGA = ".tga"
+FORMATS = (FORMAT_PNG, FORMAT_TGA)
+
+MANIFEST_NAME = "vtf-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def encode_png(decoded: decode.DecodedImage, compress_level: int=6) -> bytes:
+    channels = 4 if decoded.alpha else 3
+    # PNG rows start from the top, every row has a filter type byte (0, none) before it
+    pixels = decoded.pixels.reshape(decoded.height, decoded.width, 4)[::-1, :, :channels]
+    rows = np.zeros((decoded.height, decoded.width * channels + 1), np.uint8)
+    rows[:, 1:] = pixels.reshape(decoded.height, -1)
+    header = struct.pack(">IIBBBBB", decoded.width, decoded.height, 8, 6 if decoded.alpha else 2, 0, 0, 0)
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", header),
+        _png_chunk(b"IDAT", zlib.compress(rows.tobytes(), compress_level)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+
+def encode_tga(decoded: decode.DecodedImage) -> bytes:
+    # Uncompressed true color, rows from the bottom like the decoded pixels, BGR(A) byte order
+    channels = 4 if decoded.alpha else 3
+    pixels = decoded.pixels.reshape(decoded.height, decoded.width, 4)[:, :, [2, 1, 0, 3][:channels]]
+    header = struct.pack("<BBBHHBHHHHBB", 0, 0, 2, 0, 0, 0, 0, 0, decoded.width, decoded.height, channels * 8, 8 if decoded.alpha else 0)
+    return header + np.ascontiguousarray(pixels).tobytes()
+
+
+def convert_file(source: Path, output: Path, backend: str=decode.BACKEND_NUMPY, max_size: int=0, compress_level: int=6) -> Tuple[int, int, bool]:
+    """Decode a VTF file and write it in the format given by the output suffix"""
+    decoded = decode.decode_vtf(source, backend, max_size)
+    if output.suffix.lower() == FORMAT_TGA:
+        data = encode_tga(decoded)
+    else:
+        data = encode_png(decoded, compress_level)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    temp = output.with_name("{}.{}.tmp".format(output.name, os.getpid()))
+    with open(str(temp), "wb") as f:
+        f.write(data)
+    os.replace(str(temp), str(output))
+    return decoded.width, decoded.height, decoded.alpha
+
+
+class Converter:
+    """Converts the VTF files of a game directory, keeping a manifest of the converted files to skip them next time"""
+
+    def __init__(self, root: Path, output: Path=None, image_format: str=FORMAT_PNG, backend: str=decode.BACKEND_NUMPY, max_size: int=0, compress_level: int=6):
+        self.root = Path(root)
+        self.output = Path(output) if output else self.root  # next to the VTF files by default
+        self.image_format = image_format
+        self.backend = backend
+        self.max_size = max_size
+        self.compress_level = compress_level
+        self.manifest = dict()  # type: Dict[str, dict]
+        self.failed = dict()  # type: Dict[str, str]
+        self.found = set()  # normalized relative paths of the files seen by the last scan
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.output / MANIFEST_NAME
+
+    def load_manifest(self):
+        try:
+            with open(str(self.manifest_path), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.manifest = data["files"]
+
+    def save_manifest(self):
+        self.output.mkdir(parents=True, exist_ok=True)
+        temp = self.manifest_path.with_name("{}.{}.tmp".format(MANIFEST_NAME, os.getpid()))
+        with open(str(temp), "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": self.manifest}, f, indent=1, sort_keys=True)
+        os.replace(str(temp), str(self.manifest_path))
+
+    def _get_settings(self) -> dict:
+        return {"format": self.image_format, "max_size": self.max_size}
+
+    @staticmethod
+    def _get_version(source: Path) -> dict:
+        # Files in VPK archives are compared by their checksum, loose files by their modification time
+        found = vpk.find(source)
+        if found is not None:
+            return {"size": found[1].size, "crc": found[1].crc}
+        stat = source.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _get_output(self, source: Path) -> Path:
+        found = vpk.find(source)
+        if found is not None:
+            # The materials tree of an archive is written like the loose files
+            relpath = source.relative_to(found[0].path)
+        else:
+            relpath = source.relative_to(self.root)
+        return (self.output / relpath).with_suffix(self.image_format)
+
+    def _is_up_to_date(self, relpath: str, source: Path, output: Path) -> bool:
+        entry = self.manifest.get(relpath)
+        try:
+            version = self._get_version(source)
+            output_stat = output.stat()
+        except OSError:
+            return False
+        if entry is None:
+            # Converted without a manifest, trust the modification times
+            found = vpk.find(source)
+            return output_stat.st_mtime_ns >= os.stat(str(found[0].path if found else source)).st_mtime_ns
+        return all(entry.get(key) == value for key, value in version.items()) and entry["settings"] == self._get_settings()
+
+    def find_outdated(self) -> Iterator[Tuple[str, Path, Path]]:
+        index = ContentIndex(self.root)
+        index.refresh()
+        self.found = set()
+        for relpath, source in index.iter_files("materials", ".vtf"):
+            self.found.add(relpath)
+            output = self._get_output(source)
+            if not self._is_up_to_date(relpath, source, output):
+                yield relpath, source, output
+
+    def prune_manifest(self) -> int:
+        """Remove the entries of files deleted or renamed since they were converted, returns their number"""
+        removed = [relpath for relpath in self.manifest if relpath not in self.found]
+        for relpath in removed:
+            del self.manifest[relpath]
+        return len(removed)
+
+    def _add(self, relpath: str, source: Path, output: Path, info: Tuple[int, int, bool]):
+        self.manifest[relpath] = dict(self._get_version(source), **{
+            "output": str(output.relative_to(self.output)),
+            "settings": self._get_settings(),
+            "width": info[0],
+            "height": info[1],
+            "alpha": info[2],
+        })
+
+    def convert(self, workers: int=0) -> int:
+        """Convert all outdated files in worker processes, returns the number of converted files"""
+        self.load_manifest()
+        outdated = list(self.find_outdated())
+        pruned = self.prune_manifest()
+        instrument.log("Convert: {} textures to convert, {} removed".format(len(outdated), pruned), instrument.LEVEL_SUMMARY)
+        if not outdated:
+            if pruned:
+                self.save_manifest()
+            return 0
+        converted = 0
+        with ProcessPoolExecutor(workers or None) as pool:
+            futures = dict()
+            for relpath, source, output in outdated:
+                future = pool.submit(convert_file, source, output, self.backend, self.max_size, self.compress_level)
+                futures[future] = (relpath, source, output)
+            for future in as_completed(futures):
+                relpath, source, output = futures[future]
+                try:
+                    info = future.result()
+                except Exception as e:
+                    self.failed[relpath] = str(e)
+                    instrument.log("Convert: Failed to convert {}: {}".format(source, e), instrument.LEVEL_ERRORS)
+                    continue
+                self._add(relpath, source, output, info)
+                converted += 1
+                instrument.log("Convert: {}".format(output))
+        self.save_manifest()
+        return converted
+
+
+def main(argv: Optional[list]=None) -> int:
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Convert the VTF textures of a game directory to PNG or TGA for importing without conversion")
+    parser.add_argument("root", help="game directory containing the materials directory")
+    parser.add_argument("--output", help="directory to write the materials tree to, next to the VTF files by default")
+    parser.add_argument("--format", choices=[f[1:] for f in FORMATS], default="png", help="output image format")
+    parser.add_argument("--workers", type=int, default=0, help="number of processes, 0 uses all CPU cores")
+    parser.add_argument("--backend", choices=[decode.BACKEND_NUMPY, decode.BACKEND_VTFLIB], default=decode.BACKEND_NUMPY, help="VTF decoder")
+    parser.add_argument("--max-size", type=int, default=0, help="convert a smaller mipmap if the texture is larger than this")
+    parser.add_argument("--compress-level", type=int, default=6, choices=range(10), metavar="0-9", help="PNG compression level, lower is faster")
+    parser.add_argument("--verbose", action="store_true", help="log every converted file")
+    args = parser.parse_args(argv)
+    instrument.begin(instrument.LEVEL_STEPS if args.verbose else instrument.LEVEL_SUMMARY)
+    start = time.perf_counter()
+    converter = Converter(Path(args.root), Path(args.output) if args.output else None, "." + args.format,
+                          args.backend, args.max_size, args.compress_level)
+    converted = converter.convert(args.workers)
+    instrument.log("Convert: Converted {} textures in {:.1f} s, {} failed".format(
+        converted, time.perf_counter() - start, len(converter.failed)), instrument.LEVEL_SUMMARY)
+    return 1 if converter.failed else 0
@@ -0,0 +1,18 @@
+# Converts the VTF textures of a game directory to PNG or TGA files without Blender,
+# see convert.py. Usage: python convert_textures.py <game directory> [--output DIR] [--format png|tga]
+
+import os
+import sys
+import types
+
+# The addon's __init__ needs bpy, so only the package path is set up and the Blender independent modules are imported
+PACKAGE = "blender_vmt"
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules[PACKAGE] = package
+
+from blender_vmt import convert
+
+if __name__ == "__main__":
+    sys.exit(convert.main())
@@ -1,9 +1,14 @@
 import bpy
 from pathlib import Path
+from typing import Dict, Iterator
 
 import re
 
-from .vmt import VMT
+from . import instrument
+from .vmt import SOURCE_PROPERTY, VMT, Progress, find_duplicates, parse_vmts
+from .planner import BatchPlan
+from .cache import TextureCache
+from .content import get_index
 
 re_mtl_path = re.compile(r'^# (?P<path>.+)\nnewmtl (?P<mat>.+)', flags=re.I)
 
@@ -19,13 +24,87 @@ class CraftyMtl:
             if match:
                 self.material_map[match.group('mat')] = match.group('path').lower()
 
-    def replace_materials(self, texturepath: Path, textureext: str, suffix: str="", rename: bool=False):
-        for mat_name in self.material_map:
-            fullpath = texturepath / "materials" / (self.material_map[mat_name] + ".vmt")
-            if not fullpath.exists():
-                print("CraftyReplace: Did not find mtl file: {}".format(fullpath))
-                continue
-            vmt = VMT(fullpath, textureext, texturepath)
-            vmt.make_material(mat_name + suffix, True)
+    def replace_materials(self, texturepath: Path, textureext: str, suffix: str="", rename: bool=False, workers: int=0, cache: TextureCache=None, index_directory: Path=None, node_groups: bool=False, deduplicate: bool=False, skip_unchanged: bool=False):
+        for _ in self.iter_replace_materials(texturepath, textureext, suffix, rename, workers, cache, index_directory, node_groups, deduplicate, skip_unchanged):
+            pass
+
+    def iter_replace_materials(self, texturepath: Path, textureext: str, suffix: str="", rename: bool=False, workers: int=0, cache: TextureCache=None, index_directory: Path=None, node_groups: bool=False, deduplicate: bool=False, skip_unchanged: bool=False) -> Iterator[Progress]:
+        """Replace the materials one step at a time, yielding the progress after every texture and material.
+        If the iteration is stopped early, the materials built so far are kept."""
+        if cache is None:
+            cache = TextureCache()
+        paths = dict()
+        with instrument.span("resolve"):
+            index = get_index(texturepath, index_directory)
+            for mat_name in self.material_map:
+                fullpath = index.find("materials/" + self.material_map[mat_name] + ".vmt")
+                if fullpath is None:
+                    instrument.log("CraftyReplace: Did not find mtl file: {}".format(texturepath / "materials" / (self.material_map[mat_name] + ".vmt")), instrument.LEVEL_ERRORS)
+                    continue
+                paths[mat_name] = fullpath
+        failed = parse_vmts(paths.values(), workers)
+        vmts = dict()
+        for mat_name, fullpath in paths.items():
+            # Already logged, one broken file doesn't stop the others
+            if fullpath not in failed:
+                vmts[mat_name] = VMT(fullpath, textureext, texturepath, cache, index)
+        names = self.get_material_names(vmts, suffix, rename)
+        # Equivalent materials are only built once
+        duplicates = find_duplicates(vmts) if deduplicate else dict()
+        for mat_name in duplicates:
+            del vmts[mat_name]
+        unchanged = set()
+        if skip_unchanged:
+            # Imported before from the same VMT, textures and options
+            unchanged = set(mat_name for mat_name, vmt in vmts.items() if vmt.is_unchanged(names[mat_name], node_groups))
+            for mat_name in unchanged:
+                del vmts[mat_name]
+            instrument.log("CraftyReplace: Skipping {} unchanged materials".format(len(unchanged)), instrument.LEVEL_SUMMARY)
+        # All textures are known before anything is imported
+        plan = BatchPlan(vmts, cache, workers)
+        plan.report()
+        built = set()
+
+        def build(mat_name):
+            vmts[mat_name].make_material(names[mat_name], True, node_groups)
+            built.add(mat_name)
+
+        try:
+            yield from plan.iter_execute(build)
+        finally:
+            # Also when cancelled, for the materials that were built
+            replaced = 0
+            for mat_name, original in duplicates.items():
+                mat = bpy.data.materials.get(names[mat_name])
+                # The original is complete if it was built now or before
+                if mat and (original in built or original in unchanged):
+                    mat.user_remap(bpy.data.materials[names[original]])
+                    replaced += 1
+            if replaced:
+                instrument.log("CraftyReplace: Replaced {} duplicate materials".format(replaced), instrument.LEVEL_SUMMARY)
             if rename:
-                bpy.data.materials[mat_name + suffix].name = Path(self.material_map[mat_name]).stem
+                for mat_name in built | unchanged:
+                    mat = bpy.data.materials[names[mat_name]]
+                    stem = Path(self.material_map[mat_name]).stem
+                    if mat.name != stem:
+                        mat.name = stem
+            instrument.log("CraftyReplace: Texture cache {} hits, {} misses".format(cache.hits, cache.misses))
+
+    def get_material_names(self, vmts: Dict[str, VMT], suffix: str, rename: bool) -> Dict[str, str]:
+        """Names of the Blender materials to replace. Materials renamed by an earlier import are found by their VMT."""
+        names = dict()
+        sources = dict()  # VMT path -> names of renamed materials built from it
+        if rename:
+            for mat in bpy.data.materials:
+                source = mat.get(SOURCE_PROPERTY)
+                if source and mat.name.startswith(Path(source).stem):
+                    sources.setdefault(source, []).append(mat.name)
+        for mat_name, vmt in vmts.items():
+            names[mat_name] = mat_name + suffix
+            if rename and bpy.data.materials.get(mat_name + suffix) is None:
+                # Prefer the exact name over copies like metal.001
+                renamed = sorted(sources.get(str(vmt.filepath), []), key=len)
+                if renamed:
+                    names[mat_name] = renamed.pop(0)
+                    sources[str(vmt.filepath)] = renamed
+        return names
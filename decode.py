@@ -0,0 +1,232 @@
+# VTF decoding that does not depend on Blender, so it can also run in worker processes
+
+import os
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Tuple, Union
+
+import numpy as np
+from . import content
+from . import instrument
+from . import vtfnumpy
+from .memory import MemoryBudget
+
+# VTFLib is only needed for the VTFLib backend, so the NumPy decoder works without it (for example outside Blender)
+try:
+    from .libraries.VTFLibWrapper import VTFLib
+    from .libraries.VTFLibWrapper import VTFLibEnums
+except (ImportError, OSError):
+    VTFLib = None
+    VTFLibEnums = None
+
+BACKEND_VTFLIB = "vtflib"
+BACKEND_NUMPY = "numpy"
+
+
+class DecodedImage(NamedTuple):
+    width: int
+    height: int
+    alpha: bool
+    pixels: np.ndarray  # flat RGBA8888, bottom row first like Blender expects
+
+
+# VTFLib keeps the currently loaded image as global state,
+# so every process needs its own instance and decodes one image at a time
+_vtf_lib = None
+_vtf_lib_lock = threading.Lock()
+
+
+def _get_vtf_lib() -> "VTFLib.VTFLib":
+    global _vtf_lib
+    if VTFLib is None:
+        raise Exception("VTF: VTFLib is not available")
+    if _vtf_lib is None:
+        _vtf_lib = VTFLib.VTFLib()
+    return _vtf_lib
+
+
+def _init_worker():
+    global _vtf_lib
+    if VTFLib is not None:
+        _vtf_lib = VTFLib.VTFLib()
+
+
+def _decode_vtflib(path: Path) -> DecodedImage:
+    vtf_lib = _get_vtf_lib()
+    vtf_lib.image_load(str(path))
+    try:
+        if vtf_lib.image_is_loaded():
+            instrument.log('VTF: Image loaded successfully')
+        else:
+            raise Exception("VTF: Failed to load image :{}".format(vtf_lib.get_last_error()))
+        width = vtf_lib.width()
+        height = vtf_lib.height()
+        rgba_data = vtf_lib.get_rgba8888()
+        instrument.log('VTF: Converted')
+        with instrument.span("flip"):
+            rgba_data = vtf_lib.flip_image_external(rgba_data, width, height)
+        instrument.log('VTF: Flipped')
+        pixels = np.array(rgba_data.contents, np.uint8)
+        flags = vtf_lib.get_image_flags()
+        alpha = flags.get_flag(VTFLibEnums.ImageFlag.ImageFlagOneBitAlpha) or flags.get_flag(VTFLibEnums.ImageFlag.ImageFlagEightBitAlpha)
+        return DecodedImage(width, height, bool(alpha), pixels)
+    finally:
+        vtf_lib.image_destroy()
+
+
+def _decode_numpy(path: Path, max_size: int=0) -> DecodedImage:
+    return DecodedImage(*vtfnumpy.decode_vtf_data(content.read_bytes(path), max_size=max_size))
+
+
+def decode_vtf(path: Path, backend: str=BACKEND_VTFLIB, max_size: int=0) -> DecodedImage:
+    with instrument.span("decode", str(path)):
+        decoded = _decode_vtf(path, backend, max_size)
+    instrument.count("decoded bytes", decoded.pixels.nbytes)
+    return decoded
+
+
+def _decode_vtf(path: Path, backend: str, max_size: int) -> DecodedImage:
+    # The smaller mipmaps are read directly from the file, which only the NumPy decoder can do
+    if content.is_archived(path):
+        # VTFLib can only open files, the NumPy decoder reads from the archive directly
+        try:
+            return _decode_numpy(path, max_size)
+        except vtfnumpy.UnsupportedFormat as e:
+            raise Exception("{} in archive, extract {} to import it with VTFLib".format(e, path)) from e
+    if backend == BACKEND_NUMPY or max_size > 0:
+        try:
+            return _decode_numpy(path, max_size)
+        except vtfnumpy.UnsupportedFormat as e:
+            if max_size > 0:
+                instrument.log("{}, importing full size {} with VTFLib".format(e, path), instrument.LEVEL_ERRORS)
+            else:
+                instrument.log("{}, using VTFLib for {}".format(e, path), instrument.LEVEL_ERRORS)
+    with _vtf_lib_lock:
+        return _decode_vtflib(path)
+
+
+def read_info(path: Path) -> Tuple[int, int, bool]:
+    """Read the size and alpha of a VTF file from its header, without decoding it"""
+    header = vtfnumpy.read_header(content.read_bytes(path, vtfnumpy.HEADER_READ_SIZE))
+    return header.width, header.height, header.alpha
+
+
+def get_decoded_size(path: Path, max_size: int=0) -> int:
+    """Bytes of the pixels a VTF file decodes to, from its header"""
+    try:
+        header = vtfnumpy.read_header(content.read_bytes(path, vtfnumpy.HEADER_READ_SIZE))
+    except Exception:
+        return 0
+    width, height = vtfnumpy.get_mipmap_size(header, vtfnumpy.get_mipmap_level(header, max_size))
+    return width * height * 4
+
+
+def compare_backends(path: Path) -> int:
+    """Decode a file with both backends and return the largest difference of a single channel"""
+    reference = decode_vtf(path, BACKEND_VTFLIB)
+    result = _decode_numpy(path)
+    if (result.width, result.height) != (reference.width, reference.height):
+        raise Exception("VTF: Size differs, {}x{} != {}x{}".format(result.width, result.height, reference.width, reference.height))
+    return int(np.abs(result.pixels.astype(np.int16) - reference.pixels.astype(np.int16)).max())
+
+
+def _decode_collected(path: Path, backend: str, max_size: int):
+    # Runs in a worker, the spans are sent back with the result
+    with instrument.collect() as collected:
+        return decode_vtf(path, backend, max_size), collected
+
+
+def _decode_all(paths: Iterable[Path], backend: str, max_size: int) -> Iterator[Tuple[Path, Union[DecodedImage, Exception]]]:
+    for path in paths:
+        try:
+            yield path, decode_vtf(path, backend, max_size)
+        except Exception as e:
+            yield path, e
+
+
+def _decode_serial(paths: Iterable[Path], backend: str, max_size: int, budget: MemoryBudget=None) -> Iterator[Tuple[Path, Union[DecodedImage, Exception]]]:
+    if budget is None:
+        yield from _decode_all(paths, backend, max_size)
+        return
+    # Only one texture is held at a time, the budget makes room for it and records it
+    for path, result in _decode_all(paths, backend, max_size):
+        size = 0 if isinstance(result, Exception) else result.pixels.nbytes
+        budget.fits(size)
+        budget.reserve(size)
+        try:
+            yield path, result
+        finally:
+            budget.release(size)
+
+
+def _can_fork() -> bool:
+    # Blender can't be started as a plain interpreter for spawned children, only forking works.
+    # Forking a multithreaded process is only safe enough on Linux (macOS defaults to spawning for that reason),
+    # and not from other threads, like the one of the background loader, while the UI keeps running.
+    return sys.platform.startswith("linux") and threading.current_thread() is threading.main_thread()
+
+
+def decode_vtfs(paths: Iterable[Path], workers: int=0, max_pending: int=0, backend: str=BACKEND_VTFLIB, max_size: int=0, budget: MemoryBudget=None) -> Iterator[Tuple[Path, Union[DecodedImage, Exception]]]:
+    """Decode multiple VTF files in parallel, yielding the results in completion order.
+    With a memory budget, no more textures are decoded than fit in it while earlier results wait to be consumed."""
+    paths = list(paths)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        yield from _decode_serial(paths, backend, max_size, budget)
+        return
+    if backend == BACKEND_NUMPY:
+        # NumPy releases the GIL for the heavy array work, so threads are enough
+        pool = ThreadPoolExecutor(workers)
+    elif _can_fork():
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker)
+    else:
+        yield from _decode_serial(paths, backend, max_size, budget)
+        return
+    # Finished results stay in memory until consumed, so limiting the queued work bounds memory usage
+    if max_pending <= 0:
+        max_pending = len(paths)
+    max_pending = max(max_pending, workers)
+    remaining = list(reversed(paths))
+    pending = dict()
+    sizes = dict()  # future -> reserved bytes of its texture
+    with pool:
+        try:
+            while remaining or pending:
+                while remaining and len(pending) < max_pending:
+                    path = remaining[-1]
+                    if budget is not None:
+                        # Wait for earlier results if the next one doesn't fit, unless nothing is running
+                        size = get_decoded_size(path, max_size)
+                        if pending and not budget.fits(size):
+                            break
+                        budget.reserve(size)
+                    remaining.pop()
+                    future = pool.submit(_decode_collected, path, backend, max_size)
+                    pending[future] = path
+                    if budget is not None:
+                        sizes[future] = size
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        result, collected = future.result()
+                        instrument.recorder.merge(collected)
+                    except Exception as e:
+                        result = e
+                    try:
+                        yield path, result
+                    finally:
+                        # Consumed, the result isn't held here anymore
+                        del result
+                        if budget is not None:
+                            budget.release(sizes.pop(future, 0))
+        finally:
+            for future in pending:
+                future.cancel()
+            if budget is not None:
+                budget.release(sum(sizes.values()))
@@ -0,0 +1,195 @@
+# Deferred texture loading: materials are built against placeholder images that are filled in later
+
+import bpy
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, List, Set
+
+from . import decode
+from . import instrument
+from . import vtf
+from .diskcache import PixelCache
+from .memory import MemoryBudget
+
+# Custom properties of placeholder images, so they can be loaded later even in another session
+PENDING_PROPERTY = "vmt_pending"
+MAX_SIZE_PROPERTY = "vmt_max_size"
+
+# Seconds spent filling images per timer step, keeps the UI responsive
+STEP_TIME = 0.05
+STEP_INTERVAL = 0.1
+
+
+def make_placeholder(path: Path, max_size: int=0) -> bpy.types.Image:
+    try:
+        alpha = decode.read_info(path)[2]
+    except Exception:
+        alpha = True
+    image = bpy.data.images.new(path.stem, width=1, height=1, alpha=alpha)
+    image[PENDING_PROPERTY] = str(path)
+    image[MAX_SIZE_PROPERTY] = max_size
+    return image
+
+
+def is_pending(image: bpy.types.Image) -> bool:
+    return PENDING_PROPERTY in image
+
+
+def get_material_pending_images(material: bpy.types.Material) -> List[bpy.types.Image]:
+    if not material.use_nodes:
+        return []
+    return [node.image for node in material.node_tree.nodes if node.type == 'TEX_IMAGE' and node.image and is_pending(node.image)]
+
+
+def get_pending_images(objects: Iterable[bpy.types.Object]=None) -> List[bpy.types.Image]:
+    if objects is None:
+        return [image for image in bpy.data.images if is_pending(image)]
+    images = dict()
+    for obj in objects:
+        for slot in obj.material_slots:
+            if slot.material:
+                images.update((image.name, image) for image in get_material_pending_images(slot.material))
+    return list(images.values())
+
+
+def _group_by_size(names: Iterable[str]):
+    # Decoding settings can differ between images, group paths by them
+    groups = defaultdict(lambda: defaultdict(list))  # max size -> path -> image names
+    for name in names:
+        image = bpy.data.images.get(name)
+        if image is None or not is_pending(image):
+            continue
+        groups[image.get(MAX_SIZE_PROPERTY, 0)][Path(image[PENDING_PROPERTY])].append(name)
+    return groups
+
+
+def fill(image: bpy.types.Image, decoded: decode.DecodedImage, low_memory: bool=False, budget: MemoryBudget=None):
+    """Replace the pixels of a placeholder image with the decoded texture"""
+    vtf.fill_image(image, decoded, low_memory, budget)
+    del image[PENDING_PROPERTY]
+
+
+def _fill(path: Path, names: Iterable[str], result, low_memory: bool):
+    if isinstance(result, Exception):
+        instrument.log("VTF: Failed to decode {}: {}".format(path, result), instrument.LEVEL_ERRORS)
+        return
+    for name in names:
+        image = bpy.data.images.get(name)
+        # Could have been removed or loaded by someone else meanwhile
+        if image is None or image.get(PENDING_PROPERTY) != str(path):
+            continue
+        fill(image, result, low_memory)
+
+
+def load_images(images: Iterable[bpy.types.Image], workers: int=0, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=decode.BACKEND_VTFLIB):
+    """Load the pixels of placeholder images immediately"""
+    for max_size, paths in _group_by_size([image.name for image in images]).items():
+        for path, result in vtf.decode_images(paths.keys(), workers, pixel_cache, low_memory, backend, max_size):
+            _fill(path, paths[path], result, low_memory)
+            del result
+
+
+class BackgroundLoader:
+    """Decodes placeholder images in a background thread and fills them from a timer on the main thread"""
+
+    def __init__(self, images: Iterable[bpy.types.Image], workers: int=0, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=decode.BACKEND_VTFLIB, timing_file: str=""):
+        self.groups = _group_by_size([image.name for image in images])
+        self.workers = workers
+        self.pixel_cache = pixel_cache
+        self.low_memory = low_memory
+        self.backend = backend
+        self.timing_file = timing_file  # the import's timings are reported once the textures are loaded
+        self.total = sum(len(paths) for paths in self.groups.values())
+        self.done = 0
+        # Bounded so decoded textures don't pile up while the main thread is busy
+        self.results = queue.Queue(2 * (workers or os.cpu_count() or 1))
+        self.cancelled = False
+        self._thread = None
+        # Every access of self.step is a new bound method, the timer has to be unregistered with the registered one
+        self._step = self.step
+
+    def _put(self, item):
+        while not self.cancelled:
+            try:
+                self.results.put(item, timeout=STEP_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _decode(self):
+        try:
+            for max_size, paths in self.groups.items():
+                for path, result in vtf.decode_images(paths.keys(), self.workers, self.pixel_cache, self.low_memory, self.backend, max_size):
+                    if self.cancelled:
+                        return
+                    self._put((path, paths[path], result))
+                    del result
+        finally:
+            self._put(None)
+
+    def start(self):
+        if not self.total:
+            instrument.end(self.timing_file)
+            return
+        instrument.log("VTF: Loading {} textures in the background".format(self.total), instrument.LEVEL_SUMMARY)
+        _loaders.add(self)
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+        bpy.app.timers.register(self._step, first_interval=STEP_INTERVAL)
+
+    def cancel(self):
+        self.cancelled = True
+        if bpy.app.timers.is_registered(self._step):
+            bpy.app.timers.unregister(self._step)
+        # Let go of the decoded textures still waiting, the thread stops at its next one
+        while True:
+            try:
+                self.results.get_nowait()
+            except queue.Empty:
+                break
+        instrument.log("VTF: Cancelled loading textures in the background, {} left as placeholders".format(self.total - self.done), instrument.LEVEL_SUMMARY)
+        self._finish()
+
+    def _finish(self):
+        if self in _loaders:
+            _loaders.discard(self)
+            instrument.end(self.timing_file)
+
+    def step(self):
+        deadline = time.perf_counter() + STEP_TIME
+        while time.perf_counter() < deadline:
+            try:
+                item = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                instrument.log("VTF: Loaded {} textures in the background".format(self.done), instrument.LEVEL_SUMMARY)
+                self._finish()
+                return None
+            path, names, result = item
+            _fill(path, names, result, self.low_memory)
+            self.done += 1
+        if self.cancelled:
+            return None
+        return STEP_INTERVAL
+
+
+# Loaders still running, their images belong to the file that is open
+_loaders = set()  # type: Set[BackgroundLoader]
+
+
+def cancel_loaders():
+    """Stop loading in the background, when another file is loaded or another import begins"""
+    for loader in list(_loaders):
+        loader.cancel()
+
+
+def begin(level: int=instrument.LEVEL_SUMMARY):
+    """Start the timings of an import. Loaders still running report into the same recorder, so they are cancelled first.
+    Their remaining images stay placeholders for the next background import or Load deferred Source textures."""
+    cancel_loaders()
+    instrument.begin(level)
@@ -0,0 +1,105 @@
+import os
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from . import content
+from . import instrument
+from .decode import DecodedImage
+
+
+class PixelCache:
+    """Decoded pixel data stored on disk, so unchanged VTF files don't have to be decoded again in later sessions"""
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = Path(directory)
+        self.max_size = max_size  # bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._size = None
+
+    @staticmethod
+    def get_key(path: Path, max_size: int=0) -> Optional[str]:
+        key = content.get_identity(path)
+        if key is None:
+            return None
+        if max_size > 0:
+            key += "|{}".format(max_size)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _file(self, key: str, alpha: bool) -> Path:
+        return self.directory / "{}-{}.npy".format(key, "a" if alpha else "o")
+
+    def get(self, path: Path, max_size: int=0) -> Optional[DecodedImage]:
+        key = self.get_key(path, max_size)
+        if key is None:
+            return None
+        for alpha in (False, True):
+            file = self._file(key, alpha)
+            try:
+                pixels = np.load(str(file), mmap_mode='r')
+            except (OSError, ValueError):
+                continue
+            # Modification time is used as the last access time for eviction
+            os.utime(str(file))
+            instrument.count("pixel cache hits")
+            height, width = pixels.shape[:2]
+            return DecodedImage(width, height, alpha, pixels.reshape(-1))
+        instrument.count("pixel cache misses")
+        return None
+
+    def contains(self, path: Path, max_size: int=0) -> bool:
+        key = self.get_key(path, max_size)
+        return key is not None and any(self._file(key, alpha).is_file() for alpha in (False, True))
+
+    def put(self, path: Path, decoded: DecodedImage, max_size: int=0):
+        key = self.get_key(path, max_size)
+        if key is None:
+            return
+        file = self._file(key, decoded.alpha)
+        temp = file.with_name("{}.{}.tmp".format(file.name, os.getpid()))
+        pixels = decoded.pixels.reshape(decoded.height, decoded.width, 4)
+        try:
+            with open(str(temp), "wb") as f:
+                np.save(f, pixels)
+            os.replace(str(temp), str(file))
+        except OSError as e:
+            instrument.log("VTF: Failed to write cache file {}: {}".format(file, e), instrument.LEVEL_ERRORS)
+            return
+        if self._size is not None:
+            self._size += file.stat().st_size
+        self._evict()
+
+    def _evict(self):
+        # Remove least recently used files until the cache fits in its size limit
+        entries = None
+        if self._size is None:
+            entries = self._entries()
+            self._size = sum(entry[1] for entry in entries)
+        if self._size <= self.max_size:
+            return
+        if entries is None:
+            entries = self._entries()
+            self._size = sum(entry[1] for entry in entries)
+        for file, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                continue
+            self._size -= size
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(str(self.directory)):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+
+def get_pixel_cache(directory: str, max_size_mb: int) -> Optional[PixelCache]:
+    if not directory:
+        return None
+    return PixelCache(Path(directory), max_size_mb * 1024 * 1024)
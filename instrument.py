@@ -0,0 +1,174 @@
+# Timing of the import stages and leveled logging, replaces printing every step.
+# Does not depend on Blender, so worker processes can record spans too.
+
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+# Log levels, messages are printed if their level is at most the configured one
+LEVEL_ERRORS = 0  # only failures
+LEVEL_SUMMARY = 1  # failures and a summary at the end of an import
+LEVEL_STEPS = 2  # every step, like before
+
+LEVELS = {"ERRORS": LEVEL_ERRORS, "SUMMARY": LEVEL_SUMMARY, "STEPS": LEVEL_STEPS}
+
+log_level = LEVEL_SUMMARY
+
+# Slowest items listed in the summary
+SLOWEST_COUNT = 10
+
+
+def log(message: str, level: int=LEVEL_STEPS):
+    if level <= log_level:
+        print(message)
+
+
+class _Collector:
+    """Records spans of one task, so they can be sent back from a worker process"""
+
+    def __init__(self):
+        self.spans = []  # type: List[Tuple[str, float, Optional[str]]]
+        self.counters = Counter()
+
+    def add(self, stage: str, seconds: float, item: str=None):
+        self.spans.append((stage, seconds, item))
+
+    def count(self, name: str, value: int=1):
+        self.counters[name] += value
+
+
+class Recorder:
+    """Totals of the spans and counters of an import"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.stages = dict()  # stage -> [count, seconds]
+        self.items = dict()  # stage -> item -> seconds
+        self.counters = Counter()
+
+    def add(self, stage: str, seconds: float, item: str=None):
+        with self._lock:
+            total = self.stages.setdefault(stage, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+            if item is not None:
+                items = self.items.setdefault(stage, dict())
+                items[item] = items.get(item, 0.0) + seconds
+
+    def count(self, name: str, value: int=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def maximum(self, name: str, value: int):
+        with self._lock:
+            self.counters[name] = max(self.counters[name], value)
+
+    def merge(self, collected: _Collector):
+        for span in collected.spans:
+            self.add(*span)
+        for name, value in collected.counters.items():
+            self.count(name, value)
+
+    def get_slowest(self, stage: str, count: int=SLOWEST_COUNT) -> List[Tuple[str, float]]:
+        with self._lock:
+            items = list(self.items.get(stage, dict()).items())
+        return sorted(items, key=lambda item: item[1], reverse=True)[:count]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "seconds": time.perf_counter() - self.started,
+                "stages": {stage: {"count": count, "seconds": seconds} for stage, (count, seconds) in self.stages.items()},
+                "items": {stage: dict(items) for stage, items in self.items.items()},
+                "counters": dict(self.counters),
+            }
+
+    def summary(self) -> str:
+        data = self.to_dict()
+        lines = ["Import took {:.2f} s".format(data["seconds"])]
+        for stage, total in sorted(data["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+            lines.append("  {:<8} {:>6} x {:>9.3f} s".format(stage, total["count"], total["seconds"]))
+        counters = data["counters"]
+        if counters.get("decoded bytes"):
+            lines.append("  Decoded {:.1f} MB".format(counters["decoded bytes"] / (1024 * 1024)))
+        for name in ("texture cache", "pixel cache"):
+            hits = counters.get(name + " hits", 0)
+            misses = counters.get(name + " misses", 0)
+            if hits or misses:
+                lines.append("  {} {} hits, {} misses ({:.0%} hit rate)".format(name.capitalize(), hits, misses, hits / (hits + misses)))
+        if counters.get("peak texture memory"):
+            lines.append("  Peak texture memory {:.1f} MB, freed {:.1f} MB of image buffers".format(
+                counters["peak texture memory"] / (1024 * 1024), counters.get("evicted texture bytes", 0) / (1024 * 1024)))
+        if counters.get("identical textures merged"):
+            lines.append("  Merged {} identical textures".format(counters["identical textures merged"]))
+        slowest = self.get_slowest("decode")
+        if slowest:
+            lines.append("  Slowest textures:")
+            lines.extend("    {:.3f} s {}".format(seconds, item) for item, seconds in slowest)
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# Records the current import of this session
+recorder = Recorder()
+
+_local = threading.local()
+
+
+def _current():
+    return getattr(_local, "collector", None) or recorder
+
+
+@contextmanager
+def span(stage: str, item: str=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current().add(stage, time.perf_counter() - start, item)
+
+
+def count(name: str, value: int=1):
+    _current().count(name, value)
+
+
+def maximum(name: str, value: int):
+    """Record the largest value of a counter, like peak memory usage, in the main process"""
+    recorder.maximum(name, value)
+
+
+@contextmanager
+def collect() -> Iterator[_Collector]:
+    """Record the spans of this thread separately, for sending them from a worker to the main process"""
+    previous = getattr(_local, "collector", None)
+    _local.collector = _Collector()
+    try:
+        yield _local.collector
+    finally:
+        _local.collector = previous
+
+
+def begin(level: int=LEVEL_SUMMARY):
+    global log_level
+    log_level = level
+    recorder.reset()
+
+
+def end(timing_file: str=""):
+    """Log the summary of the import and optionally save the data as JSON"""
+    log(recorder.summary(), LEVEL_SUMMARY)
+    if timing_file:
+        try:
+            recorder.dump(timing_file)
+        except OSError as e:
+            log("Failed to write timing file {}: {}".format(timing_file, e), LEVEL_ERRORS)
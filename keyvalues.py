@@ -0,0 +1,101 @@
+# Minimal KeyValues parser for VMT files, with a cache of parsed files
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Union
+
+from . import content
+from . import instrument
+
+# Quoted string, brace, comment, bracketed text or an unquoted string. Bracketed text is a conditional
+# like [$WIN32] after a key/value pair, or an unquoted vector value like [1 0 0] where a value belongs.
+_TOKEN = re.compile(r'"([^"]*)"?|([{}])|//[^\n]*|(\[[^\]\n]*\])|([^\s{}"\[]+)')
+
+
+def parse(text: str) -> dict:
+    root = dict()
+    stack = [root]
+    key = None
+    bracket_key = None  # key of the last bracketed value, which is a conditional if a block follows
+    for match in _TOKEN.finditer(text):
+        quoted, brace, bracket, plain = match.groups()
+        if quoted is None and brace is None and bracket is None and plain is None:
+            # Comment
+            continue
+        if brace == "{":
+            if key is None and bracket_key is not None:
+                # "key" [$WIN32] { ... }
+                key = bracket_key
+                del stack[-1][key]
+            if key is None:
+                raise SyntaxError("KeyValues: Block without a key")
+            block = dict()
+            stack[-1][key] = block
+            stack.append(block)
+            key = None
+            bracket_key = None
+            continue
+        bracket_key = None
+        if brace == "}":
+            if len(stack) == 1:
+                raise SyntaxError("KeyValues: Unexpected }")
+            stack.pop()
+            key = None
+        elif bracket is not None:
+            if key is not None:
+                stack[-1][key] = bracket
+                bracket_key = key
+                key = None
+            # Otherwise a conditional after a complete pair, ignored
+        else:
+            token = quoted if quoted is not None else plain
+            if key is None:
+                key = token
+            else:
+                stack[-1][key] = token
+                key = None
+    if len(stack) != 1:
+        raise SyntaxError("KeyValues: Unexpected end of file")
+    return root
+
+
+# Parsed files of this session, keyed by path and validated with the identity of the file contents (see content.get_identity)
+_parsed = dict()  # type: Dict[str, tuple]
+
+
+def parse_file(path: Path) -> dict:
+    key = str(path)
+    identity = content.get_identity(path)
+    if identity is None:
+        raise FileNotFoundError("No such file: '{}'".format(key))
+    cached = _parsed.get(key)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    with instrument.span("parse", key):
+        # Also files in VPK archives, read without extracting them
+        text = bytes(content.read_bytes(path)).decode("utf-8-sig", errors="replace")
+        result = parse(text.replace("\r\n", "\n").replace("\r", "\n"))
+    _parsed[key] = (identity, result)
+    return result
+
+
+def parse_files(paths: Iterable[Path], workers: int=0) -> Dict[Path, Union[dict, Exception]]:
+    """Parse many files at once, reading them in a thread pool"""
+    paths = list(paths)
+    results = dict()
+
+    def parse_one(path):
+        try:
+            return parse_file(path)
+        except Exception as e:
+            return e
+
+    if workers == 1 or len(paths) < 2:
+        for path in paths:
+            results[path] = parse_one(path)
+        return results
+    with ThreadPoolExecutor(workers or content.IO_THREADS) as pool:
+        for path, result in zip(paths, pool.map(parse_one, paths)):
+            results[path] = result
+    return results
@@ -0,0 +1,86 @@
+# Memory budget of the texture pipeline, so large batch imports don't run out of memory.
+# Does not depend on Blender, the decoding side uses it from decode.py.
+
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from . import instrument
+
+MB = 1024 * 1024
+
+
+class MemoryBudget:
+    """Bytes held by decoded textures in flight and by evictable buffers, like the pixel buffers of imported images.
+    Evictable buffers are freed least recently used first when new data doesn't fit."""
+
+    def __init__(self, limit: int):
+        self.limit = limit  # bytes, 0 is unlimited
+        self.reserved = 0  # decoded textures waiting for upload
+        self.evictable = OrderedDict()  # key -> (bytes, free callback), least recently used first
+        self.evictable_bytes = 0
+        self.peak = 0
+        self.evicted = 0  # bytes
+
+    def begin(self, limit: int):
+        # Buffers tracked by an earlier import stay tracked, only the limit and statistics change
+        self.limit = limit
+        self.peak = self.used
+        self.evicted = 0
+        instrument.maximum("peak texture memory", self.peak)
+        if limit > 0:
+            while self.used > limit and self.evictable:
+                self._evict()
+
+    @property
+    def used(self) -> int:
+        return self.reserved + self.evictable_bytes
+
+    def _update_peak(self):
+        if self.used > self.peak:
+            self.peak = self.used
+            instrument.maximum("peak texture memory", self.peak)
+
+    def fits(self, size: int) -> bool:
+        """Whether size more bytes fit in the budget, after evicting buffers if needed"""
+        if self.limit <= 0:
+            return True
+        while self.used + size > self.limit and self.evictable:
+            self._evict()
+        return self.used + size <= self.limit
+
+    def reserve(self, size: int):
+        self.reserved += size
+        self._update_peak()
+
+    def release(self, size: int):
+        self.reserved -= size
+
+    def add(self, key: str, size: int, free: Callable[[], None]):
+        """Track a buffer that can be freed when the memory is needed for something else"""
+        self.remove(key)
+        self.evictable[key] = (size, free)
+        self.evictable_bytes += size
+        self._update_peak()
+        # Make room for what was just added, without evicting it
+        if self.limit > 0:
+            while self.used > self.limit and len(self.evictable) > 1:
+                self._evict()
+
+    def touch(self, key: str):
+        if key in self.evictable:
+            self.evictable.move_to_end(key)
+
+    def remove(self, key: str) -> Optional[int]:
+        item = self.evictable.pop(key, None)
+        if item is None:
+            return None
+        self.evictable_bytes -= item[0]
+        return item[0]
+
+    def _evict(self):
+        key, (size, free) = self.evictable.popitem(last=False)
+        self.evictable_bytes -= size
+        self.evicted += size
+        instrument.count("evicted texture bytes", size)
+        instrument.log("Memory: Freeing {:.1f} MB of {}".format(size / MB, key))
+        free()
@@ -1,19 +1,32 @@
 import bpy
 from pathlib import Path
-import os
+from typing import Iterator
 
-from .vmt import VMT
+from . import instrument
+from .vmt import VMT, Progress, find_duplicates, parse_vmts
+from .planner import BatchPlan
+from .cache import TextureCache
+from .content import get_index
 
 class ModelsMtl:
-    def __init__(self, materialpath: Path, textureext: str, texturepath: Path=None):
+    def __init__(self, materialpath: Path, textureext: str, texturepath: Path=None, workers: int=0, cache: TextureCache=None, index_directory: Path=None):
         self.materialpath = materialpath
         self.texturepath = texturepath or materialpath
         self.textureext = textureext
+        self.workers = workers
+        self.cache = cache if cache is not None else TextureCache()
+        self.index_directory = index_directory  # where the content indexes are saved, if any
         self.materials = dict()
 
 
-    def replace_materials(self, only_empty: bool=True, skip_crafty: bool=True, prefer_v: bool=True):
-        print("ModelsReplace: Replacing materials")
+    def replace_materials(self, only_empty: bool=True, skip_crafty: bool=True, prefer_v: bool=True, node_groups: bool=False, deduplicate: bool=False, skip_unchanged: bool=False):
+        for _ in self.iter_replace_materials(only_empty, skip_crafty, prefer_v, node_groups, deduplicate, skip_unchanged):
+            pass
+
+    def iter_replace_materials(self, only_empty: bool=True, skip_crafty: bool=True, prefer_v: bool=True, node_groups: bool=False, deduplicate: bool=False, skip_unchanged: bool=False) -> Iterator[Progress]:
+        """Replace the materials one step at a time, yielding the progress after every texture and material.
+        If the iteration is stopped early, the materials built so far are kept."""
+        instrument.log("ModelsReplace: Replacing materials")
         required_materials = dict()
         for material in bpy.data.materials:
             if only_empty and material.use_nodes:
@@ -21,27 +34,64 @@ class ModelsMtl:
             if skip_crafty and material.name.startswith('material_'):
                 continue
             required_materials[material.name.lower()] = material.name
-        print("ModelsReplace: {} materials to replace".format(len(required_materials)))
-        print("ModelsReplace: Looking for materials in {}".format(self.materialpath / "materials" / "models"))
-        for root, folders, files in os.walk(self.materialpath / "materials" / "models"):
-            # Ignore directories that don't contain proper textures
-            if "customization" in root or "gui" in root:
-                continue
-            for file in files:
-                file = Path(file)
-                if file.suffix == ".vmt" and file.stem.lower() in required_materials:
-                    print("ModelsReplace: Found material {}".format(file))
-                    name = required_materials[file.stem.lower()]
-                    root = Path(root)
+        instrument.log("ModelsReplace: {} materials to replace".format(len(required_materials)), instrument.LEVEL_SUMMARY)
+        instrument.log("ModelsReplace: Looking for materials in {}".format(self.materialpath / "materials" / "models"))
+        with instrument.span("resolve"):
+            index = get_index(self.materialpath, self.index_directory)
+            for relpath, path in index.iter_files("materials/models", ".vmt"):
+                reldir, _, file = relpath.rpartition("/")
+                # Ignore directories that don't contain proper textures
+                if "customization" in reldir or "gui" in reldir:
+                    continue
+                stem = file[:-len(".vmt")]
+                if stem in required_materials:
+                    instrument.log("ModelsReplace: Found material {}".format(path.name))
+                    name = required_materials[stem]
                     if name in self.materials:
-                        if prefer_v and 'v_models' in root.parts and 'w_models' in self.materials[name].parts:
-                            self.materials[name] = root / file
+                        if prefer_v and 'v_models' in reldir.split("/") and 'w_models' in self.materials[name][0].split("/"):
+                            self.materials[name] = (reldir, path)
                         else:
-                            print("ModelsReplace: ignoring multiple possible materials found for {}".format(name))
+                            instrument.log("ModelsReplace: ignoring multiple possible materials found for {}".format(name))
                     else:
-                        self.materials[name] = root / file
+                        self.materials[name] = (reldir, path)
+            texture_index = get_index(self.texturepath, self.index_directory)
+        failed = parse_vmts((path for _, path in self.materials.values()), self.workers)
+        vmts = dict()
         for name in self.materials:
-            mat_path = self.materials[name]
-            fullpath = self.materialpath / "materials" / "models" / mat_path
-            vmt = VMT(fullpath, self.textureext, self.texturepath)
-            vmt.make_material(name, True)
+            path = self.materials[name][1]
+            # Already logged, one broken file doesn't stop the others
+            if path not in failed:
+                vmts[name] = VMT(path, self.textureext, self.texturepath, self.cache, texture_index)
+        # Equivalent materials are only built once
+        duplicates = find_duplicates(vmts) if deduplicate else dict()
+        for name in duplicates:
+            del vmts[name]
+        unchanged = set()
+        if skip_unchanged:
+            # Imported before from the same VMT, textures and options
+            unchanged = set(name for name, vmt in vmts.items() if vmt.is_unchanged(name, node_groups))
+            for name in unchanged:
+                del vmts[name]
+            instrument.log("ModelsReplace: Skipping {} unchanged materials".format(len(unchanged)), instrument.LEVEL_SUMMARY)
+        # All textures are known before anything is imported
+        plan = BatchPlan(vmts, self.cache, self.workers)
+        plan.report()
+        built = set()
+
+        def build(name):
+            vmts[name].make_material(name, True, node_groups)
+            built.add(name)
+
+        try:
+            yield from plan.iter_execute(build)
+        finally:
+            # Also when cancelled, for the materials that were built
+            replaced = 0
+            for name, original in duplicates.items():
+                # The original is complete if it was built now or before
+                if original in built or original in unchanged:
+                    bpy.data.materials[name].user_remap(bpy.data.materials[original])
+                    replaced += 1
+            if replaced:
+                instrument.log("ModelsReplace: Replaced {} duplicate materials".format(replaced), instrument.LEVEL_SUMMARY)
+            instrument.log("ModelsReplace: Texture cache {} hits, {} misses".format(self.cache.hits, self.cache.misses))
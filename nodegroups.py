@@ -0,0 +1,145 @@
+# Materials built from shared node groups, so every material only contains image nodes and one group node
+
+import bpy
+import hashlib
+from pathlib import Path
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from . import instrument
+
+# Custom property identifying the inputs a group was built for
+SIGNATURE_PROPERTY = "vmt_signature"
+
+
+class MaterialInput(NamedTuple):
+    name: str  # texture slot, like "base" or "roughness"
+    socket: str  # Principled BSDF input
+    texture: Optional[str]  # texture node providing the data, None for a constant value
+    path: Optional[Path]
+    output: Optional[str]  # "rgb", "a" or a single channel
+    value: Optional[float]
+    baked: bool = False  # single channel already extracted and transformed at import
+
+
+def _get_texture_socket(texture: str, output: str) -> str:
+    return "{} {}".format(texture, "Alpha" if output == "a" else "Color")
+
+
+def get_signature(inputs: Iterable[MaterialInput]) -> str:
+    parts = []
+    for i in inputs:
+        if i.texture is None:
+            parts.append("{}=value".format(i.name))
+        else:
+            parts.append("{}={}.{}{}".format(i.name, i.texture, i.output, ".baked" if i.baked else ""))
+    return ";".join(parts)
+
+
+def _build_group(inputs: List[MaterialInput], signature: str) -> bpy.types.ShaderNodeTree:
+    name = "VMT Shader {}".format(hashlib.sha1(signature.encode("utf-8")).hexdigest()[:8])
+    group = bpy.data.node_groups.new(name, 'ShaderNodeTree')
+    group[SIGNATURE_PROPERTY] = signature
+    nodes = group.nodes
+    links = group.links
+    group.outputs.new('NodeSocketShader', 'BSDF')
+    group_out = nodes.new('NodeGroupOutput')
+    group_out.location = (300, 0)
+    group_in = nodes.new('NodeGroupInput')
+    group_in.location = (-1000, 0)
+    bsdf = nodes.new('ShaderNodeBsdfPrincipled')
+    bsdf.location = (0, 0)
+    links.new(bsdf.outputs['BSDF'], group_out.inputs['BSDF'])
+    bsdf.inputs['Specular'].default_value = 0.1
+    bsdf.inputs['Roughness'].default_value = 1.0
+    separatornodes = dict()
+    locationy = 300
+    for i in inputs:
+        if i.texture is None:
+            group.inputs.new('NodeSocketFloat', i.socket)
+            links.new(group_in.outputs[i.socket], bsdf.inputs[i.socket])
+            continue
+        socket = _get_texture_socket(i.texture, i.output)
+        if socket not in group.inputs:
+            group.inputs.new('NodeSocketFloat' if i.output == "a" or i.baked else 'NodeSocketColor', socket)
+        out = group_in.outputs[socket]
+        if not i.baked and i.output not in ("rgb", "a"):
+            # Need to get a single channel
+            separator = separatornodes.get(i.texture)
+            if separator is None:
+                separator = nodes.new('ShaderNodeSeparateRGB')
+                separator.location = (-750, locationy)
+                locationy -= 150
+                links.new(out, separator.inputs['Image'])
+                separatornodes[i.texture] = separator
+            out = separator.outputs[i.output.upper()]
+        if i.name == "normal":
+            normal = nodes.new("ShaderNodeNormalMap")
+            normal.location = (-500, locationy)
+            locationy -= 150
+            links.new(out, normal.inputs['Color'])
+            out = normal.outputs['Normal']
+        elif i.name == "roughness" and not i.baked:
+            # Inverted and multiplied by 0.5, see VMT.make_material
+            invert = nodes.new("ShaderNodeMath")
+            invert.operation = 'SUBTRACT'
+            invert.inputs[0].default_value = 1.0
+            invert.location = (-500, locationy)
+            links.new(out, invert.inputs[1])
+            multiply = nodes.new("ShaderNodeMath")
+            multiply.operation = 'MULTIPLY'
+            multiply.inputs[1].default_value = 0.5
+            multiply.location = (-250, locationy)
+            links.new(invert.outputs[0], multiply.inputs[0])
+            locationy -= 150
+            out = multiply.outputs[0]
+        links.new(out, bsdf.inputs[i.socket])
+    return group
+
+
+def get_group(inputs: List[MaterialInput]) -> bpy.types.ShaderNodeTree:
+    """Get the node group for a combination of inputs, creating it once per .blend file"""
+    signature = get_signature(inputs)
+    for group in bpy.data.node_groups:
+        if group.get(SIGNATURE_PROPERTY) == signature:
+            return group
+    instrument.log("VMT: Creating node group for {}".format(signature))
+    return _build_group(inputs, signature)
+
+
+def build_material(mat: bpy.types.Material, inputs: List[MaterialInput], load_image: Callable[[MaterialInput], Optional[bpy.types.Image]]):
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    nodes.clear()
+    images = dict()
+    for i in inputs:
+        if i.texture is not None and i.texture not in images:
+            images[i.texture] = load_image(i)
+    # Textures that failed to import are already logged. They are left out of the group,
+    # so the shader keeps its defaults like a material built without node groups.
+    inputs = [i for i in inputs if i.texture is None or images[i.texture] is not None]
+    out = nodes.new('ShaderNodeOutputMaterial')
+    out.location = (300, 0)
+    group = nodes.new('ShaderNodeGroup')
+    group.node_tree = get_group(inputs)
+    group.location = (0, 0)
+    links.new(group.outputs['BSDF'], out.inputs['Surface'])
+    texnodes = dict()
+    texnodelocationy = 300
+    for i in inputs:
+        if i.texture is None:
+            group.inputs[i.socket].default_value = i.value
+            continue
+        tex = texnodes.get(i.texture)
+        if tex is None:
+            tex = nodes.new('ShaderNodeTexImage')
+            tex.image = images[i.texture]
+            # Set to non-color data for other images than base color
+            tex.image.colorspace_settings.name = "sRGB" if i.texture == "base" else "Non-Color"
+            # Alpha channel has always seperate data
+            tex.image.alpha_mode = "CHANNEL_PACKED"
+            tex.location = (-400, texnodelocationy)
+            texnodelocationy -= 300
+            texnodes[i.texture] = tex
+        socket = _get_texture_socket(i.texture, i.output)
+        if not group.inputs[socket].is_linked:
+            links.new(tex.outputs['Alpha' if i.output == "a" else 'Color'], group.inputs[socket])
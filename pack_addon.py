@@ -1,7 +1,7 @@
 import os
 import zipfile
 
-ignore = ["__pycache__", ".vscode", ".git", ".gitignore", ".gitmodules", "install.sh", "pack_addon.py", "blender-vmt.zip"]
+ignore = ["__pycache__", ".vscode", ".git", ".gitignore", ".gitmodules", "install.sh", "pack_addon.py", "convert_textures.py", "benchmarks", "tests", "blender-vmt.zip"]
 
 relroot = os.path.abspath(os.path.join(".", os.pardir))
 with zipfile.ZipFile("blender-vmt.zip", "w", zipfile.ZIP_DEFLATED) as zip:
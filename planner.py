@@ -0,0 +1,80 @@
+# Batch imports in two phases: all materials are resolved and the unique textures they need are planned first,
+# then the textures are imported while the materials whose textures are ready are built
+
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Set
+
+from . import bake
+from . import instrument
+from .cache import TextureCache
+from .memory import MB
+from .vmt import VMT, Progress, get_texture_requests
+
+# I/O threads reading texture files ahead of the decoders
+READ_AHEAD_THREADS = 2
+
+
+class BatchPlan:
+    """Materials of a batch import and the textures each of them waits for"""
+
+    def __init__(self, vmts: Dict[str, VMT], cache: TextureCache, workers: int=0):
+        self.vmts = vmts
+        self.cache = cache
+        self.workers = workers
+        self.references = 0  # textures used by the materials, counting every use
+        self.waiting = dict()  # type: Dict[str, Set[str]]  # material -> keys of the textures it waits for
+        self.users = dict()  # type: Dict[str, List[str]]  # texture key -> materials waiting for it
+        with instrument.span("plan"):
+            requests = dict()
+            paths = set()
+            derived = set()
+            for name, vmt in vmts.items():
+                requests[name] = get_texture_requests(vmt, cache)
+                paths.update(requests[name][0])
+                derived.update(requests[name][1])
+                self.references += len(requests[name][0]) + len(requests[name][1])
+            self.textures = cache.plan_prefetch(paths, workers, derived)
+            pending = self.textures.keys
+            for name, (vmt_paths, vmt_derived) in requests.items():
+                keys = set(cache.get_key(path) for path in vmt_paths)
+                for path, channel, transform in vmt_derived:
+                    key = cache.get_key(path)
+                    keys.add(bake.get_key(key, channel, transform) if key else None)
+                keys &= pending
+                self.waiting[name] = keys
+                for key in keys:
+                    self.users.setdefault(key, []).append(name)
+
+    def report(self):
+        textures = self.textures
+        instrument.log("Plan: {} materials using {} textures, {} unique textures to import ({} from the pixel cache), {:.1f} MB to read, {:.1f} MB decoded".format(
+            len(self.vmts), self.references, textures.total, len(textures.cached),
+            sum(size for path, size in textures.file_sizes.items() if path not in textures.cached) / MB,
+            sum(textures.decoded_sizes.values()) / MB), instrument.LEVEL_SUMMARY)
+
+    def iter_execute(self, build: Callable[[str], None], read_ahead: int=READ_AHEAD_THREADS) -> Iterator[Progress]:
+        """Import the planned textures and build every material as soon as all of its textures are imported.
+        Yields the progress after every texture and material."""
+        ready = deque(name for name, keys in self.waiting.items() if not keys)
+        built = set()
+        textures_done = 0
+        textures_total = self.textures.total
+        for textures_done, textures_total, keys in self.cache.iter_run_prefetch(self.textures, self.workers, read_ahead):
+            yield Progress(textures_done, textures_total, len(built), len(self.vmts))
+            for key in keys:
+                for name in self.users.pop(key, ()):
+                    self.waiting[name].discard(key)
+                    if not self.waiting[name]:
+                        ready.append(name)
+            # The decoders keep working on the next textures meanwhile
+            while ready:
+                name = ready.popleft()
+                build(name)
+                built.add(name)
+                yield Progress(textures_done, textures_total, len(built), len(self.vmts))
+        # Materials without textures to import, when nothing was decoded
+        for name in self.vmts:
+            if name not in built:
+                build(name)
+                built.add(name)
+                yield Progress(textures_done, textures_total, len(built), len(self.vmts))
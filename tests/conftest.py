@@ -0,0 +1,45 @@
+# The modules are tested without Blender, with only the package path set up like in convert_textures.py.
+# The ones that need bpy use the stand-in of the benchmarks.
+
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PACKAGE = "blender_vmt"
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [str(ROOT)]
+    sys.modules[PACKAGE] = package
+
+
+@pytest.fixture
+def bpy():
+    """The bpy stand-in of the benchmarks with empty data, for testing the modules that need Blender"""
+    sys.path.insert(0, str(ROOT / "benchmarks"))
+    try:
+        import fakebpy
+    finally:
+        sys.path.remove(str(ROOT / "benchmarks"))
+    if "bpy" not in sys.modules:
+        # Installed once, the modules keep the one they imported
+        return fakebpy.install()
+    fakebpy.reset()
+    return sys.modules["bpy"]
+
+
+class _AddonDirectory:
+    """Collects the repository as a plain directory, as a package pytest would import the addon's __init__ which needs bpy"""
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collect_directory(self, path, parent):
+        if path == ROOT:
+            return pytest.Dir.from_parent(parent, path=path)
+        return None
+
+
+def pytest_configure(config):
+    config.pluginmanager.register(_AddonDirectory(), "blender_vmt_directory")
@@ -0,0 +1,47 @@
+import importlib
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def bake(bpy):
+    return importlib.import_module("blender_vmt.bake")
+
+
+PIXELS = np.array([[0, 51, 255, 10], [255, 102, 0, 20]], np.uint8).reshape(-1)
+
+
+def grayscale(*values):
+    return np.array([[value, value, value, 1] for value in values], np.float32).reshape(-1)
+
+
+@pytest.mark.parametrize("channel, expected", [("r", (0, 1)), ("g", (0.2, 0.4)), ("b", (1, 0))])
+def test_channels(bake, channel, expected):
+    np.testing.assert_allclose(bake.compute(PIXELS, channel), grayscale(*expected), atol=1e-6)
+
+
+def test_roughness(bake):
+    # (1 - x) * 0.5 like the math nodes of materials built without baking
+    np.testing.assert_allclose(bake.compute(PIXELS, "g", bake.TRANSFORM_ROUGHNESS), grayscale(0.4, 0.3), atol=1e-6)
+
+
+def test_float_pixels(bake):
+    pixels = PIXELS.astype(np.float32) / 255
+    np.testing.assert_allclose(bake.compute(pixels, "g", bake.TRANSFORM_ROUGHNESS), grayscale(0.4, 0.3), atol=1e-6)
+    # The input isn't changed
+    np.testing.assert_array_equal(pixels, PIXELS.astype(np.float32) / 255)
+
+
+def test_names(bake):
+    assert bake.get_transform("roughness") == bake.TRANSFORM_ROUGHNESS
+    assert bake.get_transform("specular") is None
+    assert bake.get_texture_name("phong", "g", bake.TRANSFORM_ROUGHNESS) == "phong_g_roughness"
+    assert bake.get_key("key", "r", None) != bake.get_key("key", "r", bake.TRANSFORM_ROUGHNESS)
+
+
+def test_bake_image(bpy, bake):
+    image = bake.bake_image("mask_g", 2, 1, PIXELS, "g")
+    assert tuple(image.size) == (2, 1)
+    assert image.colorspace_settings.name == "Non-Color"
+    assert image.packed_file is not None
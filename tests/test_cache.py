@@ -0,0 +1,24 @@
+import importlib
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def cache(bpy):
+    return importlib.import_module("blender_vmt.cache")
+
+
+def test_clear(bpy, cache):
+    textures = cache.get_cache(True, memory_budget=1)
+    image = bpy.data.images.new("a", 4, 4)
+    image.pack()
+    textures.add("key", image)
+    textures._fail(None, Path("missing.vtf"))
+    assert textures.budget.used == 64
+    textures.clear()
+    assert not textures.images and not textures.failed
+    assert textures.budget.used == 0
+    # Images of the new file are found again
+    assert cache.get_cache(True) is textures
+    assert textures.images == {"key": "a"}
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from blender_vmt import content, vpk
+from blender_vmt.content import ContentIndex
+
+
+@pytest.fixture(autouse=True)
+def indexes(monkeypatch):
+    monkeypatch.setattr(content, "_indexes", dict())
+    monkeypatch.setattr(vpk, "_archives", dict())
+
+
+def make_game(root):
+    for relpath in ("materials/Models/Props/Crate.vmt", "materials/models/props/crate.vtf", "materials/Brick/wall.VMT", "sound/a.wav"):
+        path = root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x")
+
+
+def touch_dir(path, mtime):
+    # Directory modification times can be too coarse to see a change right after listing
+    os.utime(str(path), ns=(mtime, mtime))
+
+
+def test_case_insensitive(tmp_path):
+    make_game(tmp_path)
+    index = ContentIndex(tmp_path)
+    index.refresh()
+    assert index.find("MATERIALS\\models\\props\\crate.vmt") == tmp_path / "materials/Models/Props/Crate.vmt"
+    assert index.find("/materials/brick/wall.vmt") == tmp_path / "materials/Brick/wall.VMT"
+    assert index.find("materials/missing.vmt") is None
+    # Only the materials are indexed
+    assert index.find("sound/a.wav") is None
+
+
+def test_iter_files(tmp_path):
+    make_game(tmp_path)
+    index = ContentIndex(tmp_path)
+    index.refresh()
+    assert sorted(relpath for relpath, _ in index.iter_files("materials/models", ".vmt")) == ["materials/models/props/crate.vmt"]
+    assert len(list(index.iter_files("Materials", ""))) == 3
+
+
+def test_refresh_lists_changed_directories(tmp_path):
+    make_game(tmp_path)
+    index = ContentIndex(tmp_path)
+    assert index.refresh()
+    assert not index.refresh()
+    props = tmp_path / "materials/Models/Props"
+    (props / "new.vmt").write_bytes(b"x")
+    touch_dir(props, props.stat().st_mtime_ns + 10 ** 9)
+    assert index.refresh()
+    assert index.find("materials/models/props/NEW.vmt") == props / "new.vmt"
+
+
+def test_saved_index(tmp_path):
+    game = tmp_path / "game"
+    cache_directory = tmp_path / "cache"
+    make_game(game)
+    index = content.get_index(game, cache_directory)
+    assert index.find("materials/brick/wall.vmt") is not None
+    loaded = ContentIndex(game)
+    assert loaded.load(cache_directory)
+    # Nothing changed since it was saved, so nothing is listed again
+    assert not loaded.refresh()
+    assert loaded.files == index.files
+
+
+def test_identity(tmp_path):
+    path = tmp_path / "a.vtf"
+    assert content.get_identity(path) is None
+    path.write_bytes(b"a")
+    identity = content.get_identity(path)
+    path.write_bytes(b"ab")
+    assert content.get_identity(path) not in (None, identity)
+
+
+def test_read_ahead_window(tmp_path):
+    paths = []
+    for i in range(10):
+        path = tmp_path / "{}.vtf".format(i)
+        path.write_bytes(b"x" * 100)
+        paths.append(path)
+    reader = content.ReadAhead(paths, 2, 3)
+    try:
+        assert list(reader._futures) == paths[:3]
+        reader.take(paths[1])
+        assert list(reader._futures) == [paths[0], paths[2], paths[3]]
+        # Taken before being read ahead, skipped
+        reader.take(paths[4])
+        reader.take(paths[0])
+        assert list(reader._futures) == [paths[2], paths[3], paths[5]]
+        for path in paths[2:4] + paths[5:]:
+            reader.take(path)
+        assert not reader._futures
+    finally:
+        reader.close()
+
+
+def test_index_file(tmp_path):
+    file = content.get_index_file(tmp_path / "cache", "index", "key")
+    content.save_index(file, 2, {"a": [1]})
+    assert content.load_index(file, 2) == {"version": 2, "a": [1]}
+    assert content.load_index(file, 1) is None
+    file.write_text("{")
+    assert content.load_index(file, 2) is None
+    assert not list((tmp_path / "cache").glob("*.tmp"))
@@ -0,0 +1,110 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from blender_vmt import convert, vpk
+from blender_vmt.decode import DecodedImage
+from blender_vmt.vtfnumpy import FLAG_EIGHTBITALPHA, FORMAT_BGRA8888
+
+# Bottom row first: red, green / blue, white with half alpha
+PIXELS = np.array([[255, 0, 0, 255], [0, 255, 0, 255], [0, 0, 255, 255], [255, 255, 255, 128]], np.uint8).reshape(-1)
+
+
+@pytest.fixture(autouse=True)
+def archives(monkeypatch):
+    monkeypatch.setattr(vpk, "_archives", dict())
+
+
+def read_png(data):
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks = dict()
+    pos = 8
+    while pos < len(data):
+        length, tag = struct.unpack_from(">I4s", data, pos)
+        chunk = data[pos + 8:pos + 8 + length]
+        assert struct.unpack_from(">I", data, pos + 8 + length)[0] == zlib.crc32(tag + chunk)
+        chunks[tag] = chunks.get(tag, b"") + chunk
+        pos += 12 + length
+    width, height, depth, color_type = struct.unpack_from(">IIBB", chunks[b"IHDR"])
+    channels = 4 if color_type == 6 else 3
+    rows = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), np.uint8).reshape(height, width * channels + 1)
+    assert not rows[:, 0].any()
+    return width, height, depth, rows[:, 1:].reshape(height, width, channels)
+
+
+@pytest.mark.parametrize("alpha", [True, False])
+def test_png(alpha):
+    width, height, depth, pixels = read_png(convert.encode_png(DecodedImage(2, 2, alpha, PIXELS)))
+    assert (width, height, depth) == (2, 2, 8)
+    # Top row first
+    expected = PIXELS.reshape(2, 2, 4)[::-1]
+    np.testing.assert_array_equal(pixels, expected if alpha else expected[:, :, :3])
+
+
+@pytest.mark.parametrize("alpha", [True, False])
+def test_tga(alpha):
+    data = convert.encode_tga(DecodedImage(2, 2, alpha, PIXELS))
+    image_type, width, height, bits, descriptor = struct.unpack_from("<2xB9xHHBB", data)
+    assert (image_type, width, height, bits, descriptor) == (2, 2, 2, 32 if alpha else 24, 8 if alpha else 0)
+    channels = 4 if alpha else 3
+    pixels = np.frombuffer(data[18:], np.uint8).reshape(2, 2, channels)
+    # Bottom row first, BGR(A)
+    np.testing.assert_array_equal(pixels, PIXELS.reshape(2, 2, 4)[:, :, [2, 1, 0, 3][:channels]])
+
+
+def write_vtf(path):
+    # Version 7.2, a single 2x2 BGRA8888 mipmap of PIXELS
+    header = struct.pack("<4s2IIHHIHH4x3f4xfiBiBB", b"VTF\0", 7, 2, 80, 2, 2, FLAG_EIGHTBITALPHA, 1, 0,
+                         0.5, 0.5, 0.5, 1.0, FORMAT_BGRA8888, 1, -1, 0, 0)
+    header = (header + struct.pack("<H", 1)).ljust(80, b"\0")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Stored from the top row
+    path.write_bytes(header + PIXELS.reshape(2, 2, 4)[::-1][:, :, [2, 1, 0, 3]].tobytes())
+
+
+def test_converter(tmp_path):
+    game = tmp_path / "game"
+    output = tmp_path / "out"
+    write_vtf(game / "materials/Models/a.vtf")
+    write_vtf(game / "materials/b.vtf")
+    converter = convert.Converter(game, output)
+    assert converter.convert(1) == 2
+    _, _, _, pixels = read_png((output / "materials/Models/a.png").read_bytes())
+    np.testing.assert_array_equal(pixels, PIXELS.reshape(2, 2, 4)[::-1])
+    manifest = json.loads((output / convert.MANIFEST_NAME).read_text())
+    assert manifest["files"]["materials/models/a.vtf"]["output"] == "materials/Models/a.png"
+    # Up to date, skipped
+    assert convert.Converter(game, output).convert(1) == 0
+    # Other settings convert again
+    assert convert.Converter(game, output, convert.FORMAT_TGA).convert(1) == 2
+    assert (output / "materials/b.tga").is_file()
+
+
+def test_converter_failed(tmp_path):
+    game = tmp_path / "game"
+    (game / "materials").mkdir(parents=True)
+    (game / "materials/broken.vtf").write_bytes(b"VTF\0")
+    converter = convert.Converter(game)
+    assert converter.convert(1) == 0
+    assert list(converter.failed) == ["materials/broken.vtf"]
+    # Not in the manifest, tried again next time
+    assert convert.Converter(game).convert(1) == 0
+
+
+def test_converter_prune(tmp_path):
+    game = tmp_path / "game"
+    write_vtf(game / "materials/a.vtf")
+    write_vtf(game / "materials/b.vtf")
+    assert convert.Converter(game).convert(1) == 2
+    (game / "materials/b.vtf").unlink()
+    (game / "materials/a.vtf").rename(game / "materials/c.vtf")
+    assert convert.Converter(game).convert(1) == 1
+    manifest = json.loads((game / convert.MANIFEST_NAME).read_text())
+    assert list(manifest["files"]) == ["materials/c.vtf"]
+    # Removed without converting anything
+    (game / "materials/c.vtf").unlink()
+    assert convert.Converter(game).convert(1) == 0
+    assert json.loads((game / convert.MANIFEST_NAME).read_text())["files"] == {}
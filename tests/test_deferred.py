@@ -0,0 +1,38 @@
+import importlib
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def deferred(bpy):
+    module = importlib.import_module("blender_vmt.deferred")
+    yield module
+    module.cancel_loaders()
+
+
+def start(bpy, deferred):
+    images = [deferred.make_placeholder(Path("missing{}.vtf".format(i))) for i in range(3)]
+    loader = deferred.BackgroundLoader(images, 1, backend="numpy")
+    loader.start()
+    assert bpy.app.timers.is_registered(loader._step)
+    return loader
+
+
+def test_cancel(bpy, deferred):
+    loader = start(bpy, deferred)
+    loader.cancel()
+    assert not bpy.app.timers.is_registered(loader._step)
+    assert loader not in deferred._loaders
+    loader._thread.join(5)
+    assert not loader._thread.is_alive()
+    # Left as placeholders
+    assert len(deferred.get_pending_images()) == 3
+
+
+def test_begin_cancels_loaders(bpy, deferred):
+    loader = start(bpy, deferred)
+    deferred.begin()
+    assert loader.cancelled
+    assert not deferred._loaders
+    assert not bpy.app.timers.is_registered(loader._step)
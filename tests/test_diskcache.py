@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+
+from blender_vmt.decode import DecodedImage
+from blender_vmt.diskcache import PixelCache
+
+
+def make_image(width, height, alpha, value=0):
+    pixels = np.full(width * height * 4, value, np.uint8)
+    return DecodedImage(width, height, alpha, pixels)
+
+
+def make_texture(directory, name, contents=b"vtf"):
+    path = directory / name
+    path.write_bytes(contents)
+    return path
+
+
+def test_round_trip(tmp_path):
+    cache = PixelCache(tmp_path / "cache", 1 << 20)
+    texture = make_texture(tmp_path, "a.vtf")
+    assert cache.get(texture) is None and not cache.contains(texture)
+    cache.put(texture, make_image(4, 2, True, 7))
+    assert cache.contains(texture)
+    decoded = cache.get(texture)
+    assert (decoded.width, decoded.height, decoded.alpha) == (4, 2, True)
+    assert np.array_equal(decoded.pixels, np.full(32, 7, np.uint8))
+
+
+def test_size_limited_entries_are_separate(tmp_path):
+    cache = PixelCache(tmp_path / "cache", 1 << 20)
+    texture = make_texture(tmp_path, "a.vtf")
+    cache.put(texture, make_image(4, 4, False), 2)
+    assert cache.get(texture) is None
+    assert cache.get(texture, 2).width == 4
+
+
+def test_changed_file_misses(tmp_path):
+    cache = PixelCache(tmp_path / "cache", 1 << 20)
+    texture = make_texture(tmp_path, "a.vtf")
+    cache.put(texture, make_image(2, 2, False))
+    texture.write_bytes(b"changed")
+    assert cache.get(texture) is None
+
+
+def test_missing_file(tmp_path):
+    cache = PixelCache(tmp_path / "cache", 1 << 20)
+    cache.put(tmp_path / "missing.vtf", make_image(2, 2, False))
+    assert cache.get(tmp_path / "missing.vtf") is None
+    assert not any((tmp_path / "cache").iterdir())
+
+
+def test_evicts_least_recently_used(tmp_path):
+    image = make_image(16, 16, False)
+    cache = PixelCache(tmp_path / "cache", 1 << 20)
+    textures = [make_texture(tmp_path, "{}.vtf".format(i), bytes([i])) for i in range(3)]
+    for i, texture in enumerate(textures):
+        cache.put(texture, image)
+    # Oldest access first: 1, 0, 2
+    files = {texture: next((tmp_path / "cache").glob(PixelCache.get_key(texture) + "-*")) for texture in textures}
+    for texture, mtime in zip(textures, (2000, 1000, 3000)):
+        os.utime(str(files[texture]), (mtime, mtime))
+    entry_size = files[textures[0]].stat().st_size
+    # Room for three entries, the fourth evicts the least recently used one
+    cache = PixelCache(tmp_path / "cache", 3 * entry_size)
+    cache.put(make_texture(tmp_path, "3.vtf", b"\3"), image)
+    assert [cache.contains(texture) for texture in textures] == [True, False, True]
+    # Reading counts as an access
+    cache.get(textures[0])
+    cache.put(make_texture(tmp_path, "4.vtf", b"\4"), image)
+    assert [cache.contains(texture) for texture in textures] == [True, False, False]
@@ -0,0 +1,39 @@
+import pytest
+
+from blender_vmt import keyvalues
+
+
+def test_quoted_and_unquoted():
+    data = keyvalues.parse('"VertexLitGeneric"\n{\n\t"$basetexture" "models/a/b"\n\t$phong 1\n\t$surfaceprop metal\n}\n')
+    assert data == {"VertexLitGeneric": {"$basetexture": "models/a/b", "$phong": "1", "$surfaceprop": "metal"}}
+
+
+def test_comments():
+    data = keyvalues.parse('LightmappedGeneric // shader\n{\n// "$basetexture" "x"\n$basetexture y // texture\n}')
+    assert data == {"LightmappedGeneric": {"$basetexture": "y"}}
+
+
+def test_nested_blocks():
+    data = keyvalues.parse('Patch { include "materials/a.vmt" replace { $color2 "[1 1 1]" } }')
+    assert data == {"Patch": {"include": "materials/a.vmt", "replace": {"$color2": "[1 1 1]"}}}
+
+
+def test_conditional_after_pair():
+    data = keyvalues.parse('VertexLitGeneric\n{\n$envmap env_cubemap [$WIN32]\n"$bumpmap" "a/b_normal" [!$X360]\n}')
+    assert data == {"VertexLitGeneric": {"$envmap": "env_cubemap", "$bumpmap": "a/b_normal"}}
+
+
+def test_conditional_block():
+    data = keyvalues.parse('VertexLitGeneric\n{\n$basetexture a\n"Proxies" [$WIN32]\n{\n"Sine" { }\n}\n}')
+    assert data == {"VertexLitGeneric": {"$basetexture": "a", "Proxies": {"Sine": {}}}}
+
+
+def test_bracket_values():
+    data = keyvalues.parse('VertexLitGeneric\n{\n$color [1 0 0]\n$phongfresnelranges [0.5 1 2] [$WIN32]\n$alpha 1\n}')
+    assert data == {"VertexLitGeneric": {"$color": "[1 0 0]", "$phongfresnelranges": "[0.5 1 2]", "$alpha": "1"}}
+
+
+@pytest.mark.parametrize("text", ['VertexLitGeneric\n{\n$alpha 1\n', 'VertexLitGeneric\n}', '{ $alpha 1 }'])
+def test_invalid(text):
+    with pytest.raises(SyntaxError):
+        keyvalues.parse(text)
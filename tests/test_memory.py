@@ -0,0 +1,71 @@
+from blender_vmt.memory import MemoryBudget
+
+
+def make_buffer(budget, freed, key, size):
+    budget.add(key, size, lambda: freed.append(key))
+
+
+def test_unlimited():
+    budget = MemoryBudget(0)
+    freed = []
+    for i in range(10):
+        make_buffer(budget, freed, str(i), 1000)
+    assert budget.fits(10 ** 9)
+    assert budget.used == 10000 and budget.peak == 10000
+    assert freed == []
+
+
+def test_evicts_least_recently_used():
+    budget = MemoryBudget(300)
+    freed = []
+    for key in "abc":
+        make_buffer(budget, freed, key, 100)
+    budget.touch("a")
+    assert budget.fits(100)
+    assert freed == ["b"]
+    assert budget.evicted == 100
+    assert budget.used == 200
+
+
+def test_add_makes_room_without_evicting_itself():
+    budget = MemoryBudget(250)
+    freed = []
+    make_buffer(budget, freed, "a", 100)
+    make_buffer(budget, freed, "b", 100)
+    make_buffer(budget, freed, "c", 100)
+    assert freed == ["a"]
+    make_buffer(budget, freed, "d", 1000)
+    # Larger than the budget on its own, kept anyway
+    assert freed == ["a", "b", "c"]
+    assert list(budget.evictable) == ["d"]
+
+
+def test_reserved_is_not_evicted():
+    budget = MemoryBudget(200)
+    freed = []
+    make_buffer(budget, freed, "a", 100)
+    budget.reserve(150)
+    assert not budget.fits(100)
+    assert freed == ["a"]
+    assert budget.peak == 250
+    budget.release(150)
+    assert budget.used == 0 and budget.fits(200)
+
+
+def test_remove():
+    budget = MemoryBudget(0)
+    freed = []
+    make_buffer(budget, freed, "a", 100)
+    assert budget.remove("a") == 100
+    assert budget.remove("a") is None
+    assert budget.used == 0 and freed == []
+
+
+def test_begin_keeps_buffers_and_applies_new_limit():
+    budget = MemoryBudget(0)
+    freed = []
+    for key in "abc":
+        make_buffer(budget, freed, key, 100)
+    budget.begin(150)
+    assert freed == ["a", "b"]
+    assert budget.used == 100 and budget.peak == 300 and budget.evicted == 200
@@ -0,0 +1,56 @@
+import importlib
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def nodegroups(bpy):
+    return importlib.import_module("blender_vmt.nodegroups")
+
+
+def make_inputs():
+    from blender_vmt.nodegroups import MaterialInput
+    return [
+        MaterialInput("base", "Base Color", "base", Path("base.vtf"), "rgb", None),
+        MaterialInput("alpha", "Alpha", "base", Path("base.vtf"), "a", None),
+        MaterialInput("roughness", "Roughness", "roughness_g", Path("mask.vtf"), "g", None, True),
+        MaterialInput("normal", "Normal", "normal", Path("normal.vtf"), "rgb", None),
+        MaterialInput("specular", "Specular", None, None, None, 0.5),
+    ]
+
+
+def build(bpy, nodegroups, failed):
+    mat = bpy.data.materials.new("material")
+    mat.use_nodes = True
+
+    def load_image(i):
+        return None if i.path.name in failed else bpy.data.images.new(i.path.stem, 4, 4)
+
+    nodegroups.build_material(mat, make_inputs(), load_image)
+    group = next(node for node in mat.node_tree.nodes if node.type == 'GROUP')
+    return mat, group.node_tree
+
+
+def test_all_textures(bpy, nodegroups):
+    mat, group = build(bpy, nodegroups, ())
+    assert group[nodegroups.SIGNATURE_PROPERTY] == nodegroups.get_signature(make_inputs())
+    assert sum(1 for node in mat.node_tree.nodes if node.type == 'TEX_IMAGE') == 3
+    assert any(node.bl_idname == "ShaderNodeNormalMap" for node in group.nodes)
+
+
+def test_failed_textures_left_out(bpy, nodegroups):
+    mat, group = build(bpy, nodegroups, ("base.vtf", "mask.vtf", "normal.vtf"))
+    # Only the constant is left, the shader keeps its defaults like Alpha 1 and Roughness 1
+    assert group[nodegroups.SIGNATURE_PROPERTY] == "specular=value"
+    assert not any(node.type == 'TEX_IMAGE' for node in mat.node_tree.nodes)
+    assert not any(node.bl_idname == "ShaderNodeNormalMap" for node in group.nodes)
+    for socket in ("base Alpha", "roughness_g Color", "normal Color"):
+        assert socket not in group.inputs
+
+
+def test_failed_texture_uses_own_group(bpy, nodegroups):
+    _, complete = build(bpy, nodegroups, ())
+    _, partial = build(bpy, nodegroups, ("normal.vtf",))
+    assert partial is not complete
+    assert "normal" not in partial[nodegroups.SIGNATURE_PROPERTY]
@@ -0,0 +1,131 @@
+import struct
+import zlib
+
+import pytest
+
+from blender_vmt import vpk
+
+FILES = {
+    # path -> (bytes preloaded in the directory file, archive the rest is stored in)
+    "materials/models/a/base.vmt": (None, vpk.DIR_ARCHIVE),
+    "materials/models/a/base.vtf": (0, 0),
+    "materials/models/a/Normal.vtf": (16, vpk.DIR_ARCHIVE),
+    "materials/models/b/split.vtf": (16, 0),
+    "materials/readme": (0, 0),
+    "sound/ignored.wav": (0, 0),
+}
+
+
+def make_contents(path):
+    return (path * 20).encode("utf-8")
+
+
+def write_archive(directory):
+    """Version 2 archive of FILES, with a pak01_000.vpk data file"""
+    tree = dict()  # extension -> directory -> [(name, path)]
+    for path in FILES:
+        folder, _, file = path.rpartition("/")
+        name, dot, extension = file.rpartition(".")
+        if not dot:
+            name, extension = file, " "
+        tree.setdefault(extension, dict()).setdefault(folder, []).append((name, path))
+    data = bytearray()
+    dir_data = bytearray()
+    encoded = bytearray()
+    for extension, folders in tree.items():
+        encoded += extension.encode() + b"\0"
+        for folder, names in folders.items():
+            encoded += folder.encode() + b"\0"
+            for name, path in names:
+                contents = make_contents(path)
+                preload, archive = FILES[path]
+                if preload is None:
+                    preload = len(contents)
+                rest = contents[preload:]
+                target = dir_data if archive == vpk.DIR_ARCHIVE else data
+                encoded += name.encode() + b"\0"
+                encoded += struct.pack("<IHHIIH", zlib.crc32(contents), preload, archive, len(target), len(rest), 0xffff)
+                encoded += contents[:preload]
+                target += rest
+            encoded += b"\0"
+        encoded += b"\0"
+    encoded += b"\0"
+    path = directory / "pak01_dir.vpk"
+    path.write_bytes(struct.pack("<3I", vpk.SIGNATURE, 2, len(encoded)) + struct.pack("<4I", len(dir_data), 0, 0, 0) + bytes(encoded) + bytes(dir_data))
+    (directory / "pak01_000.vpk").write_bytes(bytes(data))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def archives(monkeypatch):
+    monkeypatch.setattr(vpk, "_archives", dict())
+
+
+def test_read(tmp_path):
+    archive = vpk.VpkArchive(write_archive(tmp_path))
+    archive.read_directory()
+    expected = {path for path in FILES if path.startswith("materials/")}
+    assert set(real for _, real in archive.iter_files()) == expected
+    for path in expected:
+        entry = archive.get_entry(path.upper())
+        contents = make_contents(path)
+        assert entry.size == len(contents)
+        assert bytes(archive.read(entry)) == contents
+        # Only the start, across the preloaded bytes
+        assert bytes(archive.read(entry, 20)) == contents[:20]
+
+
+def test_subdirs(tmp_path):
+    archive = vpk.VpkArchive(write_archive(tmp_path), ())
+    archive.read_directory()
+    assert archive.get_entry("sound/ignored.wav") is not None
+
+
+def test_invalid_signature(tmp_path):
+    path = tmp_path / "pak01_dir.vpk"
+    path.write_bytes(struct.pack("<3I", 0, 2, 0))
+    with pytest.raises(Exception, match="Invalid signature"):
+        vpk.VpkArchive(path).read_directory()
+
+
+def test_saved_index(tmp_path):
+    path = write_archive(tmp_path)
+    cache_directory = tmp_path / "cache"
+    read = vpk.mount(path, ("materials",), cache_directory)
+    loaded = vpk.VpkArchive(path)
+    assert loaded.load(cache_directory)
+    assert set(loaded.files) == set(read.files)
+    entry = loaded.get_entry("materials/models/b/split.vtf")
+    assert bytes(loaded.read(entry)) == make_contents("materials/models/b/split.vtf")
+    # Changed since, read again
+    path.write_bytes(path.read_bytes() + b"\0")
+    assert not vpk.VpkArchive(path).load(cache_directory)
+
+
+def test_find(tmp_path):
+    path = write_archive(tmp_path)
+    # Mounted on first use
+    archive, entry = vpk.find(path / "materials/models/a/normal.vtf")
+    assert archive.path == path
+    assert bytes(archive.read(entry)) == make_contents("materials/models/a/Normal.vtf")
+    assert vpk.find(path / "materials/models/a/missing.vtf") is None
+    assert vpk.find(tmp_path / "materials/models/a/base.vtf") is None
+
+
+def test_remount_closes(tmp_path):
+    path = write_archive(tmp_path)
+    archive, entry = vpk.find(path / "materials/models/a/base.vtf")
+    data = bytes(archive.read(entry))
+    old_maps = list(archive._maps.values())
+    # Changed since, mounted again and the old maps closed
+    path.write_bytes(path.read_bytes() + b"\0")
+    mounted = vpk.mount(path)
+    assert mounted is not archive
+    assert all(m.closed for m in old_maps)
+    # Still readable, mapped again
+    assert bytes(archive.read(entry)) == data
+    mounted.read(mounted.get_entry("materials/models/a/base.vtf"))
+    maps = list(mounted._maps.values())
+    vpk.unmount_all()
+    assert not vpk._archives
+    assert maps and all(m.closed for m in maps)
@@ -0,0 +1,145 @@
+import struct
+
+import numpy as np
+import pytest
+
+from blender_vmt import decode, vtfnumpy
+from blender_vmt.vtfnumpy import FLAG_EIGHTBITALPHA, FORMAT_BGR888, FORMAT_BGRA8888, FORMAT_DXT1, FORMAT_DXT5
+
+_HEADER = struct.Struct("<4s2IIHHIHH4x3f4xfiBiBB")
+HEADER_SIZE = 80
+
+BYTES_PER_BLOCK = {FORMAT_DXT1: 8, FORMAT_DXT5: 16}
+BYTES_PER_PIXEL = {FORMAT_BGR888: 3, FORMAT_BGRA8888: 4}
+
+
+def get_size(image_format, width, height):
+    if image_format in BYTES_PER_BLOCK:
+        return ((width + 3) // 4) * ((height + 3) // 4) * BYTES_PER_BLOCK[image_format]
+    return width * height * BYTES_PER_PIXEL[image_format]
+
+
+def vtflib_available():
+    try:
+        decode._get_vtf_lib()
+    except Exception:
+        return False
+    return True
+
+
+def make_vtf(image_format, width, height, seed=0):
+    """Version 7.2 file with a full mipmap chain of random data, and the data of each mipmap, largest first"""
+    mipmap_count = max(width, height).bit_length()
+    header = _HEADER.pack(b"VTF\0", 7, 2, HEADER_SIZE, width, height, FLAG_EIGHTBITALPHA, 1, 0,
+                          0.5, 0.5, 0.5, 1.0, image_format, mipmap_count, -1, 0, 0)
+    header = (header + struct.pack("<H", 1)).ljust(HEADER_SIZE, b"\0")
+    rng = np.random.default_rng(seed)
+    mipmaps = [rng.integers(0, 256, get_size(image_format, max(1, width >> level), max(1, height >> level)), np.uint8).tobytes()
+               for level in range(mipmap_count)]
+    return header + b"".join(reversed(mipmaps)), mipmaps
+
+
+def unpack_565(color):
+    r, g, b = (color >> 11) & 0x1f, (color >> 5) & 0x3f, color & 0x1f
+    return [(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)]
+
+
+def color_block(block, four_colors):
+    c0, c1, bits = struct.unpack("<HHI", block)
+    rgb0, rgb1 = unpack_565(c0), unpack_565(c1)
+    if four_colors or c0 > c1:
+        palette = [rgb0 + [255], rgb1 + [255],
+                   [(2 * a + b) // 3 for a, b in zip(rgb0, rgb1)] + [255],
+                   [(a + 2 * b) // 3 for a, b in zip(rgb0, rgb1)] + [255]]
+    else:
+        palette = [rgb0 + [255], rgb1 + [255], [(a + b) // 2 for a, b in zip(rgb0, rgb1)] + [255], [0, 0, 0, 0]]
+    return [list(palette[(bits >> (2 * i)) & 3]) for i in range(16)]
+
+
+def alpha_block(block):
+    a0, a1 = block[0], block[1]
+    bits = int.from_bytes(block[2:8], "little")
+    if a0 > a1:
+        palette = [a0, a1] + [((8 - i) * a0 + (i - 1) * a1) // 7 for i in range(2, 8)]
+    else:
+        palette = [a0, a1] + [((6 - i) * a0 + (i - 1) * a1) // 5 for i in range(2, 6)] + [0, 255]
+    return [palette[(bits >> (3 * i)) & 7] for i in range(16)]
+
+
+def reference_decode(image_format, data, width, height):
+    """Pixel by pixel decoder, rows from top to bottom"""
+    rows = [[None] * width for _ in range(height)]
+    if image_format in BYTES_PER_BLOCK:
+        block_size = BYTES_PER_BLOCK[image_format]
+        blocks_x = (width + 3) // 4
+        for index in range(len(data) // block_size):
+            block = data[index * block_size:(index + 1) * block_size]
+            if image_format == FORMAT_DXT5:
+                pixels = color_block(block[8:], True)
+                for pixel, alpha in zip(pixels, alpha_block(block)):
+                    pixel[3] = alpha
+            else:
+                pixels = color_block(block, False)
+            for i, pixel in enumerate(pixels):
+                x = index % blocks_x * 4 + i % 4
+                y = index // blocks_x * 4 + i // 4
+                if x < width and y < height:
+                    rows[y][x] = pixel
+    else:
+        size = BYTES_PER_PIXEL[image_format]
+        for y in range(height):
+            for x in range(width):
+                b, g, r = data[(y * width + x) * size:(y * width + x) * size + 3]
+                a = data[(y * width + x) * size + 3] if size == 4 else 255
+                rows[y][x] = [r, g, b, a]
+    return rows
+
+
+def flatten(rows):
+    # Blender images start from the bottom row
+    return np.array([value for row in reversed(rows) for pixel in row for value in pixel], np.uint8)
+
+
+@pytest.mark.parametrize("image_format", [FORMAT_DXT1, FORMAT_DXT5, FORMAT_BGR888, FORMAT_BGRA8888])
+@pytest.mark.parametrize("width, height", [(16, 8), (8, 8), (4, 4)])
+def test_decode_matches_reference(image_format, width, height):
+    data, mipmaps = make_vtf(image_format, width, height)
+    decoded_width, decoded_height, alpha, pixels = vtfnumpy.decode_vtf_data(data)
+    assert (decoded_width, decoded_height, alpha) == (width, height, True)
+    assert np.array_equal(pixels, flatten(reference_decode(image_format, mipmaps[0], width, height)))
+
+
+@pytest.mark.parametrize("image_format", [FORMAT_DXT1, FORMAT_BGR888])
+def test_decode_mipmap(image_format):
+    data, mipmaps = make_vtf(image_format, 32, 16, seed=1)
+    width, height, _, pixels = vtfnumpy.decode_vtf_data(data, max_size=8)
+    assert (width, height) == (8, 4)
+    assert np.array_equal(pixels, flatten(reference_decode(image_format, mipmaps[2], 8, 4)))
+
+
+def test_header():
+    data, _ = make_vtf(FORMAT_DXT5, 16, 8)
+    header = vtfnumpy.read_header(data)
+    assert (header.width, header.height, header.image_format, header.mipmap_count) == (16, 8, FORMAT_DXT5, 5)
+    assert header.alpha and header.faces == 1
+
+
+def test_truncated():
+    data, _ = make_vtf(FORMAT_DXT1, 16, 16)
+    with pytest.raises(Exception, match="Unexpected end of file"):
+        vtfnumpy.decode_vtf_data(data[:-1])
+
+
+def test_invalid_signature():
+    data, _ = make_vtf(FORMAT_DXT1, 4, 4)
+    with pytest.raises(Exception, match="Invalid signature"):
+        vtfnumpy.read_header(b"XTF\0" + data[4:])
+
+
+@pytest.mark.skipif(not vtflib_available(), reason="VTFLib can't be loaded")
+@pytest.mark.parametrize("image_format", [FORMAT_DXT1, FORMAT_DXT5, FORMAT_BGR888, FORMAT_BGRA8888])
+def test_matches_vtflib(image_format, tmp_path):
+    data, _ = make_vtf(image_format, 16, 8)
+    path = tmp_path / "texture.vtf"
+    path.write_bytes(data)
+    assert decode.compare_backends(path) == 0
@@ -1,87 +1,238 @@
 # Slightly inspired by https://github.com/Ganonmaster/io_texture_VTF/blob/blender280/vmt.py
 
 import bpy
-from pathlib import Path
+import os
+import hashlib
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
-from .libraries import vdf
-from . import vtf
+from . import bake
+from . import deferred
+from . import instrument
+from . import keyvalues
+from . import nodegroups
+from .nodegroups import MaterialInput
+from .cache import TextureCache
+from .content import ContentIndex, get_identity, normalize
+
+# Custom properties of imported materials, so unchanged materials can be skipped when importing again
+SOURCE_PROPERTY = "vmt_source"
+FINGERPRINT_PROPERTY = "vmt_fingerprint"
+# Changes when materials are built differently, so they are all built again
+FINGERPRINT_VERSION = 1
+
+
+class Progress(NamedTuple):
+    """Progress of a batch import, yielded after every step so the import can be run in slices.
+    Textures and materials are imported interleaved, so both are counted in every step."""
+    textures_done: int
+    textures_total: int
+    materials_done: int
+    materials_total: int
 
 
 class VMT:
     def _get_root_path(self, path: Path):
-        if path.parts[-1] == 'materials':
+        if path.parts[-1].lower() == 'materials':
             return path.parent
         else:
             return self._get_root_path(path.parent)
 
-    def __init__(self, filepath: Path, textureext: str, texturepath: Path=None):
+    def __init__(self, filepath: Path, textureext: str, texturepath: Path=None, cache: TextureCache=None, index: ContentIndex=None):
         self.filepath = Path(filepath)
         self.textureext = textureext
         self.convert = textureext == ".vtf"
         if not texturepath:
             texturepath = self._get_root_path(self.filepath)
         self.texturepath = texturepath
-        print("VMT: Parsing VMT file {}".format(filepath))
-        kv = vdf.parse(open(filepath), escaped=False)
+        self.index = index  # of the texture path, for case-insensitive lookups
+        instrument.log("VMT: Parsing VMT file {}".format(filepath))
+        kv = keyvalues.parse_file(self.filepath)
         self.shader = next(iter(kv))
         self.shader_data = kv[self.shader]
         self.texture_files = dict()  # tuples, if first is string, then refers another member
         self.texture_consts = dict() # const values that override textures
         self.texture_defaults = dict() # const values that are overridden by textures
-        self.images = dict()
+        self.cache = cache if cache is not None else TextureCache()  # can be shared between materials
         self.blend_method = "OPAQUE"
         self.shadow_method = "OPAQUE"
         for param, value in self.shader_data.items():
-            param = param.lower()  # ignore case
-            # Handle supported texture parameters
-            if param == "$basetexture":
-                self.texture_files['base'] = (self.get_text_file(value), "rgb")
-            elif (param == "$translucent") and int(value) == 1:
-                self.blend_method = "BLEND"
-                self.shadow_method = "CLIP"
-                self.texture_files['alpha'] = ("base", "a")
-            elif (param == "$alphatest") and int(value) == 1:
-                self.blend_method = "CLIP"
-                self.shadow_method = "CLIP"
-                self.texture_files['alpha'] = ("base", "a")
-            elif (param == "$basemapalphaphongmask" or param == "$basemapalphaenvmapmask") and int(value) == 1:
-                self.texture_files['specular'] = ("base", "a")
-            elif param == "$bumpmap":
-                self.texture_files['normal'] = (self.get_text_file(value), "rgb")
-                if 'specular' not in self.texture_files:
-                    self.texture_files['specular'] = ("normal", "a")
-            elif param == "$phong" and int(value) == 1:
-                # Estimate for source-like appearance
-                self.texture_defaults['roughness'] = 0.3
-                self.texture_defaults['specular'] = 0.5
-            elif param == "$phongexponent":
-                # Roughness needs to be inverted and converted to float
-                # Source range 0-255 is approx blender range 0.5-0
-                # Overrides textures, so goes to consts
-                self.texture_consts['roughness'] = (255 - int(value)) / 510
-            elif param == "$phongexponenttexture":
-                self.texture_files['roughness'] = (self.get_text_file(value), "r")
-            elif param == "$phongalbedotint" and int(value) == 1:
-                self.texture_files['specular_tint'] = ("roughness", "g")
-            elif param == "$envmap":
-                # Envmap probably means clearer reflections than phong
-                self.texture_defaults['roughness'] = 0.1
-                self.texture_defaults['specular'] = 0.7
-            elif param == "$envmapmask":
-                self.texture_files['specular'] = (self.get_text_file(value), "rgb")
-            elif param == "$selfillum" and int(value) == 1:
-                if 'emission' not in self.texture_files:
-                    self.texture_files['emission'] = ("base", "a")
-            elif param == "$selfillummask":
-                self.texture_files['emission'] = (self.get_text_file(value), "rgb")
+            # Handle supported texture parameters, ignoring case
+            handler = self._parameters.get(param.lower())
+            if handler is not None:
+                handler(self, value)
+
+    def _basetexture(self, value: str):
+        self.texture_files['base'] = (self.get_text_file(value), "rgb")
+
+    def _translucent(self, value: str):
+        if int(value) == 1:
+            self.blend_method = "BLEND"
+            self.shadow_method = "CLIP"
+            self.texture_files['alpha'] = ("base", "a")
+
+    def _alphatest(self, value: str):
+        if int(value) == 1:
+            self.blend_method = "CLIP"
+            self.shadow_method = "CLIP"
+            self.texture_files['alpha'] = ("base", "a")
+
+    def _basemapalphamask(self, value: str):
+        if int(value) == 1:
+            self.texture_files['specular'] = ("base", "a")
+
+    def _bumpmap(self, value: str):
+        self.texture_files['normal'] = (self.get_text_file(value), "rgb")
+        if 'specular' not in self.texture_files:
+            self.texture_files['specular'] = ("normal", "a")
+
+    def _phong(self, value: str):
+        if int(value) == 1:
+            # Estimate for source-like appearance
+            self.texture_defaults['roughness'] = 0.3
+            self.texture_defaults['specular'] = 0.5
+
+    def _phongexponent(self, value: str):
+        # Roughness needs to be inverted and converted to float
+        # Source range 0-255 is approx blender range 0.5-0
+        # Overrides textures, so goes to consts
+        self.texture_consts['roughness'] = (255 - int(value)) / 510
+
+    def _phongexponenttexture(self, value: str):
+        self.texture_files['roughness'] = (self.get_text_file(value), "r")
+
+    def _phongalbedotint(self, value: str):
+        if int(value) == 1:
+            self.texture_files['specular_tint'] = ("roughness", "g")
+
+    def _envmap(self, value: str):
+        # Envmap probably means clearer reflections than phong
+        self.texture_defaults['roughness'] = 0.1
+        self.texture_defaults['specular'] = 0.7
+
+    def _envmapmask(self, value: str):
+        self.texture_files['specular'] = (self.get_text_file(value), "rgb")
+
+    def _selfillum(self, value: str):
+        if int(value) == 1:
+            if 'emission' not in self.texture_files:
+                self.texture_files['emission'] = ("base", "a")
+
+    def _selfillummask(self, value: str):
+        self.texture_files['emission'] = (self.get_text_file(value), "rgb")
+
+    _parameters = {
+        "$basetexture": _basetexture,
+        "$translucent": _translucent,
+        "$alphatest": _alphatest,
+        "$basemapalphaphongmask": _basemapalphamask,
+        "$basemapalphaenvmapmask": _basemapalphamask,
+        "$bumpmap": _bumpmap,
+        "$phong": _phong,
+        "$phongexponent": _phongexponent,
+        "$phongexponenttexture": _phongexponenttexture,
+        "$phongalbedotint": _phongalbedotint,
+        "$envmap": _envmap,
+        "$envmapmask": _envmapmask,
+        "$selfillum": _selfillum,
+        "$selfillummask": _selfillummask,
+    }
 
     def get_text_file(self, name: str) -> Path:
-        path = self.texturepath / "materials" / name
-        return path.with_suffix(self.textureext)
+        with instrument.span("resolve"):
+            if self.index is not None:
+                relpath = PurePosixPath("materials", normalize(name)).with_suffix(self.textureext)
+                path = self.index.find(str(relpath))
+                if path is not None:
+                    return path
+            path = self.texturepath / "materials" / name
+            return path.with_suffix(self.textureext)
+
+    def get_signature(self) -> str:
+        """Normalized description of the material, equal for VMTs that would create identical materials"""
+        files = []
+        for name, (filepath, out_type) in self.texture_files.items():
+            if isinstance(filepath, Path):
+                filepath = os.path.normcase(os.path.abspath(str(filepath)))
+            files.append((name, filepath, out_type))
+        return repr((
+            sorted(files),
+            sorted(self.texture_consts.items()),
+            sorted(self.texture_defaults.items()),
+            self.blend_method,
+            self.shadow_method,
+        ))
+
+    def get_fingerprint(self, node_groups: bool=False) -> str:
+        """Hash of the VMT file, its textures and the import options that change the material"""
+        files = [get_identity(self.filepath)]
+        files.extend(sorted(str(get_identity(path)) for path in self.get_texture_paths()))
+        options = (FINGERPRINT_VERSION, self.textureext, node_groups, self.cache.bake, self.cache.max_size)
+        data = repr((self.get_signature(), files, options))
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def is_unchanged(self, mat_name: str, node_groups: bool=False) -> bool:
+        """Whether the material was imported from this VMT with the same textures and options before"""
+        mat = bpy.data.materials.get(mat_name)
+        if mat is None or not mat.use_nodes or mat.get(FINGERPRINT_PROPERTY) != self.get_fingerprint(node_groups):
+            return False
+        # Placeholders of a deferred import are loaded by importing it again without deferring
+        return self.cache.deferred or not deferred.get_material_pending_images(mat)
+
+    def get_texture_paths(self) -> Set[Path]:
+        return set(pair[0] for pair in self.texture_files.values() if isinstance(pair[0], Path))
+
+    # Where different textures are connected
+    _texture_inputs = {
+        "base": "Base Color",
+        "specular": "Specular",
+        "specular_tint": "Specular Tint",
+        "roughness": "Roughness",
+        "emission": "Emission",
+        "alpha": "Alpha",
+        "normal": "Normal"
+    }
+
+    def get_inputs(self) -> List[MaterialInput]:
+        inputs = []
+        for name, socket in self._texture_inputs.items():
+            if name in self.texture_consts:
+                # Overrides possible texture value
+                inputs.append(MaterialInput(name, socket, None, None, None, self.texture_consts[name]))
+            elif name in self.texture_files:
+                filepath, out_type = self.texture_files[name]
+                texname = name
+                if type(filepath) is str:
+                    # Relative reference, solve it
+                    texname = filepath
+                    relativepair = self.texture_files.get(filepath)
+                    if not relativepair:
+                        instrument.log("VMT: Referenced texture {} not found".format(filepath), instrument.LEVEL_ERRORS)
+                        continue
+                    filepath = relativepair[0]
+                if self.cache.bake and out_type in ("r", "g", "b"):
+                    transform = bake.get_transform(name)
+                    inputs.append(MaterialInput(name, socket, bake.get_texture_name(texname, out_type, transform), filepath, out_type, None, True))
+                    continue
+                inputs.append(MaterialInput(name, socket, texname, filepath, out_type, None))
+            elif name in self.texture_defaults:
+                inputs.append(MaterialInput(name, socket, None, None, None, self.texture_defaults[name]))
+        return inputs
 
-    def make_material(self, mat_name: str=None, override: bool=False) -> bool:
+    def make_material(self, mat_name: str=None, override: bool=False, node_groups: bool=False) -> bool:
         if not mat_name:
             mat_name = self.filepath.stem
+        # Includes loading the textures that weren't prefetched
+        with instrument.span("build", mat_name):
+            if not self._make_material(mat_name, override, node_groups):
+                return False
+        # Only stored once the material is complete, a failed build is built again next time
+        mat = bpy.data.materials[mat_name]
+        mat[SOURCE_PROPERTY] = str(self.filepath)
+        mat[FINGERPRINT_PROPERTY] = self.get_fingerprint(node_groups)
+        return True
+
+    def _make_material(self, mat_name: str, override: bool, node_groups: bool) -> bool:
         mat = bpy.data.materials.get(mat_name)
         if mat:
             if not override:
@@ -91,10 +242,13 @@ class VMT:
                     mat.node_tree.nodes.remove(node)
         else:
             mat = bpy.data.materials.new(mat_name)
-        print("VMT: Building material")
+        instrument.log("VMT: Building material")
         mat.use_nodes = True
         mat.blend_method = self.blend_method
         mat.shadow_method = self.shadow_method
+        if node_groups:
+            nodegroups.build_material(mat, self.get_inputs(), self._load_input)
+            return True
         nodes = mat.node_tree.nodes
         links = mat.node_tree.links
         out = nodes.get('Material Output', None)
@@ -110,22 +264,13 @@ class VMT:
         bsdf.inputs['Roughness'].default_value = 1.0
         texnodes = dict()
         separatornodes = dict()
-        # Where different textures are connected
-        texnames = {
-            "base": "Base Color",
-            "specular": "Specular",
-            "specular_tint": "Specular Tint",
-            "roughness": "Roughness",
-            "emission": "Emission",
-            "alpha": "Alpha",
-            "normal": "Normal"
-        }
+        texnames = self._texture_inputs
         texnodelocationy = 300
         for name in texnames:
             if name in self.texture_consts:
                 # No texture, but a constant value
                 # Overrides possible texture value
-                print("VMT: Overriding {} with constant value".format(name))
+                instrument.log("VMT: Overriding {} with constant value".format(name))
                 bsdf.inputs[texnames[name]].default_value = self.texture_consts[name]
             elif name in self.texture_files:
                 pair = self.texture_files[name]
@@ -141,17 +286,34 @@ class VMT:
                     else:
                         relativepair = self.texture_files.get(filepath)
                         if not relativepair:
-                            print("VMT: Referenced texture {} not found".format(filepath))
+                            instrument.log("VMT: Referenced texture {} not found".format(filepath), instrument.LEVEL_ERRORS)
                             continue
                         filepath = relativepair[0]
                 else:
                     texname = name
                     if texnodes.get(texname, None):
                         tex = texnodes[texname]
+                out_type = pair[1]
+                # Single channels can be baked to their own images, which don't need separating or math nodes
+                baked = self.cache.bake and out_type in ("r", "g", "b")
+                if baked:
+                    transform = bake.get_transform(name)
+                    texname = bake.get_texture_name(texname, out_type, transform)
+                    tex = texnodes.get(texname, None)
+                    if not tex and type(filepath) is str:
+                        # Only the full image of the referenced texture had a node
+                        filepath = self.texture_files[filepath][0]
                 # Create texture node if not already created
                 if not tex:
                     tex = nodes.new('ShaderNodeTexImage')
-                    tex.image = self._load_image(filepath)
+                    if baked:
+                        tex.image = self.cache.load_derived(filepath, self.convert, out_type, transform)
+                    else:
+                        tex.image = self._load_image(filepath)
+                    if tex.image is None:
+                        # Failed to import, already logged
+                        nodes.remove(tex)
+                        continue
                     # Set to non-color data for other images than base color
                     if texname == "base":
                         tex.image.colorspace_settings.name = "sRGB"
@@ -162,10 +324,9 @@ class VMT:
                     tex.location = (-1000, texnodelocationy)
                     texnodelocationy -= 300
                     texnodes[texname] = tex
-                out_type = pair[1]
                 out = None
                 out_node = tex
-                if out_type == "rgb":
+                if out_type == "rgb" or baked:
                     out = "Color"
                 elif out_type == "a":
                     out = "Alpha"
@@ -190,7 +351,7 @@ class VMT:
                     links.new(out_node.outputs[out], normal.inputs['Color'])
                     out_node = normal
                     out = "Normal"
-                elif name == "roughness":
+                elif name == "roughness" and not baked:
                     # Need to invert value since source format is different
                     # And multiply by 0.5 for more accurate results
                     invert = nodes.new("ShaderNodeMath")
@@ -212,14 +373,72 @@ class VMT:
         return True
     
     def _load_image(self, path: Path) -> bpy.types.Image:
-        if path not in self.images:
-            print("VMT: Loading texture {}".format(path))
-            if self.convert:
-                if path.stem in bpy.data.images:
-                    result = bpy.data.images[path.stem]
-                else:
-                    result = vtf.import_image(path)
-                self.images[path] = result
-            else:
-                self.images[path] = bpy.data.images.load(str(path), check_existing=True)
-        return self.images[path]
\ No newline at end of file
+        return self.cache.load(path, self.convert)
+
+    def _load_input(self, i: MaterialInput) -> bpy.types.Image:
+        if i.baked:
+            return self.cache.load_derived(i.path, self.convert, i.output, bake.get_transform(i.name))
+        return self._load_image(i.path)
+
+
+def parse_vmts(paths: Iterable[Path], workers: int=0) -> Set[Path]:
+    """Read and parse all files at once, VMT objects then get them from the parsed file cache.
+    Returns the files that failed to parse, which should be skipped."""
+    paths = list(paths)
+    instrument.log("VMT: Parsing {} VMT files".format(len(paths)))
+    failed = set()
+    for path, result in keyvalues.parse_files(paths, workers).items():
+        if isinstance(result, Exception):
+            instrument.log("VMT: Failed to parse {}: {}".format(path, result), instrument.LEVEL_ERRORS)
+            failed.add(path)
+        elif not result:
+            instrument.log("VMT: No shader in {}".format(path), instrument.LEVEL_ERRORS)
+            failed.add(path)
+    return failed
+
+
+def find_duplicates(vmts: Dict[str, VMT]) -> Dict[str, str]:
+    """Map the names of materials equivalent to an earlier one to the name of that material"""
+    originals = dict()  # signature -> name
+    duplicates = dict()
+    for name, vmt in vmts.items():
+        signature = vmt.get_signature()
+        if signature in originals:
+            duplicates[name] = originals[signature]
+        else:
+            originals[signature] = name
+    return duplicates
+
+
+def prefetch_textures(vmts: Iterable[VMT], cache: TextureCache, workers: int=0):
+    for _ in iter_prefetch_textures(vmts, cache, workers):
+        pass
+
+
+def get_texture_requests(vmt: VMT, cache: TextureCache) -> Tuple[Set[Path], Set[Tuple[Path, str, Optional[str]]]]:
+    """Textures a material imports and the derived textures it bakes, as (path, channel, transform)"""
+    paths = set()
+    derived = set()
+    if not vmt.convert:
+        return paths, derived
+    if not cache.bake:
+        return vmt.get_texture_paths(), derived
+    # Only the textures used as they are, the baked ones don't need the full image
+    for i in vmt.get_inputs():
+        if i.baked:
+            derived.add((i.path, i.output, bake.get_transform(i.name)))
+        elif i.texture is not None:
+            paths.add(i.path)
+    return paths, derived
+
+
+def iter_prefetch_textures(vmts: Iterable[VMT], cache: TextureCache, workers: int=0) -> Iterator[Progress]:
+    # Decode the textures of all materials in parallel before any material is built
+    paths = set()
+    derived = set()
+    for vmt in vmts:
+        vmt_paths, vmt_derived = get_texture_requests(vmt, cache)
+        paths.update(vmt_paths)
+        derived.update(vmt_derived)
+    for done, total in cache.iter_prefetch(paths, workers, derived):
+        yield Progress(done, total, 0, 0)
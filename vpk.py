@@ -0,0 +1,242 @@
+# Reading files from VPK archives without extracting them
+# Format reference: https://developer.valvesoftware.com/wiki/VPK_File_Format
+
+import os
+import mmap
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import instrument
+
+SIGNATURE = 0x55aa1234
+INDEX_VERSION = 1
+
+# Archive index of files stored in the directory file itself, after the tree
+DIR_ARCHIVE = 0x7fff
+
+_HEADER = struct.Struct("<3I")
+_HEADER_V2 = struct.Struct("<4I")
+_ENTRY = struct.Struct("<IHHIIH")
+
+
+class VpkEntry:
+    __slots__ = ("crc", "archive", "offset", "length", "preload_offset", "preload_length")
+
+    def __init__(self, crc: int, archive: int, offset: int, length: int, preload_offset: int, preload_length: int):
+        self.crc = crc
+        self.archive = archive
+        self.offset = offset  # in the archive, or after the tree for DIR_ARCHIVE
+        self.length = length  # excluding the preload bytes
+        self.preload_offset = preload_offset  # in the directory file
+        self.preload_length = preload_length
+
+    @property
+    def size(self) -> int:
+        return self.preload_length + self.length
+
+
+def _read_string(data: bytes, pos: int) -> Tuple[str, int]:
+    end = data.index(b"\0", pos)
+    return data[pos:end].decode("utf-8", "replace"), end + 1
+
+
+class VpkArchive:
+    """Directory of a multi-part VPK archive, mapping lower-cased paths to entries whose data is read with mmap"""
+
+    def __init__(self, path: Path, subdirs: Tuple[str, ...]=("materials",)):
+        self.path = Path(path)  # the _dir.vpk file
+        self.subdirs = subdirs  # only files under these are indexed
+        self.files = dict()  # type: Dict[str, Tuple[str, VpkEntry]]  # normalized path -> real path, entry
+        self.data_offset = 0  # of the DIR_ARCHIVE data in the directory file
+        self.stat = None  # (size, mtime_ns) of the directory file when it was read
+        self._maps = dict()  # archive index -> mmap
+        self._lock = threading.Lock()
+
+    def _get_stat(self) -> Tuple[int, int]:
+        stat = os.stat(str(self.path))
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_current(self) -> bool:
+        try:
+            return self.stat == self._get_stat()
+        except OSError:
+            return False
+
+    def read_directory(self):
+        with instrument.span("vpk"):
+            self.stat = self._get_stat()
+            with open(str(self.path), "rb") as f:
+                signature, version, tree_size = _HEADER.unpack(f.read(_HEADER.size))
+                if signature != SIGNATURE:
+                    raise Exception("VPK: Invalid signature in {}".format(self.path))
+                header_size = _HEADER.size
+                if version == 2:
+                    f.read(_HEADER_V2.size)
+                    header_size += _HEADER_V2.size
+                elif version != 1:
+                    raise Exception("VPK: Unsupported version {} of {}".format(version, self.path))
+                tree = f.read(tree_size)
+            self.data_offset = header_size + tree_size
+            self.files = dict()
+            prefixes = tuple(subdir + "/" for subdir in self.subdirs)
+            pos = 0
+            while True:
+                extension, pos = _read_string(tree, pos)
+                if not extension:
+                    break
+                while True:
+                    directory, pos = _read_string(tree, pos)
+                    if not directory:
+                        break
+                    directory = "" if directory == " " else directory.strip("/") + "/"
+                    wanted = not prefixes or directory.lower().startswith(prefixes)
+                    while True:
+                        name, pos = _read_string(tree, pos)
+                        if not name:
+                            break
+                        crc, preload_length, archive, offset, length, _ = _ENTRY.unpack_from(tree, pos)
+                        pos += _ENTRY.size
+                        if wanted:
+                            relpath = directory + name + ("" if extension == " " else "." + extension)
+                            entry = VpkEntry(crc, archive, offset, length, header_size + pos, preload_length)
+                            self.files[relpath.lower()] = (relpath, entry)
+                        pos += preload_length
+        instrument.log("VPK: Indexed {} files in {}".format(len(self.files), self.path))
+
+    def _get_archive_path(self, archive: int) -> Path:
+        if archive == DIR_ARCHIVE:
+            return self.path
+        # pak01_dir.vpk -> pak01_000.vpk
+        return self.path.with_name("{}_{:03}.vpk".format(self.path.name[:-len("_dir.vpk")], archive))
+
+    def _get_map(self, archive: int) -> mmap.mmap:
+        data = self._maps.get(archive)
+        if data is None:
+            with self._lock:
+                data = self._maps.get(archive)
+                if data is None:
+                    with open(str(self._get_archive_path(archive)), "rb") as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[archive] = data
+        return data
+
+    def get_entry(self, relpath: str) -> Optional[VpkEntry]:
+        item = self.files.get(relpath.lower())
+        return item[1] if item is not None else None
+
+    def read(self, entry: VpkEntry, size: int=-1) -> memoryview:
+        """Data of an entry, only the first size bytes if given. Only the pages used are read from the archive."""
+        if size < 0 or size > entry.size:
+            size = entry.size
+        offset = entry.offset + (self.data_offset if entry.archive == DIR_ARCHIVE else 0)
+        if not entry.preload_length:
+            return memoryview(self._get_map(entry.archive))[offset:offset + size]
+        # Preloaded bytes are stored in the directory, followed by the rest in the archive
+        data = bytearray(self._get_map(DIR_ARCHIVE)[entry.preload_offset:entry.preload_offset + min(size, entry.preload_length)])
+        if size > entry.preload_length:
+            data += self._get_map(entry.archive)[offset:offset + size - entry.preload_length]
+        return memoryview(data)
+
+    def iter_files(self) -> Iterator[Tuple[str, str]]:
+        for relpath, (real, _) in self.files.items():
+            yield relpath, real
+
+    def close(self):
+        """Unmap the archive files. Maps still used by data read from them are freed with that data."""
+        with self._lock:
+            maps = list(self._maps.values())
+            self._maps = dict()
+        for data in maps:
+            try:
+                data.close()
+            except BufferError:
+                pass
+
+    def _get_file(self, directory: Path) -> Path:
+        # content imports this module
+        from .content import get_index_file
+        return get_index_file(directory, "vpk", "{}|{}".format(self.path.resolve(), "|".join(self.subdirs)))
+
+    def load(self, directory: Path) -> bool:
+        from .content import load_index
+        data = load_index(self._get_file(directory), INDEX_VERSION)
+        try:
+            stat = self._get_stat()
+        except OSError:
+            return False
+        if data is None or data.get("subdirs") != list(self.subdirs) or tuple(data.get("stat", ())) != stat:
+            return False
+        self.stat = stat
+        self.data_offset = data["data_offset"]
+        self.files = {real.lower(): (real, VpkEntry(*entry)) for real, entry in data["files"]}
+        return True
+
+    def save(self, directory: Path):
+        from .content import save_index
+        files = [[real, [entry.crc, entry.archive, entry.offset, entry.length, entry.preload_offset, entry.preload_length]]
+                 for real, entry in self.files.values()]
+        save_index(self._get_file(directory), INDEX_VERSION, {"path": str(self.path), "subdirs": list(self.subdirs),
+                                                               "stat": list(self.stat), "data_offset": self.data_offset, "files": files})
+
+
+# Archives opened in this session, keyed by the path of the directory file.
+# Paths of files in them are the directory file path followed by the path in the archive.
+_archives = dict()  # type: Dict[str, VpkArchive]
+
+
+def mount(path: Path, subdirs: Tuple[str, ...]=("materials",), cache_directory: Path=None) -> VpkArchive:
+    key = str(path)
+    archive = _archives.get(key)
+    if archive is not None:
+        if archive.subdirs == subdirs and archive.is_current():
+            return archive
+        unmount(path)
+    archive = VpkArchive(path, subdirs)
+    if not cache_directory or not archive.load(cache_directory):
+        archive.read_directory()
+        if cache_directory:
+            archive.save(cache_directory)
+    _archives[key] = archive
+    return archive
+
+
+def unmount(path: Path):
+    """Forget an archive and close its files"""
+    archive = _archives.pop(str(path), None)
+    if archive is not None:
+        archive.close()
+
+
+def unmount_all():
+    for path in list(_archives):
+        unmount(path)
+
+
+def find_dir_files(root: Path) -> List[Path]:
+    try:
+        with os.scandir(str(root)) as it:
+            return sorted(Path(item.path) for item in it if item.name.lower().endswith("_dir.vpk") and item.is_file())
+    except OSError:
+        return []
+
+
+def find(path: Path) -> Optional[Tuple[VpkArchive, VpkEntry]]:
+    """Archive and entry of a path inside an archive, which is mounted if it isn't already"""
+    for parent in path.parents:
+        if not parent.name.lower().endswith("_dir.vpk"):
+            continue
+        archive = _archives.get(str(parent))
+        if archive is None:
+            # For example a deferred texture of a .blend file saved in an earlier session
+            if not parent.is_file():
+                return None
+            try:
+                archive = mount(parent)
+            except Exception as e:
+                instrument.log("VPK: Failed to read {}: {}".format(parent, e), instrument.LEVEL_ERRORS)
+                return None
+        entry = archive.get_entry(path.relative_to(parent).as_posix())
+        return (archive, entry) if entry is not None else None
+    return None
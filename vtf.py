@@ -1,38 +1,135 @@
 # Heavily inspired by https://github.com/Ganonmaster/io_texture_VTF/blob/blender280/vtf.py
 
 import bpy
+import os
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
 
 import numpy as np
-from .libraries.VTFLibWrapper import VTFLib
-from .libraries.VTFLibWrapper import VTFLibEnums
-
-vtf_lib = VTFLib.VTFLib()
-
-def import_image(path: Path) -> bpy.types.Image:
-    name = path.stem
-    vtf_lib.image_load(str(path))
-    try:
-        if vtf_lib.image_is_loaded():
-            print('VTF: Image loaded successfully')
-            pass
-        else:
-            raise Exception("VTF: Failed to load image :{}".format(vtf_lib.get_last_error()))
-        rgba_data = vtf_lib.get_rgba8888()
-        print('VTF: Converted')
-        rgba_data = vtf_lib.flip_image_external(rgba_data, vtf_lib.width(), vtf_lib.height())
-        print('VTF: Flipped')
-        pixels = np.array(rgba_data.contents, np.uint8)
-        pixels = pixels.astype(np.float16, copy=False)
-        print("VTF: Saving rgb")
-        flags = vtf_lib.get_image_flags()
-        alpha = flags.get_flag(VTFLibEnums.ImageFlag.ImageFlagOneBitAlpha) or flags.get_flag(VTFLibEnums.ImageFlag.ImageFlagEightBitAlpha)
-        image = bpy.data.images.new(name, width=vtf_lib.width(), height=vtf_lib.height(), alpha=alpha)
-        pixels = np.divide(pixels, 255)
-        image.pixels = pixels
-        image.file_format = "PNG"
+from . import decode
+from . import instrument
+from .diskcache import PixelCache
+from .memory import MemoryBudget
+
+
+# Reused between uploads, so a new float buffer isn't allocated for every texture
+_upload_buffer = None
+
+
+def _free_upload_buffer():
+    global _upload_buffer
+    _upload_buffer = None
+
+
+def _get_upload_buffer(size: int, low_memory: bool, budget: MemoryBudget=None) -> np.ndarray:
+    global _upload_buffer
+    if low_memory:
+        # Don't keep the largest texture's worth of floats around after the upload
+        _upload_buffer = None
+        return np.empty(size, np.float32)
+    if _upload_buffer is None or _upload_buffer.size < size:
+        _upload_buffer = None
+        if budget is not None:
+            budget.fits(size * 4)
+        _upload_buffer = np.empty(size, np.float32)
+        if budget is not None:
+            # Kept for the next upload, but freed first when the memory is needed
+            budget.add("upload buffer", _upload_buffer.nbytes, _free_upload_buffer)
+    elif budget is not None:
+        budget.touch("upload buffer")
+    return _upload_buffer[:size]
+
+
+def set_pixels(image: bpy.types.Image, values: np.ndarray):
+    if hasattr(image.pixels, "foreach_set"):
+        image.pixels.foreach_set(values)
+    else:
+        image.pixels[:] = values
+
+
+def upload_pixels(image: bpy.types.Image, pixels: np.ndarray, low_memory: bool=False, budget: MemoryBudget=None):
+    # Single conversion straight into the float buffer Blender copies from, without temporaries
+    with instrument.span("upload"):
+        buffer = _get_upload_buffer(pixels.size, low_memory, budget)
+        np.divide(pixels.reshape(-1), np.float32(255), out=buffer)
+        set_pixels(image, buffer)
+    instrument.count("uploaded bytes", buffer.nbytes)
+
+
+def fill_image(image: bpy.types.Image, decoded: decode.DecodedImage, low_memory: bool=False, budget: MemoryBudget=None):
+    if tuple(image.size) != (decoded.width, decoded.height):
+        image.scale(decoded.width, decoded.height)
+    upload_pixels(image, decoded.pixels, low_memory, budget)
+    image.file_format = "PNG"
+    with instrument.span("pack"):
         image.pack()
-        return image
-    finally:
-        vtf_lib.image_destroy()
+
+
+def load_image(name: str, decoded: decode.DecodedImage, low_memory: bool=False, budget: MemoryBudget=None) -> bpy.types.Image:
+    instrument.log("VTF: Saving rgb")
+    image = bpy.data.images.new(name, width=decoded.width, height=decoded.height, alpha=decoded.alpha)
+    fill_image(image, decoded, low_memory, budget)
+    return image
+
+
+def free_buffers(name: str):
+    """Free the pixels of a packed image, Blender loads them from the packed file again when needed"""
+    image = bpy.data.images.get(name)
+    if image is not None and image.packed_file is not None:
+        image.buffers_free()
+
+
+def import_image(path: Path, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=decode.BACKEND_VTFLIB, max_size: int=0) -> bpy.types.Image:
+    decoded = pixel_cache.get(path, max_size) if pixel_cache else None
+    if decoded is None:
+        decoded = decode.decode_vtf(path, backend, max_size)
+        if pixel_cache:
+            pixel_cache.put(path, decoded, max_size)
+    return load_image(path.stem, decoded, low_memory)
+
+
+def decode_images(paths: Iterable[Path], workers: int=0, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=decode.BACKEND_VTFLIB, max_size: int=0, budget: MemoryBudget=None) -> Iterator[Tuple[Path, Union[decode.DecodedImage, Exception]]]:
+    # Decoding happens in worker processes or threads, only the image creation needs the main thread
+    to_decode = []
+    for path in paths:
+        decoded = pixel_cache.get(path, max_size) if pixel_cache else None
+        if decoded is None:
+            to_decode.append(path)
+        elif budget is not None:
+            # Read from the memory mapped cache file while it's used
+            budget.fits(decoded.pixels.nbytes)
+            budget.reserve(decoded.pixels.nbytes)
+            try:
+                yield path, decoded
+            finally:
+                budget.release(decoded.pixels.nbytes)
+        else:
+            yield path, decoded
+        del decoded
+    # Only keep a couple of decoded textures per worker waiting for upload
+    max_pending = 2 * (workers or os.cpu_count() or 1) if low_memory else 0
+    for path, result in decode.decode_vtfs(to_decode, workers, max_pending, backend, max_size, budget):
+        if pixel_cache and not isinstance(result, Exception):
+            pixel_cache.put(path, result, max_size)
+        yield path, result
+        del result
+
+
+def iter_import_images(paths: Iterable[Path], workers: int=0, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=decode.BACKEND_VTFLIB, max_size: int=0, budget: MemoryBudget=None) -> Iterator[Tuple[Path, Optional[bpy.types.Image]]]:
+    """Import images one at a time as they are decoded, yielding None for the ones that failed"""
+    for path, result in decode_images(paths, workers, pixel_cache, low_memory, backend, max_size, budget):
+        if isinstance(result, Exception):
+            instrument.log("VTF: Failed to decode {}: {}".format(path, result), instrument.LEVEL_ERRORS)
+            yield path, None
+            continue
+        image = load_image(path.stem, result, low_memory, budget)
+        del result
+        yield path, image
+
+
+def import_images(paths: Iterable[Path], workers: int=0, pixel_cache: PixelCache=None, low_memory: bool=False, backend: str=decode.BACKEND_VTFLIB, max_size: int=0) -> Dict[Path, bpy.types.Image]:
+    images = dict()
+    for path, image in iter_import_images(paths, workers, pixel_cache, low_memory, backend, max_size):
+        if image is not None:
+            images[path] = image
+    return images
@@ -0,0 +1,261 @@
+# Pure NumPy VTF decoder, an alternative to VTFLib that works on bytes and can run in several threads at once
+# Format reference: https://developer.valvesoftware.com/wiki/Valve_Texture_Format
+
+import struct
+from typing import Dict, NamedTuple, Tuple
+
+import numpy as np
+
+FORMAT_RGBA8888 = 0
+FORMAT_ABGR8888 = 1
+FORMAT_RGB888 = 2
+FORMAT_BGR888 = 3
+FORMAT_I8 = 5
+FORMAT_IA88 = 6
+FORMAT_A8 = 8
+FORMAT_BGRA8888 = 12
+FORMAT_DXT1 = 13
+FORMAT_DXT3 = 14
+FORMAT_DXT5 = 15
+FORMAT_BGRX8888 = 16
+FORMAT_DXT1_ONEBITALPHA = 20
+
+FLAG_ONEBITALPHA = 0x1000
+FLAG_EIGHTBITALPHA = 0x2000
+FLAG_ENVMAP = 0x4000
+
+RESOURCE_HIGH_RES_IMAGE = b"\x30\x00\x00"
+
+# Bytes per 4x4 block for compressed formats
+_BLOCK_SIZES = {
+    FORMAT_DXT1: 8,
+    FORMAT_DXT1_ONEBITALPHA: 8,
+    FORMAT_DXT3: 16,
+    FORMAT_DXT5: 16,
+}
+
+# Source byte index of R, G, B and A for uncompressed formats, None for a constant
+_CHANNELS = {
+    FORMAT_RGBA8888: (4, (0, 1, 2, 3)),
+    FORMAT_ABGR8888: (4, (3, 2, 1, 0)),
+    FORMAT_RGB888: (3, (0, 1, 2, None)),
+    FORMAT_BGR888: (3, (2, 1, 0, None)),
+    FORMAT_I8: (1, (0, 0, 0, None)),
+    FORMAT_IA88: (2, (0, 0, 0, 1)),
+    FORMAT_A8: (1, (None, None, None, 0)),
+    FORMAT_BGRA8888: (4, (2, 1, 0, 3)),
+    FORMAT_BGRX8888: (4, (2, 1, 0, None)),
+}
+
+SUPPORTED_FORMATS = frozenset(_BLOCK_SIZES) | frozenset(_CHANNELS)
+
+# Blocks decoded at once, bounds the size of the temporary index arrays
+_CHUNK_BLOCKS = 1 << 16
+
+_HEADER = struct.Struct("<4s2IIHHIHH4x3f4xfiBiBB")
+
+# Enough to contain the header and the resource entries
+HEADER_READ_SIZE = 4096
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+class VtfHeader(NamedTuple):
+    version: Tuple[int, int]
+    header_size: int
+    width: int
+    height: int
+    flags: int
+    frames: int
+    first_frame: int
+    image_format: int
+    mipmap_count: int
+    low_format: int
+    low_width: int
+    low_height: int
+    depth: int
+    resources: Dict[bytes, int]
+
+    @property
+    def alpha(self) -> bool:
+        return bool(self.flags & (FLAG_ONEBITALPHA | FLAG_EIGHTBITALPHA))
+
+    @property
+    def faces(self) -> int:
+        if not self.flags & FLAG_ENVMAP:
+            return 1
+        # Older versions have an additional sphere map face
+        return 7 if self.version[1] < 5 and self.first_frame != 0xffff else 6
+
+
+def read_header(data: bytes) -> VtfHeader:
+    if len(data) < _HEADER.size:
+        raise Exception("VTF: File is too small")
+    (signature, major, minor, header_size, width, height, flags, frames, first_frame,
+        _, _, _, _, image_format, mipmap_count, low_format, low_width, low_height) = _HEADER.unpack_from(data)
+    if signature != b"VTF\0":
+        raise Exception("VTF: Invalid signature")
+    depth = 1
+    if minor >= 2:
+        depth = max(1, struct.unpack_from("<H", data, 63)[0])
+    resources = dict()
+    if minor >= 3:
+        resource_count = struct.unpack_from("<I", data, 68)[0]
+        for i in range(resource_count):
+            tag, _, offset = struct.unpack_from("<3sBI", data, 80 + i * 8)
+            resources[tag] = offset
+    return VtfHeader((major, minor), header_size, width, height, flags, frames, first_frame,
+                     image_format, mipmap_count, low_format, low_width, low_height, depth, resources)
+
+
+def get_image_size(image_format: int, width: int, height: int) -> int:
+    if image_format in _BLOCK_SIZES:
+        return max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * _BLOCK_SIZES[image_format]
+    if image_format in _CHANNELS:
+        return width * height * _CHANNELS[image_format][0]
+    raise UnsupportedFormat("VTF: Unsupported image format {}".format(image_format))
+
+
+def get_mipmap_size(header: VtfHeader, level: int) -> Tuple[int, int]:
+    return max(1, header.width >> level), max(1, header.height >> level)
+
+
+def _get_mipmap_offset(header: VtfHeader, level: int) -> int:
+    # Mipmaps are stored from the smallest to the largest,
+    # each containing all frames, faces and slices
+    if header.version[1] >= 3:
+        if RESOURCE_HIGH_RES_IMAGE not in header.resources:
+            raise Exception("VTF: No image data")
+        offset = header.resources[RESOURCE_HIGH_RES_IMAGE]
+    else:
+        offset = header.header_size
+        if header.low_format >= 0 and header.low_width and header.low_height:
+            offset += get_image_size(header.low_format, header.low_width, header.low_height)
+    for smaller in range(header.mipmap_count - 1, level, -1):
+        width, height = get_mipmap_size(header, smaller)
+        depth = max(1, header.depth >> smaller)
+        offset += get_image_size(header.image_format, width, height) * header.frames * header.faces * depth
+    return offset
+
+
+def _unpack_565(colors: np.ndarray) -> np.ndarray:
+    r = (colors >> 11) & 0x1f
+    g = (colors >> 5) & 0x3f
+    b = colors & 0x1f
+    return np.stack(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)), axis=-1)
+
+
+def _decode_color(blocks: np.ndarray, out: np.ndarray, four_colors: bool):
+    # blocks: (n, 8) color blocks, out: (n, 16, 4)
+    count = blocks.shape[0]
+    colors = np.ascontiguousarray(blocks[:, :4]).view("<u2").astype(np.uint16)
+    rgb0 = _unpack_565(colors[:, 0])
+    rgb1 = _unpack_565(colors[:, 1])
+    palette = np.empty((count, 4, 4), np.uint16)
+    palette[:, 0, :3] = rgb0
+    palette[:, 1, :3] = rgb1
+    palette[:, :, 3] = 255
+    if four_colors:
+        mode = np.ones((count, 1), bool)
+    else:
+        mode = (colors[:, 0] > colors[:, 1])[:, None]
+    palette[:, 2, :3] = np.where(mode, (2 * rgb0 + rgb1) // 3, (rgb0 + rgb1) // 2)
+    palette[:, 3, :3] = np.where(mode, (rgb0 + 2 * rgb1) // 3, 0)
+    # Three color mode has transparent black as the fourth color
+    palette[:, 3, 3] = np.where(mode[:, 0], 255, 0)
+    bits = np.ascontiguousarray(blocks[:, 4:8]).view("<u4")
+    indices = (bits >> np.arange(0, 32, 2, dtype=np.uint32)) & 3
+    out[:] = palette[np.arange(count)[:, None], indices]
+
+
+def _decode_alpha_dxt3(blocks: np.ndarray, out: np.ndarray):
+    # 4 bits per pixel, low nibble first
+    alpha = np.empty((blocks.shape[0], 16), np.uint8)
+    alpha[:, 0::2] = blocks[:, :8] & 0x0f
+    alpha[:, 1::2] = blocks[:, :8] >> 4
+    out[:, :, 3] = alpha * 17
+
+
+def _decode_alpha_dxt5(blocks: np.ndarray, out: np.ndarray):
+    count = blocks.shape[0]
+    a0 = blocks[:, 0].astype(np.uint16)
+    a1 = blocks[:, 1].astype(np.uint16)
+    palette = np.empty((count, 8), np.uint16)
+    palette[:, 0] = a0
+    palette[:, 1] = a1
+    eight = a0 > a1
+    for i in range(2, 8):
+        six = ((6 - i) * a0 + (i - 1) * a1) // 5 if i < 6 else (0 if i == 6 else 255)
+        palette[:, i] = np.where(eight, ((8 - i) * a0 + (i - 1) * a1) // 7, six)
+    packed = np.zeros((count, 8), np.uint8)
+    packed[:, :6] = blocks[:, 2:8]
+    bits = packed.view("<u8")
+    indices = (bits >> np.arange(0, 48, 3, dtype=np.uint64)) & 7
+    out[:, :, 3] = palette[np.arange(count)[:, None], indices.astype(np.intp)]
+
+
+def _decode_blocks(data: bytes, offset: int, image_format: int, width: int, height: int) -> np.ndarray:
+    block_size = _BLOCK_SIZES[image_format]
+    blocks_x = max(1, (width + 3) // 4)
+    blocks_y = max(1, (height + 3) // 4)
+    count = blocks_x * blocks_y
+    blocks = np.frombuffer(data, np.uint8, count * block_size, offset).reshape(count, block_size)
+    out = np.empty((count, 16, 4), np.uint8)
+    for start in range(0, count, _CHUNK_BLOCKS):
+        chunk = blocks[start:start + _CHUNK_BLOCKS]
+        chunk_out = out[start:start + _CHUNK_BLOCKS]
+        if image_format == FORMAT_DXT3:
+            _decode_color(chunk[:, 8:], chunk_out, True)
+            _decode_alpha_dxt3(chunk, chunk_out)
+        elif image_format == FORMAT_DXT5:
+            _decode_color(chunk[:, 8:], chunk_out, True)
+            _decode_alpha_dxt5(chunk, chunk_out)
+        else:
+            _decode_color(chunk, chunk_out, False)
+    # Blocks to rows of pixels
+    out = out.reshape(blocks_y, blocks_x, 4, 4, 4).transpose(0, 2, 1, 3, 4)
+    return out.reshape(blocks_y * 4, blocks_x * 4, 4)[:height, :width]
+
+
+def _decode_pixels(data: bytes, offset: int, image_format: int, width: int, height: int) -> np.ndarray:
+    pixel_size, channels = _CHANNELS[image_format]
+    pixels = np.frombuffer(data, np.uint8, width * height * pixel_size, offset).reshape(height, width, pixel_size)
+    out = np.empty((height, width, 4), np.uint8)
+    for i, channel in enumerate(channels):
+        if channel is None:
+            out[:, :, i] = 0 if i < 3 else 255
+        else:
+            out[:, :, i] = pixels[:, :, channel]
+    return out
+
+
+def get_mipmap_level(header: VtfHeader, max_size: int) -> int:
+    # Largest stored mipmap that fits in the size limit, or the smallest one there is
+    level = 0
+    if max_size > 0:
+        while level < header.mipmap_count - 1 and max(get_mipmap_size(header, level)) > max_size:
+            level += 1
+    return level
+
+
+def decode_vtf_data(data: bytes, mipmap_level: int=0, max_size: int=0) -> Tuple[int, int, bool, np.ndarray]:
+    """Decode the first frame of a VTF file to flat RGBA8888 pixels, bottom row first.
+    A smaller mipmap is decoded instead of the full image if a mipmap level or a maximum size is given."""
+    header = read_header(data)
+    if header.image_format not in SUPPORTED_FORMATS:
+        raise UnsupportedFormat("VTF: Unsupported image format {}".format(header.image_format))
+    mipmap_level = max(mipmap_level, get_mipmap_level(header, max_size))
+    mipmap_level = min(mipmap_level, max(0, header.mipmap_count - 1))
+    width, height = get_mipmap_size(header, mipmap_level)
+    offset = _get_mipmap_offset(header, mipmap_level)
+    if offset + get_image_size(header.image_format, width, height) > len(data):
+        raise Exception("VTF: Unexpected end of file")
+    if header.image_format in _BLOCK_SIZES:
+        rgba = _decode_blocks(data, offset, header.image_format, width, height)
+    else:
+        rgba = _decode_pixels(data, offset, header.image_format, width, height)
+    # Blender images start from the bottom row
+    pixels = np.ascontiguousarray(rgba[::-1]).reshape(-1)
+    return width, height, header.alpha, pixels